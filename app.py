@@ -1,16 +1,21 @@
 import os
 import json
 import collections
+import concurrent.futures
 import math
 import threading
 import time
+
+# Mốc thời gian bắt đầu khởi động (để log thời gian từng giai đoạn)
+_STARTUP_T0 = time.time()
+
 import requests
 from datetime import datetime, date
 import pytz
 from dateutil.relativedelta import relativedelta
 import re
 
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 from linebot import (
     LineBotApi, WebhookHandler
 )
@@ -20,20 +25,31 @@ from linebot.models import (
 )
 
 # --- IMPORT ---
-from config import CLIENT, SHEET_NAME, WORKSHEET_NAME_USERS, WORKSHEET_NAME, WORKSHEET_TRACKER_NAME, get_spreadsheet
+from config import SHEET_NAME, WORKSHEET_NAME_USERS, WORKSHEET_NAME, WORKSHEET_TRACKER_NAME, get_client, get_spreadsheet
+import sheet_cache
+import storage
+import write_queue
+import event_queue
+import scrape_watcher
+import schedule_repository
+import profile_cache
+import reply_dispatcher
+import command_router
+import store_index
 # CẬP NHẬT IMPORT MỚI
 from schedule_handler import send_daily_schedule
 from flex_handler import (
     initialize_daily_tasks, generate_checklist_flex, get_tasks_status_from_sheet,
     add_adhoc_tasks, generate_adhoc_flex, update_adhoc_task_status,
     add_all_adhoc_tasks, generate_all_adhoc_flex, register_group_member,
-    add_multi_adhoc_tasks, generate_multi_adhoc_flex
+    add_multi_adhoc_tasks, generate_multi_adhoc_flex, tracker_row_key,
+    get_member_registry_stats
 )
 from checklist_scheduler import send_initial_checklist, get_checklist_message 
 from meal_handler import generate_meal_flex, update_meal_status
 from vesinh_handler import generate_vesinh_flex, update_vesinh_status, get_current_vesinh_session
-from dmx_data_provider import trigger_adhoc_scrape, check_scrape_status
-from dmx_flex_messages import build_luyke_flex, build_nhanvien_flex, build_realtime_flex, build_help_commands_flex
+from dmx_data_provider import get_http_stats, get_dataset_cache_stats
+from dmx_flex_messages import build_luyke_flex, build_nhanvien_report, render_staff_cards, find_staff_rank, NHANVIEN_PAGES, build_realtime_flex, build_help_commands_flex, get_render_cache_stats
 
 # --- CẤU HÌNH ---
 CHANNEL_ACCESS_TOKEN = os.environ.get('CHANNEL_ACCESS_TOKEN')
@@ -44,17 +60,24 @@ CRON_SECRET_KEY = os.environ.get('CRON_SECRET_KEY')
 if not all([CHANNEL_ACCESS_TOKEN, CHANNEL_SECRET, ADMIN_USER_ID]):
     print("Cảnh báo: Thiếu biến môi trường quan trọng.")
 
+# Thời gian tối đa (giây) một tin nhắn chờ danh sách ID được phép tải xong lúc khởi động
+ALLOWED_IDS_WAIT_SECONDS = float(os.environ.get('ALLOWED_IDS_WAIT_SECONDS', '5'))
+
 allowed_ids_cache = set()
+allowed_ids_ready = threading.Event()
+allowed_ids_loaded = False
+_imports_done_at = time.time()
+startup_timings = {'imports_s': round(_imports_done_at - _STARTUP_T0, 2)}
 app = Flask(__name__)
 line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(CHANNEL_SECRET)
+reply_dispatcher.configure(line_bot_api)
 
 # --- UTILS ---
 def load_allowed_ids():
-    global allowed_ids_cache
+    global allowed_ids_cache, allowed_ids_loaded
     try:
-        sheet = get_spreadsheet().worksheet(WORKSHEET_NAME_USERS)
-        records = sheet.get_all_records()
+        records = sheet_cache.get_all_records(WORKSHEET_NAME_USERS)
         new_allowed_ids = set()
         today = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).date()
         for record in records:
@@ -66,9 +89,46 @@ def load_allowed_ids():
                 if exp_date >= today: new_allowed_ids.add(str(user_id))
             except ValueError: continue
         allowed_ids_cache = new_allowed_ids
+        allowed_ids_loaded = True
+        return True
     except Exception as e:
         print(f"Lỗi tải danh sách ID: {e}")
         allowed_ids_cache = set()
+        return False
+
+def warm_up(max_attempts=3):
+    """
+    Chạy nền lúc khởi động: xác thực Google, mở spreadsheet và tải danh sách ID
+    được phép. Ghi lại thời gian từng bước vào startup_timings.
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            started = time.time()
+            get_client()
+            startup_timings['google_auth_s'] = round(time.time() - started, 2)
+
+            started = time.time()
+            get_spreadsheet()
+            startup_timings['open_spreadsheet_s'] = round(time.time() - started, 2)
+        except Exception as e:
+            print(f"Lỗi khởi động kết nối Google Sheets (lần {attempt}): {e}")
+            time.sleep(2 * attempt)
+            continue
+
+        started = time.time()
+        loaded = load_allowed_ids()
+        startup_timings['allowed_ids_s'] = round(time.time() - started, 2)
+        if loaded:
+            started = time.time()
+            store_index.refresh()
+            startup_timings['store_index_s'] = round(time.time() - started, 2)
+            break
+        time.sleep(2 * attempt)
+
+    # Dù lỗi vẫn đánh dấu xong để tin nhắn không phải chờ mãi (giữ hành vi cũ khi tải lỗi)
+    startup_timings['total_ready_s'] = round(time.time() - _STARTUP_T0, 2)
+    allowed_ids_ready.set()
+    print(f"Khởi động xong: {startup_timings}")
 
 def keep_alive():
     ping_url = os.environ.get("RENDER_EXTERNAL_URL")
@@ -79,14 +139,14 @@ def keep_alive():
         time.sleep(600)
 
 def update_expiration_in_sheet(target_id, expiration_date_str):
-    sheet = get_spreadsheet().worksheet(WORKSHEET_NAME_USERS)
-    all_ids = sheet.col_values(1)
+    # Số dòng sẽ là đích ghi: đọc mới cột A (không dùng bản chụp có thể đã cũ)
+    all_ids = [row[0] if row else '' for row in sheet_cache.get_range(WORKSHEET_NAME_USERS, 'A:A')]
     try:
         row_to_update = all_ids.index(target_id) + 1
-        sheet.update_cell(row_to_update, 2, expiration_date_str)
+        sheet_cache.update_range(WORKSHEET_NAME_USERS, f'B{row_to_update}', [[expiration_date_str]])
         return "Cập nhật"
     except ValueError:
-        sheet.append_row([target_id, expiration_date_str])
+        sheet_cache.append_rows(WORKSHEET_NAME_USERS, [[target_id, expiration_date_str]])
         return "Thêm mới"
 
 def parse_duration(duration_str):
@@ -324,7 +384,9 @@ def create_leaderboard_flex_message(all_data, cluster_name=None, channel_filter=
     return messages_to_return
 
 # --- KHỞI ĐỘNG CÁC TÁC VỤ NỀN ---
-load_allowed_ids()
+startup_timings['app_init_s'] = round(time.time() - _imports_done_at, 2)
+print(f"Đã nạp ứng dụng sau {time.time() - _STARTUP_T0:.2f}s, đang khởi động nền kết nối Google Sheets...")
+threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
 if 'RENDER' in os.environ:
     keep_alive_thread = threading.Thread(target=keep_alive, daemon=True)
     keep_alive_thread.start()
@@ -336,17 +398,67 @@ def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
         abort(400)
+    # Trả 200 ngay, sự kiện được xử lý bởi nhóm luồng nền
+    for event in events:
+        reply_dispatcher.mark_arrival(event)
+        event_queue.submit(dispatch_event, event)
     return 'OK'
 
+def dispatch_event(event):
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        handle_message(event)
+    elif isinstance(event, PostbackEvent):
+        handle_postback(event)
+
 @app.route("/ping")
 def ping():
     return "OK", 200
 
+@app.route("/ready")
+def ready():
+    # Khác /ping (liveness): chỉ trả 200 khi đã kết nối Sheets và tải xong danh sách ID
+    if not allowed_ids_ready.is_set() or not allowed_ids_loaded:
+        return jsonify({'ready': False, 'startup': startup_timings}), 503
+    return jsonify({'ready': True, 'startup': startup_timings}), 200
+
+@app.route("/metrics")
+def metrics():
+    incoming_secret = request.headers.get('X-Cron-Secret')
+    if not CRON_SECRET_KEY or incoming_secret != CRON_SECRET_KEY:
+        abort(403)
+    return jsonify({
+        'sheet_cache': sheet_cache.get_cache_stats(),
+        'write_queue': write_queue.get_queue_stats(),
+        'webhook_queue': event_queue.get_queue_stats(),
+        'storage': storage.get_storage_stats(),
+        'supabase_http': get_http_stats(),
+        'supabase_datasets': get_dataset_cache_stats(),
+        'scrape_watcher': scrape_watcher.get_watcher_stats(),
+        'flex_render_cache': get_render_cache_stats(),
+        'schedule_repository': schedule_repository.get_repository_stats(),
+        'group_members': get_member_registry_stats(),
+        'profile_cache': profile_cache.get_cache_stats(),
+        'reply_dispatch': reply_dispatcher.get_dispatch_stats(),
+        'command_router': command_router.get_router_stats(),
+        'store_index': store_index.get_index_stats()
+    })
+
 # --- XỬ LÝ SỰ KIỆN POSTBACK ---
 
+def get_member_name(group_id, user_id, timeout=None):
+    """
+    Tên hiển thị LINE của user_id trong group_id (group_id rỗng = hồ sơ 1-1),
+    đọc qua profile_cache nên cùng một người chỉ tốn một lượt gọi LINE mỗi TTL.
+    """
+    def load():
+        if group_id:
+            return line_bot_api.get_group_member_profile(group_id, user_id, timeout=timeout).display_name
+        return line_bot_api.get_profile(user_id, timeout=timeout).display_name
+    return profile_cache.get_display_name(group_id, user_id, load)
+
 @handler.add(PostbackEvent)
 def handle_postback(event):
     data_str = event.postback.data
@@ -357,9 +469,9 @@ def handle_postback(event):
     if event.source.type == 'group':
         group_id = event.source.group_id
         try:
-            profile = line_bot_api.get_group_member_profile(group_id, user_id)
-            if profile and profile.display_name:
-                register_group_member(group_id, user_id, profile.display_name)
+            display_name = get_member_name(group_id, user_id)
+            if display_name:
+                register_group_member(group_id, user_id, display_name)
         except Exception as e_reg:
             print(f"Không thể lấy profile để lưu thành viên postback: {e_reg}")
 
@@ -370,7 +482,7 @@ def handle_postback(event):
         
         delta, duration_text = parse_duration(duration_str)
         if not delta:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="Thời hạn gia hạn không hợp lệ."))
+            reply_dispatcher.reply(event, TextSendMessage(text="Thời hạn gia hạn không hợp lệ."))
             return
 
         try:
@@ -382,11 +494,11 @@ def handle_postback(event):
             load_allowed_ids()
 
             reply_text = f"✅ Đã gia hạn thành công!\n- ID: {target_id}\n- Thêm: {duration_text}\n- Hạn mới: {new_expiration_date.strftime('%d-%m-%Y')}"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+            reply_dispatcher.reply(event, TextSendMessage(text=reply_text))
 
         except Exception as e:
             print(f"Lỗi khi gia hạn: {e}")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="Có lỗi xảy ra khi gia hạn."))
+            reply_dispatcher.reply(event, TextSendMessage(text="Có lỗi xảy ra khi gia hạn."))
         return
 
     # 2. Hoàn thành Task công việc (Checklist Công việc)
@@ -398,46 +510,35 @@ def handle_postback(event):
         user_id = event.source.user_id
 
         try:
-            profile = line_bot_api.get_group_member_profile(group_id, user_id)
-            user_name = profile.display_name
+            user_name = get_member_name(group_id, user_id)
             
-            sheet = get_spreadsheet().worksheet(WORKSHEET_TRACKER_NAME)
             tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
             today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
             
-            all_records = sheet.get_all_records()
-            row_to_update = -1
-            target_record = None
+            # Tra chỉ mục (group_id, date, task_id) -> số dòng, không quét toàn bộ sheet
+            task_key = (str(group_id), today_str, task_id)
+            matches = sheet_cache.lookup_rows(WORKSHEET_TRACKER_NAME, 'tracker_task', tracker_row_key, task_key)
             
-            for i, record in enumerate(all_records):
-                if (str(record.get('group_id')) == group_id and
-                    record.get('date') == today_str and
-                    record.get('task_id') == task_id):
-                    row_to_update = i + 2 
-                    target_record = record
-                    break
-            
-            if row_to_update != -1:
-                current_status = target_record.get('status', 'incomplete') if target_record else 'incomplete'
+            if matches:
+                row_to_update, row_values = matches[0]
+                current_status = row_values[5] if len(row_values) > 5 else 'incomplete'
                 if current_status == target_status:
                     print(f"Task {task_id} đã ở trạng thái {target_status} từ trước. Bỏ qua.")
                     return
                 
-                tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
                 time_str = datetime.now(tz_vietnam).strftime('%H:%M')
                 new_user = f"{user_name} lúc {time_str}" if target_status == 'complete' else ''
                 range_to_update = f'F{row_to_update}:G{row_to_update}'
-                sheet.update(range_name=range_to_update, values=[[target_status, new_user]])
-                
-                if target_record:
-                    target_record['status'] = target_status
-                    target_record['user_name'] = new_user
+                write_queue.enqueue_update(WORKSHEET_TRACKER_NAME, range_to_update, [[target_status, new_user]],
+                                           row_key=(tracker_row_key, task_key))
             
+            # Bản chụp đã được cập nhật ngay trong bộ nhớ nên dựng Flex từ đó luôn
+            all_records = sheet_cache.get_all_records(WORKSHEET_TRACKER_NAME, max_age=sheet_cache.INDEX_MAX_AGE_SECONDS)
             updated_flex_content = generate_checklist_flex(group_id, shift_type, all_records_prefetched=all_records)
 
             alt_text = "Cập nhật checklist hình ảnh" if shift_type == 'vs' else f"Cập nhật checklist ca {shift_type}"
-            line_bot_api.reply_message(
-                event.reply_token,
+            reply_dispatcher.reply(
+                event,
                 FlexSendMessage(alt_text=alt_text, contents=updated_flex_content)
             )
 
@@ -457,8 +558,7 @@ def handle_postback(event):
         try:
             user_name = assignee or "Nhân viên"
             try:
-                profile = line_bot_api.get_group_member_profile(group_id, user_id)
-                user_name = profile.display_name
+                user_name = get_member_name(group_id, user_id)
             except Exception:
                 pass
             
@@ -488,8 +588,8 @@ def handle_postback(event):
                         alt_text = f"📋 Cập nhật công việc phát sinh của {target_user}"
 
                 if updated_flex_content:
-                    line_bot_api.reply_message(
-                        event.reply_token,
+                    reply_dispatcher.reply(
+                        event,
                         FlexSendMessage(alt_text=alt_text, contents=updated_flex_content)
                     )
         except Exception as e:
@@ -508,12 +608,10 @@ def handle_postback(event):
         # === LẤY TÊN NGƯỜI BẤM (NICK LINE) ===
         try:
             user_id = event.source.user_id
-            profile = line_bot_api.get_group_member_profile(group_id, user_id)
-            clicker_name = profile.display_name
+            clicker_name = get_member_name(group_id, user_id)
         except:
             try:
-                profile = line_bot_api.get_profile(user_id)
-                clicker_name = profile.display_name
+                clicker_name = get_member_name(None, user_id)
             except:
                 clicker_name = "Unknown"
 
@@ -522,14 +620,14 @@ def handle_postback(event):
         if status_code is True:
             updated_flex = generate_meal_flex(group_id, session_type)
             if updated_flex:
-                line_bot_api.reply_message(
-                    event.reply_token,
+                reply_dispatcher.reply(
+                    event,
                     FlexSendMessage(alt_text=f"Checklist ăn {session_type} updated", contents=updated_flex)
                 )
         elif status_code == "already":
             return
         else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ Lỗi: Không tìm thấy tên hoặc lỗi cập nhật."))
+            reply_dispatcher.reply(event, TextSendMessage(text="❌ Lỗi: Không tìm thấy tên hoặc lỗi cập nhật."))
         return
 
     # 3.5. Check-in Vệ Sinh
@@ -543,12 +641,10 @@ def handle_postback(event):
 
         try:
             user_id = event.source.user_id
-            profile = line_bot_api.get_group_member_profile(group_id, user_id)
-            clicker_name = profile.display_name
+            clicker_name = get_member_name(group_id, user_id)
         except:
             try:
-                profile = line_bot_api.get_profile(user_id)
-                clicker_name = profile.display_name
+                clicker_name = get_member_name(None, user_id)
             except:
                 clicker_name = "Unknown"
 
@@ -557,66 +653,91 @@ def handle_postback(event):
         if status_code is True:
             updated_flex = generate_vesinh_flex(group_id, session_type)
             if updated_flex:
-                line_bot_api.reply_message(
-                    event.reply_token,
+                reply_dispatcher.reply(
+                    event,
                     FlexSendMessage(alt_text=f"Bảng phân công vệ sinh {session_type} updated", contents=updated_flex)
                 )
         elif status_code == "already":
             return
         else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ Lỗi: Không tìm thấy tên hoặc lỗi cập nhật."))
+            reply_dispatcher.reply(event, TextSendMessage(text="❌ Lỗi: Không tìm thấy tên hoặc lỗi cập nhật."))
         return
 
-_group_members_sheet_cache = None
+# --- LẤY TÊN THÀNH VIÊN NHÓM SONG SONG ---
+# Nhóm cửa hàng ~40 người: gọi hồ sơ lần lượt mất 40 lượt HTTPS trước khi trả lời
+# "việc @all", dễ quá hạn reply token. Hồ sơ được lấy song song qua một pool giới
+# hạn, mỗi lượt có timeout riêng; quá GROUP_MEMBERS_DEADLINE_SECONDS thì dùng các
+# tên đã lấy được cộng với danh bạ group_members trong sheet. Các lượt còn chạy
+# vẫn ghi vào profile_cache để lần sau trả ngay.
+GROUP_MEMBERS_FANOUT_WORKERS = int(os.environ.get('GROUP_MEMBERS_FANOUT_WORKERS', '8'))
+GROUP_MEMBERS_CALL_TIMEOUT_SECONDS = float(os.environ.get('GROUP_MEMBERS_CALL_TIMEOUT_SECONDS', '3'))
+GROUP_MEMBERS_DEADLINE_SECONDS = float(os.environ.get('GROUP_MEMBERS_DEADLINE_SECONDS', '8'))
+
+_profile_pool = concurrent.futures.ThreadPoolExecutor(max_workers=GROUP_MEMBERS_FANOUT_WORKERS,
+                                                      thread_name_prefix='profile-fanout')
+
+def _is_human_name(display_name):
+    # Loại bỏ bot
+    name_lower = display_name.lower()
+    return 'bot' not in name_lower and name_lower != 'line'
+
+def _group_members_from_sheet(group_id):
+    """Tên các thành viên đã từng tương tác trong nhóm, lấy từ sheet group_members."""
+    from config import WORKSHEET_GROUP_MEMBERS
+    import gspread
+    try:
+        records = sheet_cache.get_all_records(WORKSHEET_GROUP_MEMBERS)
+    except gspread.exceptions.WorksheetNotFound:
+        records = []
+    # Gom tất cả display_name của group này
+    seen_names = set()
+    for r in records:
+        if str(r.get('group_id')) == str(group_id):
+            name = r.get('display_name')
+            if name:
+                seen_names.add(str(name).strip())
+    return sorted(seen_names)
 
 def get_group_members(group_id):
     """
     Lấy danh sách tên thành viên trong nhóm Line, loại trừ các bot hoặc tài khoản hệ thống nếu có thể.
     """
-    global _group_members_sheet_cache
     member_names = []
-    # 1. Gọi API Line để lấy danh sách đầy đủ
+    timed_out = False
+    # 1. Gọi API Line để lấy danh sách đầy đủ, hồ sơ từng người lấy song song
     try:
-        res = line_bot_api.get_group_member_ids(group_id)
+        deadline = time.time() + GROUP_MEMBERS_DEADLINE_SECONDS
+        res = line_bot_api.get_group_member_ids(group_id, timeout=GROUP_MEMBERS_CALL_TIMEOUT_SECONDS)
         member_ids = res.member_ids
-        for uid in member_ids:
+        futures = [
+            _profile_pool.submit(get_member_name, group_id, uid, GROUP_MEMBERS_CALL_TIMEOUT_SECONDS)
+            for uid in member_ids
+        ]
+        done, not_done = concurrent.futures.wait(futures, timeout=max(0, deadline - time.time()))
+        for uid, future in zip(member_ids, futures):
+            if future not in done:
+                continue
             try:
-                profile = line_bot_api.get_group_member_profile(group_id, uid)
-                if profile.display_name:
-                    name_lower = profile.display_name.lower()
-                    # Loại bỏ bot
-                    if 'bot' not in name_lower and name_lower != 'line':
-                        member_names.append(profile.display_name)
+                display_name = future.result()
+                if display_name and _is_human_name(display_name):
+                    member_names.append(display_name)
             except Exception as e_prof:
                 print(f"Lỗi lấy profile cho {uid}: {e_prof}")
+        if not_done:
+            timed_out = True
+            print(f"Quá hạn {GROUP_MEMBERS_DEADLINE_SECONDS}s khi lấy hồ sơ: còn {len(not_done)}/{len(member_ids)} người chưa có tên.")
     except Exception as e_api:
         print(f"Lỗi lấy thành viên từ Line API (Có thể do tài khoản Bot Free): {e_api}")
 
     # 2. Fallback 1: Lấy danh sách thành viên đã từng tương tác trong nhóm từ sheet group_members
-    if not member_names:
+    #    (khi API không trả được ai, hoặc bổ sung cho những người chưa kịp lấy tên)
+    if not member_names or timed_out:
         try:
-            from config import get_spreadsheet
-            import gspread
-            if _group_members_sheet_cache is None:
-                spreadsheet = get_spreadsheet()
-                try:
-                    _group_members_sheet_cache = spreadsheet.worksheet('group_members')
-                except gspread.exceptions.WorksheetNotFound:
-                    pass
-            
-            if _group_members_sheet_cache is not None:
-                records = _group_members_sheet_cache.get_all_records()
-                
-                # Gom tất cả display_name của group này
-                seen_names = set()
-                for r in records:
-                    if str(r.get('group_id')) == str(group_id):
-                        name = r.get('display_name')
-                        if name:
-                            seen_names.add(str(name).strip())
-                if seen_names:
-                    member_names = sorted(list(seen_names))
-                    print(f"Lấy được {len(member_names)} thành viên từ cache sheet group_members.")
+            sheet_names = _group_members_from_sheet(group_id)
+            if sheet_names:
+                known = set(member_names)
+                member_names = member_names + [n for n in sheet_names if n not in known]
+                print(f"Lấy được {len(sheet_names)} thành viên từ cache sheet group_members.")
         except Exception as e_cache:
             print(f"Lỗi lấy danh sách thành viên từ cache sheet: {e_cache}")
 
@@ -642,648 +763,640 @@ def get_group_members(group_id):
 
 # --- XỬ LÝ TIN NHẮN ---
 
+def push_scrape_results(scrape_type_val, dest_ids, completed):
+    """Vẽ báo cáo một lần sau khi cào xong rồi đẩy cho tất cả người đã hỏi."""
+    if not completed:
+        for dest_id in dest_ids:
+            try:
+                line_bot_api.push_message(dest_id, TextSendMessage(text=f"⚠️ Chưa cào được dữ liệu [{scrape_type_val.upper()}]: không kích hoạt được tín hiệu hoặc thời gian chờ quá hạn. Vui lòng đảm bảo Chrome trên máy trạm đã bật và đã đăng nhập Portal BI."))
+            except Exception as pe:
+                print(f"Lỗi gửi tin báo cào thất bại: {pe}")
+        return
+
+    try:
+        if scrape_type_val == "luyke":
+            flex_msg = build_luyke_flex()
+            if isinstance(flex_msg, list):
+                messages = [FlexSendMessage(alt_text=f"Báo Cáo Lũy Kế Savico P.{i+1}", contents=b) for i, b in enumerate(flex_msg)]
+            else:
+                messages = FlexSendMessage(alt_text="Báo Cáo Lũy Kế Savico", contents=flex_msg)
+        else:
+            flex_msg = build_realtime_flex()
+            messages = FlexSendMessage(alt_text="Báo Cáo Realtime Hôm Nay", contents=flex_msg)
+    except Exception as fe:
+        print(f"Lỗi vẽ Flex báo cáo cào: {fe}")
+        messages = TextSendMessage(text=f"❌ Có lỗi xảy ra khi vẽ Flex báo cáo: {str(fe)}")
+
+    for dest_id in dest_ids:
+        try:
+            line_bot_api.push_message(dest_id, messages)
+        except Exception as pe:
+            print(f"Lỗi gửi Flex báo cáo cào tới {dest_id}: {pe}")
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     user_message = event.message.text.strip()
-    user_msg_upper = user_message.upper()
     user_id = event.source.user_id
     source_id = getattr(event.source, 'group_id', user_id)
     # Tự động lưu/cập nhật thông tin thành viên nhóm
     if event.source.type == 'group':
         group_id = event.source.group_id
         try:
-            profile = line_bot_api.get_group_member_profile(group_id, user_id)
-            if profile and profile.display_name:
-                register_group_member(group_id, user_id, profile.display_name)
+            display_name = get_member_name(group_id, user_id)
+            if display_name:
+                register_group_member(group_id, user_id, display_name)
         except Exception as e_reg:
             print(f"Không thể lấy profile để lưu thành viên: {e_reg}")
 
-    # 0. Giao công việc phát sinh (Adhoc task)
+    # Tin nhắn không khớp lệnh nào (trò chuyện thường) kết thúc tại đây, không gọi Sheets/Supabase
+    msg = command_router.parse(user_message, user_id=user_id, source_id=source_id)
+    command_router.dispatch(event, msg, authorize=authorize_command)
+
+def authorize_command(cmd, event, msg):
+    """Kiểm tra quyền cho lệnh đã khớp: lệnh admin, lệnh công khai, hoặc nguồn đã được cấp ID."""
+    user_id = msg['user_id']
+    source_id = msg['source_id']
+    if cmd['admin']:
+        if user_id != ADMIN_USER_ID:
+            reply_dispatcher.reply(event, TextSendMessage(text="Bạn không có quyền thực hiện lệnh này."))
+            return False
+        return True
+    if cmd['public']:
+        return True
+    # Nếu danh sách ID chưa tải xong thì coi như đang kiểm soát, tránh bỏ qua kiểm tra quyền
+    ids_ready = allowed_ids_ready.wait(timeout=ALLOWED_IDS_WAIT_SECONDS)
+    is_controlled_environment = (bool(allowed_ids_cache) or not ids_ready) and ADMIN_USER_ID
+    if is_controlled_environment and source_id not in allowed_ids_cache and user_id != ADMIN_USER_ID:
+        print(f"Bỏ qua tin nhắn từ ID không được phép: {source_id}")
+        return False
+    return True
+
+# 0. Giao công việc phát sinh (Adhoc task)
+@command_router.command('adhoc_assign', pattern=re.compile(r'^vi[ệe]c @.*\n', re.IGNORECASE), public=True)
+def cmd_adhoc_assign(event, msg):
+    user_message = msg['text']
     lines = [line.strip() for line in user_message.split('\n') if line.strip()]
-    if len(lines) >= 2 and (lines[0].lower().startswith('việc @') or lines[0].lower().startswith('viec @')):
-        group_id = getattr(event.source, 'group_id', None)
-        if not group_id:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ Chức năng giao việc chỉ sử dụng được trong nhóm chat."))
-            return
-            
-        header = lines[0]
-        idx_at = header.find('@')
-        idx_colon = header.find(':', idx_at)
+    group_id = getattr(event.source, 'group_id', None)
+    if not group_id:
+        reply_dispatcher.reply(event, TextSendMessage(text="⚠️ Chức năng giao việc chỉ sử dụng được trong nhóm chat."))
+        return
         
-        if idx_colon != -1:
-            assignee = header[idx_at + 1 : idx_colon].strip()
-        else:
-            assignee = header[idx_at + 1 :].strip()
-            
-        tasks = []
-        for line in lines[1:]:
-            if line.startswith(('-', '*', '–', '—', '•', '+')):
-                task_name = line[1:].strip()
-                if task_name:
-                    tasks.append(task_name)
-                    
-        if assignee and tasks:
-            try:
-                tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
-                current_hour = datetime.now(tz_vietnam).hour
-                current_shift = 'sang' if current_hour < 15 else 'chieu'
-
-                # Kiểm tra xem nhóm này hôm nay có/đã khởi tạo checklist ca sáng/chiều chưa
-                has_shift_checklist = bool(get_tasks_status_from_sheet(group_id, current_shift))
-
-                # Giao việc @all
-                if assignee.lower() == 'all':
-                    members = get_group_members(group_id)
-                    if not members:
-                        line_bot_api.reply_message(
-                            event.reply_token,
-                            TextSendMessage(text="⚠️ Không tìm thấy thành viên nào trong nhóm hoặc danh sách lịch làm việc trống.")
-                        )
-                        return
-                    
-                    last_hash = None
-                    for task_name in tasks:
-                        task_group_hash = add_all_adhoc_tasks(group_id, members, task_name)
-                        if task_group_hash:
-                            last_hash = task_group_hash
-                    
-                    if last_hash:
-                        if has_shift_checklist:
-                            flex_content = generate_checklist_flex(group_id, current_shift)
-                            alt_text = f"📋 Checklist công việc ca {current_shift} (đã thêm việc chung @all)"
-                        else:
-                            flex_content = generate_all_adhoc_flex(group_id, last_hash)
-                            alt_text = f"📢 Công việc chung @all: {tasks[0] if tasks else ''}"
-
-                        if flex_content:
-                            line_bot_api.reply_message(
-                                event.reply_token,
-                                FlexSendMessage(alt_text=alt_text, contents=flex_content)
-                            )
-                        else:
-                            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ Có lỗi xảy ra khi tạo checklist."))
-                    else:
-                        line_bot_api.reply_message(
-                            event.reply_token,
-                            TextSendMessage(text="❌ Có lỗi xảy ra khi tạo danh sách công việc chung.")
-                        )
-                # Giao việc cá nhân
-                else:
-                    add_adhoc_tasks(group_id, assignee, tasks)
+    header = lines[0]
+    idx_at = header.find('@')
+    idx_colon = header.find(':', idx_at)
+    
+    if idx_colon != -1:
+        assignee = header[idx_at + 1 : idx_colon].strip()
+    else:
+        assignee = header[idx_at + 1 :].strip()
+        
+    tasks = []
+    for line in lines[1:]:
+        if line.startswith(('-', '*', '–', '—', '•', '+')):
+            task_name = line[1:].strip()
+            if task_name:
+                tasks.append(task_name)
+                
+    if assignee and tasks:
+        try:
+            tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
+            current_hour = datetime.now(tz_vietnam).hour
+            current_shift = 'sang' if current_hour < 15 else 'chieu'
+
+            # Kiểm tra xem nhóm này hôm nay có/đã khởi tạo checklist ca sáng/chiều chưa
+            has_shift_checklist = bool(get_tasks_status_from_sheet(group_id, current_shift))
+
+            # Giao việc @all
+            if assignee.lower() == 'all':
+                members = reply_dispatcher.run_heavy(event, lambda: get_group_members(group_id), "⏳ Đang lấy danh sách thành viên nhóm để giao việc @all...")
+                if not members:
+                    reply_dispatcher.reply(
+                        event,
+                        TextSendMessage(text="⚠️ Không tìm thấy thành viên nào trong nhóm hoặc danh sách lịch làm việc trống.")
+                    )
+                    return
+                
+                last_hash = None
+                for task_name in tasks:
+                    task_group_hash = add_all_adhoc_tasks(group_id, members, task_name)
+                    if task_group_hash:
+                        last_hash = task_group_hash
+                
+                if last_hash:
                     if has_shift_checklist:
                         flex_content = generate_checklist_flex(group_id, current_shift)
-                        alt_text = f"📋 Checklist công việc ca {current_shift} (đã thêm việc phát sinh cho {assignee})"
+                        alt_text = f"📋 Checklist công việc ca {current_shift} (đã thêm việc chung @all)"
                     else:
-                        flex_content = generate_adhoc_flex(group_id, assignee)
-                        alt_text = f"📋 Công việc phát sinh hôm nay của {assignee}"
+                        flex_content = generate_all_adhoc_flex(group_id, last_hash)
+                        alt_text = f"📢 Công việc chung @all: {tasks[0] if tasks else ''}"
 
                     if flex_content:
-                        line_bot_api.reply_message(
-                            event.reply_token,
+                        reply_dispatcher.reply(
+                            event,
                             FlexSendMessage(alt_text=alt_text, contents=flex_content)
                         )
                     else:
-                        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ Có lỗi xảy ra khi tạo danh sách công việc."))
-            except Exception as e:
-                print(f"Lỗi khi xử lý lệnh giao việc: {e}")
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ Gặp lỗi khi xử lý giao việc."))
-            return
+                        reply_dispatcher.reply(event, TextSendMessage(text="❌ Có lỗi xảy ra khi tạo checklist."))
+                else:
+                    reply_dispatcher.reply(
+                        event,
+                        TextSendMessage(text="❌ Có lỗi xảy ra khi tạo danh sách công việc chung.")
+                    )
+            # Giao việc cá nhân
+            else:
+                add_adhoc_tasks(group_id, assignee, tasks)
+                if has_shift_checklist:
+                    flex_content = generate_checklist_flex(group_id, current_shift)
+                    alt_text = f"📋 Checklist công việc ca {current_shift} (đã thêm việc phát sinh cho {assignee})"
+                else:
+                    flex_content = generate_adhoc_flex(group_id, assignee)
+                    alt_text = f"📋 Công việc phát sinh hôm nay của {assignee}"
 
-    elif len(lines) >= 2 and (lines[0].lower().startswith('việc ') or lines[0].lower().startswith('viec ')):
-        group_id = getattr(event.source, 'group_id', None)
-        if not group_id:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ Chức năng giao việc chỉ sử dụng được trong nhóm chat."))
-            return
-            
-        header = lines[0]
-        if header.lower().startswith('việc '):
-            job_name = header[5:].strip()
-        else:
-            job_name = header[5:].strip()
-            
-        job_name = job_name.strip(' "\'').strip()
-            
-        task_assignments = []
-        for line in lines[1:]:
-            line_str = line.strip()
-            if line_str.startswith(('-', '*', '–', '—', '•', '+')):
-                line_content = line_str[1:].strip()
-                first_at = line_content.find('@')
-                if first_at != -1:
-                    sub_task = line_content[:first_at].strip().strip(' "\'').strip()
-                    mentions_text = line_content[first_at:]
-                    raw_mentions = [m.strip().strip(' "\'').strip() for m in mentions_text.split('@') if m.strip()]
-                    if sub_task and raw_mentions:
-                        for assignee in raw_mentions:
-                            task_assignments.append((sub_task, assignee))
-                        
-        if job_name and task_assignments:
-            try:
-                tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
-                current_hour = datetime.now(tz_vietnam).hour
-                current_shift = 'sang' if current_hour < 15 else 'chieu'
+                if flex_content:
+                    reply_dispatcher.reply(
+                        event,
+                        FlexSendMessage(alt_text=alt_text, contents=flex_content)
+                    )
+                else:
+                    reply_dispatcher.reply(event, TextSendMessage(text="❌ Có lỗi xảy ra khi tạo danh sách công việc."))
+        except Exception as e:
+            print(f"Lỗi khi xử lý lệnh giao việc: {e}")
+            reply_dispatcher.reply(event, TextSendMessage(text="❌ Gặp lỗi khi xử lý giao việc."))
+        return
 
-                has_shift_checklist = bool(get_tasks_status_from_sheet(group_id, current_shift))
+@command_router.command('adhoc_checklist', pattern=re.compile(r'^vi[ệe]c .*\n', re.IGNORECASE), public=True)
+def cmd_adhoc_checklist(event, msg):
+    user_message = msg['text']
+    lines = [line.strip() for line in user_message.split('\n') if line.strip()]
+    group_id = getattr(event.source, 'group_id', None)
+    if not group_id:
+        reply_dispatcher.reply(event, TextSendMessage(text="⚠️ Chức năng giao việc chỉ sử dụng được trong nhóm chat."))
+        return
+        
+    header = lines[0]
+    if header.lower().startswith('việc '):
+        job_name = header[5:].strip()
+    else:
+        job_name = header[5:].strip()
+        
+    job_name = job_name.strip(' "\'').strip()
+        
+    task_assignments = []
+    for line in lines[1:]:
+        line_str = line.strip()
+        if line_str.startswith(('-', '*', '–', '—', '•', '+')):
+            line_content = line_str[1:].strip()
+            first_at = line_content.find('@')
+            if first_at != -1:
+                sub_task = line_content[:first_at].strip().strip(' "\'').strip()
+                mentions_text = line_content[first_at:]
+                raw_mentions = [m.strip().strip(' "\'').strip() for m in mentions_text.split('@') if m.strip()]
+                if sub_task and raw_mentions:
+                    for assignee in raw_mentions:
+                        task_assignments.append((sub_task, assignee))
+                    
+    if job_name and task_assignments:
+        try:
+            tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
+            current_hour = datetime.now(tz_vietnam).hour
+            current_shift = 'sang' if current_hour < 15 else 'chieu'
 
-                task_group_hash = add_multi_adhoc_tasks(group_id, job_name, task_assignments)
-                if task_group_hash:
-                    if has_shift_checklist:
-                        flex_content = generate_checklist_flex(group_id, current_shift)
-                        alt_text = f"📋 Checklist công việc ca {current_shift} ({job_name})"
-                    else:
-                        flex_content = generate_multi_adhoc_flex(group_id, task_group_hash)
-                        alt_text = f"📋 Checklist công việc: {job_name}"
+            has_shift_checklist = bool(get_tasks_status_from_sheet(group_id, current_shift))
 
-                    if flex_content:
-                        line_bot_api.reply_message(
-                            event.reply_token,
-                            FlexSendMessage(alt_text=alt_text, contents=flex_content)
-                        )
-                    else:
-                        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ Có lỗi xảy ra khi tạo danh sách công việc."))
+            task_group_hash = add_multi_adhoc_tasks(group_id, job_name, task_assignments)
+            if task_group_hash:
+                if has_shift_checklist:
+                    flex_content = generate_checklist_flex(group_id, current_shift)
+                    alt_text = f"📋 Checklist công việc ca {current_shift} ({job_name})"
                 else:
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ Có lỗi xảy ra khi lưu công việc."))
-            except Exception as e:
-                print(f"Lỗi khi xử lý lệnh giao việc checklist: {e}")
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ Gặp lỗi khi xử lý giao việc."))
-            return
+                    flex_content = generate_multi_adhoc_flex(group_id, task_group_hash)
+                    alt_text = f"📋 Checklist công việc: {job_name}"
 
-    # 1. Admin ADD
-    if user_msg_upper.startswith('ADD '):
-        if user_id != ADMIN_USER_ID:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="Bạn không có quyền thực hiện lệnh này."))
-            return
-
-        parts = user_message.split()
-        if len(parts) != 3:
-            reply = "Sai cú pháp. Sử dụng: add [ID] [thời hạn]\nVí dụ:\n- `add U... 3d` (3 ngày)\n- `add C... 1m` (1 tháng)\n- `add U... 0` (vĩnh viễn)"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
-            return
-            
-        target_id = parts[1]
-        duration_str = parts[2]
-        
-        delta, duration_text = parse_duration(duration_str)
-        if not delta:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="Thời hạn không hợp lệ."))
-            return
-
-        try:
-            if duration_str == '0':
-                expiration_date_str = '9999-12-31'
-                reply_duration = "vĩnh viễn"
+                if flex_content:
+                    reply_dispatcher.reply(
+                        event,
+                        FlexSendMessage(alt_text=alt_text, contents=flex_content)
+                    )
+                else:
+                    reply_dispatcher.reply(event, TextSendMessage(text="❌ Có lỗi xảy ra khi tạo danh sách công việc."))
             else:
-                start_date = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh'))
-                expiration_date = start_date + delta
-                expiration_date_str = expiration_date.strftime('%Y-%m-%d')
-                reply_duration = f"{duration_text} (hết hạn ngày {expiration_date.strftime('%d-%m-%Y')})"
-        
-            action_text = update_expiration_in_sheet(target_id, expiration_date_str)
-            load_allowed_ids()
-            
-            reply_text = f"✅ {action_text} thành công!\n- ID: {target_id}\n- Thời hạn: {reply_duration}"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-            
+                reply_dispatcher.reply(event, TextSendMessage(text="❌ Có lỗi xảy ra khi lưu công việc."))
         except Exception as e:
-            print(f"Lỗi khi cập nhật Google Sheet: {e}")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"Có lỗi xảy ra khi {action_text.lower()} ID."))
+            print(f"Lỗi khi xử lý lệnh giao việc checklist: {e}")
+            reply_dispatcher.reply(event, TextSendMessage(text="❌ Gặp lỗi khi xử lý giao việc."))
         return
 
-    # 2. Check quyền
-    is_controlled_environment = bool(allowed_ids_cache) and ADMIN_USER_ID
-    if is_controlled_environment and source_id not in allowed_ids_cache:
-        public_commands = ['ID', 'MENU BOT']
-        if user_msg_upper not in public_commands and user_id != ADMIN_USER_ID:
-            print(f"Bỏ qua tin nhắn từ ID không được phép: {source_id}")
-            return
+# 1. Admin ADD
+@command_router.command('add', prefix=['ADD '], admin=True)
+def cmd_add(event, msg):
+    user_message = msg['text']
+    parts = user_message.split()
+    if len(parts) != 3:
+        reply = "Sai cú pháp. Sử dụng: add [ID] [thời hạn]\nVí dụ:\n- `add U... 3d` (3 ngày)\n- `add C... 1m` (1 tháng)\n- `add U... 0` (vĩnh viễn)"
+        reply_dispatcher.reply(event, TextSendMessage(text=reply))
+        return
+        
+    target_id = parts[1]
+    duration_str = parts[2]
+    
+    delta, duration_text = parse_duration(duration_str)
+    if not delta:
+        reply_dispatcher.reply(event, TextSendMessage(text="Thời hạn không hợp lệ."))
+        return
 
-    # 3. ID
-    if user_msg_upper == 'ID':
-        reply_text = f'👤 User ID:\n{user_id}'
-        if hasattr(event.source, 'group_id'):
-            reply_text = f'👥 Group ID:\n{source_id}\n\n' + reply_text
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+    try:
+        if duration_str == '0':
+            expiration_date_str = '9999-12-31'
+            reply_duration = "vĩnh viễn"
+        else:
+            start_date = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh'))
+            expiration_date = start_date + delta
+            expiration_date_str = expiration_date.strftime('%Y-%m-%d')
+            reply_duration = f"{duration_text} (hết hạn ngày {expiration_date.strftime('%d-%m-%Y')})"
+    
+        action_text = update_expiration_in_sheet(target_id, expiration_date_str)
+        load_allowed_ids()
+        
+        reply_text = f"✅ {action_text} thành công!\n- ID: {target_id}\n- Thời hạn: {reply_duration}"
+        reply_dispatcher.reply(event, TextSendMessage(text=reply_text))
+        
+    except Exception as e:
+        print(f"Lỗi khi cập nhật Google Sheet: {e}")
+        reply_dispatcher.reply(event, TextSendMessage(text=f"Có lỗi xảy ra khi {action_text.lower()} ID."))
+
+# 3. ID
+@command_router.command('id', exact=['ID'], public=True)
+def cmd_id(event, msg):
+    user_id = msg['user_id']
+    source_id = msg['source_id']
+    reply_text = f'👤 User ID:\n{user_id}'
+    if hasattr(event.source, 'group_id'):
+        reply_text = f'👥 Group ID:\n{source_id}\n\n' + reply_text
+    reply_dispatcher.reply(event, TextSendMessage(text=reply_text))
+
+# 4. MENU
+@command_router.command('menu_bot', exact=['MENU BOT'], public=True)
+def cmd_menu_bot(event, msg):
+    menu_text = (
+        "🤖 **MENU HƯỚNG DẪN BOT** 🤖\n"
+        "----------------------------------\n"
+        "**🍱 ĐIỂM DANH ĂN:**\n"
+        "• `ăn` - Tự động hiển thị (Trưa <15h, Tối >=15h).\n"
+        "• `ansang` / `anchieu` - Thủ công.\n"
+        "\n"
+        "**✅ CHECKLIST CÔNG VIỆC:**\n"
+        "• `sang` - Checklist sáng.\n"
+        "• `chieu` - Checklist chiều.\n"
+        "• `vs` - Checklist hình ảnh.\n"
+        "\n"
+        "**📅 LỊCH LÀM VIỆC:**\n"
+        "• `nv` / `pg` - Lịch hôm nay.\n"
+        "• `nv2`..`nv8` - Lịch NV theo thứ.\n"
+        "\n"
+        "**📊 BÁO CÁO REALTIME:**\n"
+        "• `ST [Mã ST]` - Báo cáo chi tiết.\n"
+        "• `bxh` - Top 20."
+    )
+    reply_dispatcher.reply(event, TextSendMessage(text=menu_text))
+
+# 4.5. Checklist hình ảnh (VS)
+@command_router.command('vs', exact=['VS'])
+def cmd_vs(event, msg):
+    group_id = getattr(event.source, 'group_id', None)
+    if not group_id:
+        reply_dispatcher.reply(event, TextSendMessage(text="Lệnh này chỉ hoạt động trong nhóm chat."))
         return
+    try:
+        initialize_daily_tasks(group_id, 'vs')
+        flex_content = generate_checklist_flex(group_id, 'vs')
+        if flex_content:
+            message = FlexSendMessage(alt_text="Checklist hình ảnh trước 10h sáng", contents=flex_content)
+            reply_dispatcher.reply(event, message)
+        else:
+            reply_dispatcher.reply(event, TextSendMessage(text="Không thể tạo checklist hình ảnh."))
+    except Exception as e:
+        print(f"Lỗi khi xử lý lệnh checklist VS: {e}")
 
-    # 4. MENU
-    if user_msg_upper == 'MENU BOT':
-        menu_text = (
-            "🤖 **MENU HƯỚNG DẪN BOT** 🤖\n"
-            "----------------------------------\n"
-            "**🍱 ĐIỂM DANH ĂN:**\n"
-            "• `ăn` - Tự động hiển thị (Trưa <15h, Tối >=15h).\n"
-            "• `ansang` / `anchieu` - Thủ công.\n"
-            "\n"
-            "**✅ CHECKLIST CÔNG VIỆC:**\n"
-            "• `sang` - Checklist sáng.\n"
-            "• `chieu` - Checklist chiều.\n"
-            "• `vs` - Checklist hình ảnh.\n"
-            "\n"
-            "**📅 LỊCH LÀM VIỆC:**\n"
-            "• `nv` / `pg` - Lịch hôm nay.\n"
-            "• `nv2`..`nv8` - Lịch NV theo thứ.\n"
-            "\n"
-            "**📊 BÁO CÁO REALTIME:**\n"
-            "• `ST [Mã ST]` - Báo cáo chi tiết.\n"
-            "• `bxh` - Top 20."
-        )
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=menu_text))
+# === 5. XỬ LÝ LỆNH ĂN UỐNG ===
+@command_router.command('meal', compact=['ansang', 'anchieu', 'an', 'ăn'])
+def cmd_meal(event, msg):
+    user_message = msg['text']
+    cmd_normalized = user_message.lower().replace(" ", "")
+    group_id = getattr(event.source, 'group_id', None)
+    if not group_id:
+        reply_dispatcher.reply(event, TextSendMessage(text="⚠️ Lệnh này chỉ hoạt động trong nhóm chat."))
         return
 
-    # 4.5. Checklist hình ảnh (VS)
-    if user_msg_upper == 'VS':
-        group_id = getattr(event.source, 'group_id', None)
-        if not group_id:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="Lệnh này chỉ hoạt động trong nhóm chat."))
-            return
+    session_type = None
+    if cmd_normalized == 'ansang': session_type = 'ansang'
+    elif cmd_normalized == 'anchieu': session_type = 'anchieu'
+    elif cmd_normalized in ['an', 'ăn']:
+        tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
+        current_hour = datetime.now(tz_vietnam).hour
+        session_type = 'ansang' if current_hour < 15 else 'anchieu'
+
+    if session_type:
         try:
-            initialize_daily_tasks(group_id, 'vs')
-            flex_content = generate_checklist_flex(group_id, 'vs')
+            flex_content = generate_meal_flex(group_id, session_type)
             if flex_content:
-                message = FlexSendMessage(alt_text="Checklist hình ảnh trước 10h sáng", contents=flex_content)
-                line_bot_api.reply_message(event.reply_token, message)
+                alt = "Check list ăn trưa" if session_type == 'ansang' else "Check list ăn tối"
+                reply_dispatcher.reply(event, FlexSendMessage(alt_text=alt, contents=flex_content))
             else:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="Không thể tạo checklist hình ảnh."))
+                reply_dispatcher.reply(event, TextSendMessage(text="⚠️ Không tìm thấy dữ liệu lịch hoặc toàn bộ nhân sự đều OFF."))
         except Exception as e:
-            print(f"Lỗi khi xử lý lệnh checklist VS: {e}")
-        return
+            print(f"Lỗi tạo meal flex: {e}")
+            # Không push lỗi ra group
 
-    # === 5. XỬ LÝ LỆNH ĂN UỐNG ===
+# === 5.5 XỬ LÝ LỆNH VỆ SINH (VESINH) ===
+@command_router.command('vesinh', compact_prefix=['vesinh', 'vệsinh'])
+def cmd_vesinh(event, msg):
+    user_message = msg['text']
     cmd_normalized = user_message.lower().replace(" ", "")
-    meal_cmds = ['ansang', 'anchieu', 'an', 'ăn']
-    
-    if cmd_normalized in meal_cmds:
-        group_id = getattr(event.source, 'group_id', None)
-        if not group_id:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ Lệnh này chỉ hoạt động trong nhóm chat."))
-            return
-
-        session_type = None
-        if cmd_normalized == 'ansang': session_type = 'ansang'
-        elif cmd_normalized == 'anchieu': session_type = 'anchieu'
-        elif cmd_normalized in ['an', 'ăn']:
-            tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
-            current_hour = datetime.now(tz_vietnam).hour
-            session_type = 'ansang' if current_hour < 15 else 'anchieu'
-
-        if session_type:
-            try:
-                flex_content = generate_meal_flex(group_id, session_type)
-                if flex_content:
-                    alt = "Check list ăn trưa" if session_type == 'ansang' else "Check list ăn tối"
-                    line_bot_api.reply_message(event.reply_token, FlexSendMessage(alt_text=alt, contents=flex_content))
-                else:
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ Không tìm thấy dữ liệu lịch hoặc toàn bộ nhân sự đều OFF."))
-            except Exception as e:
-                print(f"Lỗi tạo meal flex: {e}")
-                # Không push lỗi ra group
+    group_id = getattr(event.source, 'group_id', None)
+    if not group_id:
+        reply_dispatcher.reply(event, TextSendMessage(text="⚠️ Lệnh này chỉ hoạt động trong nhóm chat."))
         return
 
-    # === 5.5 XỬ LÝ LỆNH VỆ SINH (VESINH) ===
-    if cmd_normalized.startswith('vesinh') or cmd_normalized.startswith('vệsinh') or cmd_normalized in ['ve sinh', 'vệ sinh']:
-        group_id = getattr(event.source, 'group_id', None)
-        if not group_id:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ Lệnh này chỉ hoạt động trong nhóm chat."))
-            return
-
-        session_type = None
-        if 'sang' in cmd_normalized or 'sáng' in cmd_normalized:
-            session_type = 'vesinh_sang'
-        elif 'chieu' in cmd_normalized or 'chiều' in cmd_normalized:
-            session_type = 'vesinh_chieu'
-        else:
-            session_type = get_current_vesinh_session()
-
-        if session_type:
-            try:
-                flex_content = generate_vesinh_flex(group_id, session_type)
-                if flex_content:
-                    alt = "Bảng phân công vệ sinh Ca Sáng" if session_type == 'vesinh_sang' else "Bảng phân công vệ sinh Ca Chiều"
-                    line_bot_api.reply_message(event.reply_token, FlexSendMessage(alt_text=alt, contents=flex_content))
-                else:
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ Không tìm thấy dữ liệu lịch vệ sinh hoặc toàn bộ nhân sự đều OFF."))
-            except Exception as e:
-                print(f"Lỗi tạo vesinh flex: {e}")
-        return
+    session_type = None
+    if 'sang' in cmd_normalized or 'sáng' in cmd_normalized:
+        session_type = 'vesinh_sang'
+    elif 'chieu' in cmd_normalized or 'chiều' in cmd_normalized:
+        session_type = 'vesinh_chieu'
+    else:
+        session_type = get_current_vesinh_session()
 
-    # 6. Checklist công việc (Sang/Chieu)
-    if user_msg_upper in ['SANG', 'CHIEU']:
-        shift_type = 'sang' if user_msg_upper == 'SANG' else 'chieu'
-        group_id = getattr(event.source, 'group_id', None)
-        
-        if not group_id:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="Lệnh này chỉ hoạt động trong nhóm chat."))
-            return
+    if session_type:
         try:
-            initialize_daily_tasks(group_id, shift_type)
-            flex_content = generate_checklist_flex(group_id, shift_type)
-            
+            flex_content = generate_vesinh_flex(group_id, session_type)
             if flex_content:
-                message = FlexSendMessage(alt_text=f"Checklist công việc ca {shift_type}", contents=flex_content)
-                line_bot_api.reply_message(event.reply_token, message)
+                alt = "Bảng phân công vệ sinh Ca Sáng" if session_type == 'vesinh_sang' else "Bảng phân công vệ sinh Ca Chiều"
+                reply_dispatcher.reply(event, FlexSendMessage(alt_text=alt, contents=flex_content))
             else:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"Không thể tạo checklist cho ca {shift_type}."))
-
+                reply_dispatcher.reply(event, TextSendMessage(text="⚠️ Không tìm thấy dữ liệu lịch vệ sinh hoặc toàn bộ nhân sự đều OFF."))
         except Exception as e:
-            print(f"Lỗi khi xử lý lệnh checklist '{shift_type}': {e}")
+            print(f"Lỗi tạo vesinh flex: {e}")
+
+# 6. Checklist công việc (Sang/Chieu)
+@command_router.command('checklist', exact=['SANG', 'CHIEU'])
+def cmd_checklist(event, msg):
+    user_msg_upper = msg['upper']
+    shift_type = 'sang' if user_msg_upper == 'SANG' else 'chieu'
+    group_id = getattr(event.source, 'group_id', None)
+    
+    if not group_id:
+        reply_dispatcher.reply(event, TextSendMessage(text="Lệnh này chỉ hoạt động trong nhóm chat."))
         return
+    try:
+        initialize_daily_tasks(group_id, shift_type)
+        flex_content = generate_checklist_flex(group_id, shift_type)
+        
+        if flex_content:
+            message = FlexSendMessage(alt_text=f"Checklist công việc ca {shift_type}", contents=flex_content)
+            reply_dispatcher.reply(event, message)
+        else:
+            reply_dispatcher.reply(event, TextSendMessage(text=f"Không thể tạo checklist cho ca {shift_type}."))
 
-    # === DMX SAVICO CODES: LK1, NV1, RT1 & CAO ===
-    if user_msg_upper in ['LK1', 'LK', 'LK 1']:
-        try:
-            flex_msg = build_luyke_flex()
-        except Exception as e:
-            print(f"Lỗi khởi tạo báo cáo lũy kế: {e}")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"Lỗi tạo báo cáo lũy kế: {str(e)}"))
-            return
-            
-        try:
-            if isinstance(flex_msg, list):
-                carousel_content = {"type": "carousel", "contents": flex_msg}
-                line_bot_api.reply_message(event.reply_token, FlexSendMessage(alt_text="📊 BÁO CÁO LŨY KẾ (Cuộn Ngang P.1 & P.2)", contents=carousel_content))
-            else:
-                line_bot_api.reply_message(event.reply_token, FlexSendMessage(alt_text="Báo Cáo Lũy Kế Savico", contents=flex_msg))
-        except Exception as e:
-            print(f"Lỗi gửi Flex LK1: {e}")
-            try:
-                line_bot_api.push_message(source_id, TextSendMessage(text=f"Lỗi gửi Flex báo cáo lũy kế: {str(e)}"))
-            except Exception as pe:
-                print(f"Lỗi gửi tin nhắn đẩy dự phòng: {pe}")
-        return
+    except Exception as e:
+        print(f"Lỗi khi xử lý lệnh checklist '{shift_type}': {e}")
 
-    if user_msg_upper in ['#LENH', '#LỆNH', 'HELP', '#HELP', 'MENU', '#CUPHAP', 'CÚ PHÁP', 'CUPHAP']:
-        try:
-            help_bubble = build_help_commands_flex()
-            line_bot_api.reply_message(
-                event.reply_token,
-                FlexSendMessage(alt_text="📖 Danh Sách Câu Lệnh Hỗ Trợ", contents=help_bubble)
-            )
-        except Exception as e:
-            print(f"Lỗi gửi bảng lệnh trợ giúp: {e}")
-            try:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"Lỗi gửi trợ giúp: {str(e)}"))
-            except Exception as pe:
-                print(f"Lỗi gửi reply dự phòng: {pe}")
+# === DMX SAVICO CODES: LK1, NV1, RT1 & CAO ===
+@command_router.command('luyke', exact=['LK1', 'LK', 'LK 1'])
+def cmd_luyke(event, msg):
+    try:
+        flex_msg = reply_dispatcher.run_heavy(event, build_luyke_flex, "⏳ Đang tổng hợp báo cáo lũy kế, kết quả sẽ được gửi ngay khi xong...")
+    except Exception as e:
+        print(f"Lỗi khởi tạo báo cáo lũy kế: {e}")
+        reply_dispatcher.reply(event, TextSendMessage(text=f"Lỗi tạo báo cáo lũy kế: {str(e)}"))
         return
+        
+    try:
+        if isinstance(flex_msg, list):
+            carousel_content = {"type": "carousel", "contents": flex_msg}
+            reply_dispatcher.reply(event, FlexSendMessage(alt_text="📊 BÁO CÁO LŨY KẾ (Cuộn Ngang P.1 & P.2)", contents=carousel_content))
+        else:
+            reply_dispatcher.reply(event, FlexSendMessage(alt_text="Báo Cáo Lũy Kế Savico", contents=flex_msg))
+    except Exception as e:
+        print(f"Lỗi gửi Flex LK1: {e}")
+        try:
+            reply_dispatcher.reply(event, TextSendMessage(text=f"Lỗi gửi Flex báo cáo lũy kế: {str(e)}"))
+        except Exception as pe:
+            print(f"Lỗi gửi tin báo lỗi dự phòng: {pe}")
 
+@command_router.command('help', exact=['#LENH', '#LỆNH', 'HELP', '#HELP', 'MENU', '#CUPHAP', 'CÚ PHÁP', 'CUPHAP'])
+def cmd_help(event, msg):
+    try:
+        help_bubble = build_help_commands_flex()
+        reply_dispatcher.reply(
+            event,
+            FlexSendMessage(alt_text="📖 Danh Sách Câu Lệnh Hỗ Trợ", contents=help_bubble)
+        )
+    except Exception as e:
+        print(f"Lỗi gửi bảng lệnh trợ giúp: {e}")
+        try:
+            reply_dispatcher.reply(event, TextSendMessage(text=f"Lỗi gửi trợ giúp: {str(e)}"))
+        except Exception as pe:
+            print(f"Lỗi gửi reply dự phòng: {pe}")
+
+@command_router.command('nhanvien', exact=['NV0', 'NV1'], compact=['nv0', 'nv1'], prefix=['NV0 ', 'NV1 ', 'NV:', 'NV '])
+def cmd_nhanvien(event, msg):
+    user_message = msg['text']
+    user_msg_upper = msg['upper']
     cmd_clean = user_message.lower().replace(" ", "")
-    has_nv_search_query = (
-        user_msg_upper.startswith('NV ') and len(user_message[3:].strip()) > 0
-    ) or (
-        user_msg_upper.startswith(('NV:', 'NV0 ', 'NV1 ')) and len(user_message[4:].strip()) > 0
-    )
-    is_nv_kpi_cmd = (
-        user_msg_upper in ['NV0', 'NV1'] or 
-        cmd_clean in ['nv0', 'nv1'] or 
-        user_msg_upper.startswith(('NV0 ', 'NV1 ', 'NV:')) or
-        has_nv_search_query
-    )
-
-    if is_nv_kpi_cmd:
-        group_id = getattr(event.source, 'group_id', None)
-        target_id = group_id or getattr(event.source, 'user_id', None)
-        
+    group_id = getattr(event.source, 'group_id', None)
+    target_id = group_id or getattr(event.source, 'user_id', None)
+    
+    try:
+        report = reply_dispatcher.run_heavy(event, build_nhanvien_report, "⏳ Đang tổng hợp thẻ KPI nhân viên, kết quả sẽ được gửi ngay khi xong...")
+    except Exception as e:
+        print(f"Lỗi khởi tạo báo cáo nhân viên: {e}")
         try:
-            flex_bubbles = build_nhanvien_flex()
-        except Exception as e:
-            print(f"Lỗi khởi tạo báo cáo nhân viên: {e}")
-            try:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"Lỗi tạo báo cáo nhân viên: {str(e)}"))
-            except Exception as pe:
-                print(f"Lỗi gửi reply dự phòng: {pe}")
+            reply_dispatcher.reply(event, TextSendMessage(text=f"Lỗi tạo báo cáo nhân viên: {str(e)}"))
+        except Exception as pe:
+            print(f"Lỗi gửi reply dự phòng: {pe}")
+        return
+        
+    try:
+        overview_bubble = report["overview"]
+
+        # 1. Chuẩn hóa lệnh NV0: Bảng Xếp Hạng Doanh Thu NV + Carousel 6 Thẻ KPI Đầu (Chia cụm max 2 thẻ/Carousel)
+        if cmd_clean == 'nv0':
+            overview_msg = FlexSendMessage(alt_text="🏆 Bảng Xếp Hạng Doanh Thu NV", contents=overview_bubble)
+            top_staff = render_staff_cards(report, *NHANVIEN_PAGES['nv0'])
+            reply_msgs = [overview_msg]
+            if top_staff:
+                for i in range(0, len(top_staff), 2):
+                    chunk = top_staff[i:i+2]
+                    reply_msgs.append(FlexSendMessage(
+                        alt_text=f"🎴 Thẻ KPI Nhân Viên (#{i+1}-#{i+len(chunk)})",
+                        contents={"type": "carousel", "contents": chunk}
+                    ))
+            reply_dispatcher.reply(event, reply_msgs[:5])
             return
-            
-        try:
-            if not isinstance(flex_bubbles, list):
-                flex_bubbles = [flex_bubbles]
-
-            overview_bubble = flex_bubbles[0]
-            staff_bubbles = flex_bubbles[1:]
-
-            # 1. Chuẩn hóa lệnh NV0: Bảng Xếp Hạng Doanh Thu NV + Carousel 6 Thẻ KPI Đầu (Chia cụm max 2 thẻ/Carousel)
-            if cmd_clean == 'nv0':
-                overview_msg = FlexSendMessage(alt_text="🏆 Bảng Xếp Hạng Doanh Thu NV", contents=overview_bubble)
-                top_staff = staff_bubbles[:6]
-                reply_msgs = [overview_msg]
-                if top_staff:
-                    for i in range(0, len(top_staff), 2):
-                        chunk = top_staff[i:i+2]
-                        reply_msgs.append(FlexSendMessage(
-                            alt_text=f"🎴 Thẻ KPI Nhân Viên (#{i+1}-#{i+len(chunk)})",
+
+        # 2. Chuẩn hóa lệnh NV1: Gửi tiếp các thẻ NV từ #7 đến hết (Chia cụm max 2 thẻ/Carousel)
+        elif cmd_clean == 'nv1':
+            rem_staff = render_staff_cards(report, *NHANVIEN_PAGES['nv1'])
+            if not rem_staff:
+                reply_dispatcher.reply(
+                    event,
+                    TextSendMessage(text="✅ Tất cả nhân viên đã được hiển thị trọn vẹn trong bảng xếp hạng NV0.")
+                )
+            else:
+                carousel_msgs = []
+                for i in range(0, len(rem_staff), 2):
+                    chunk = rem_staff[i:i+2]
+                    if chunk:
+                        carousel_msgs.append(FlexSendMessage(
+                            alt_text=f"🎴 Thẻ KPI Nhân Viên (#{i+7}-#{i+6+len(chunk)})",
                             contents={"type": "carousel", "contents": chunk}
                         ))
-                line_bot_api.reply_message(event.reply_token, reply_msgs[:5])
-                return
-
-            # 2. Chuẩn hóa lệnh NV1: Gửi tiếp các thẻ NV từ #7 đến hết (Chia cụm max 2 thẻ/Carousel)
-            elif cmd_clean == 'nv1':
-                rem_staff = staff_bubbles[6:]
-                if not rem_staff:
-                    line_bot_api.reply_message(
-                        event.reply_token,
-                        TextSendMessage(text="✅ Tất cả nhân viên đã được hiển thị trọn vẹn trong bảng xếp hạng NV0.")
-                    )
-                else:
-                    carousel_msgs = []
-                    for i in range(0, len(rem_staff), 2):
-                        chunk = rem_staff[i:i+2]
-                        if chunk:
-                            carousel_msgs.append(FlexSendMessage(
-                                alt_text=f"🎴 Thẻ KPI Nhân Viên (#{i+7}-#{i+6+len(chunk)})",
-                                contents={"type": "carousel", "contents": chunk}
-                            ))
-                    line_bot_api.reply_message(event.reply_token, carousel_msgs[:5])
-                return
-
-            # 3. Chuẩn hóa lệnh NV2 (Dự phòng nếu tổng số NV cực lớn): Gửi tiếp từ #17 trở đi
-            elif cmd_clean == 'nv2':
-                rem_staff = staff_bubbles[16:]
-                if not rem_staff:
-                    line_bot_api.reply_message(
-                        event.reply_token,
-                        TextSendMessage(text="✅ Tất cả nhân viên đã được hiển thị trong NV0 và NV1.")
+                reply_dispatcher.reply(event, carousel_msgs[:5])
+            return
+
+        # 3. Chuẩn hóa lệnh NV2 (Dự phòng nếu tổng số NV cực lớn): Gửi tiếp từ #17 trở đi
+        elif cmd_clean == 'nv2':
+            rem_staff = render_staff_cards(report, *NHANVIEN_PAGES['nv2'])
+            if not rem_staff:
+                reply_dispatcher.reply(
+                    event,
+                    TextSendMessage(text="✅ Tất cả nhân viên đã được hiển thị trong NV0 và NV1.")
+                )
+            else:
+                carousel_msgs = []
+                for i in range(0, len(rem_staff), 2):
+                    chunk = rem_staff[i:i+2]
+                    if chunk:
+                        carousel_msgs.append(FlexSendMessage(
+                            alt_text=f"🎴 Thẻ KPI Nhân Viên (#{i+17}-#{i+16+len(chunk)})",
+                            contents={"type": "carousel", "contents": chunk}
+                        ))
+                reply_dispatcher.reply(event, carousel_msgs[:5])
+            return
+
+        # 4. Trường hợp tra cứu riêng 1 hoặc nhiều nhân viên (VD: "NV 61169", "NV 61169,98372", "NV Dương")
+        query_param = ""
+        if user_msg_upper.startswith('NV '):
+            query_param = user_message[3:].strip()
+        elif user_msg_upper.startswith(('NV:', 'NV1 ', 'NV0 ', 'NV2 ')):
+            query_param = user_message[4:].strip()
+
+        if query_param:
+            raw_queries = [q.strip() for q in query_param.split(',') if q.strip()]
+            matched_bubbles = []
+
+            for q in raw_queries:
+                # Tra theo mã User, tiền tố tên không dấu, rồi tới số thứ hạng
+                rank_idx = find_staff_rank(report["staff_index"], q)
+                m_b = render_staff_cards(report, rank_idx - 1, rank_idx)[0] if rank_idx else None
+
+                if m_b and m_b not in matched_bubbles:
+                    matched_bubbles.append(m_b)
+
+            if matched_bubbles:
+                if len(matched_bubbles) == 1:
+                    reply_dispatcher.reply(
+                        event,
+                        FlexSendMessage(alt_text=f"🎴 Thẻ KPI Nhân Viên: {query_param}", contents=matched_bubbles[0])
                     )
                 else:
-                    carousel_msgs = []
-                    for i in range(0, len(rem_staff), 2):
-                        chunk = rem_staff[i:i+2]
-                        if chunk:
-                            carousel_msgs.append(FlexSendMessage(
-                                alt_text=f"🎴 Thẻ KPI Nhân Viên (#{i+17}-#{i+16+len(chunk)})",
-                                contents={"type": "carousel", "contents": chunk}
-                            ))
-                    line_bot_api.reply_message(event.reply_token, carousel_msgs[:5])
-                return
-
-            # 4. Trường hợp tra cứu riêng 1 hoặc nhiều nhân viên (VD: "NV 61169", "NV 61169,98372", "NV Dương")
-            query_param = ""
-            if user_msg_upper.startswith('NV '):
-                query_param = user_message[3:].strip()
-            elif user_msg_upper.startswith(('NV:', 'NV1 ', 'NV0 ', 'NV2 ')):
-                query_param = user_message[4:].strip()
-
-            if query_param:
-                raw_queries = [q.strip() for q in query_param.split(',') if q.strip()]
-                matched_bubbles = []
-
-                for q in raw_queries:
-                    qu = q.upper()
-                    m_b = None
-                    for s_b in staff_bubbles:
-                        if qu in json.dumps(s_b).upper():
-                            m_b = s_b
-                            break
-
-                    if not m_b and qu.isdigit():
-                        rank_idx = int(qu)
-                        if 1 <= rank_idx <= len(staff_bubbles):
-                            m_b = staff_bubbles[rank_idx - 1]
-
-                    if m_b and m_b not in matched_bubbles:
-                        matched_bubbles.append(m_b)
-
-                if matched_bubbles:
-                    if len(matched_bubbles) == 1:
-                        line_bot_api.reply_message(
-                            event.reply_token,
-                            FlexSendMessage(alt_text=f"🎴 Thẻ KPI Nhân Viên: {query_param}", contents=matched_bubbles[0])
-                        )
-                    else:
-                        matched_carousels = []
-                        for i in range(0, len(matched_bubbles), 2):
-                            chunk = matched_bubbles[i:i+2]
-                            matched_carousels.append(FlexSendMessage(
-                                alt_text=f"🎴 Thẻ KPI Nhân Viên ({i+1}-{i+len(chunk)})",
-                                contents={"type": "carousel", "contents": chunk}
-                            ))
-                        line_bot_api.reply_message(event.reply_token, matched_carousels[:5])
-                else:
-                    line_bot_api.reply_message(
-                        event.reply_token,
-                        TextSendMessage(text=f"🔍 Không tìm thấy nhân viên với mã/tên: '{query_param}'. Vui lòng thử lại với Mã User (VD: nv 61169).")
-                    )
-
-        except Exception as e:
-            print(f"Lỗi gửi Flex NV: {e}")
-            try:
-                line_bot_api.push_message(source_id, TextSendMessage(text=f"Lỗi gửi Flex xếp hạng nhân viên: {str(e)}"))
-            except Exception as pe:
-                print(f"Lỗi gửi tin nhắn đẩy dự phòng: {pe}")
-        return
+                    matched_carousels = []
+                    for i in range(0, len(matched_bubbles), 2):
+                        chunk = matched_bubbles[i:i+2]
+                        matched_carousels.append(FlexSendMessage(
+                            alt_text=f"🎴 Thẻ KPI Nhân Viên ({i+1}-{i+len(chunk)})",
+                            contents={"type": "carousel", "contents": chunk}
+                        ))
+                    reply_dispatcher.reply(event, matched_carousels[:5])
+            else:
+                reply_dispatcher.reply(
+                    event,
+                    TextSendMessage(text=f"🔍 Không tìm thấy nhân viên với mã/tên: '{query_param}'. Vui lòng thử lại với Mã User (VD: nv 61169).")
+                )
 
-    if user_msg_upper == 'RT1':
-        try:
-            flex_msg = build_realtime_flex()
-        except Exception as e:
-            print(f"Lỗi khởi tạo báo cáo realtime: {e}")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"Lỗi tạo báo cáo realtime: {str(e)}"))
-            return
-            
+    except Exception as e:
+        print(f"Lỗi gửi Flex NV: {e}")
         try:
-            if isinstance(flex_msg, list):
-                carousel_content = {"type": "carousel", "contents": flex_msg}
-                line_bot_api.reply_message(event.reply_token, FlexSendMessage(alt_text="⚡ BÁO CÁO REALTIME (Cuộn Ngang P.1 & P.2)", contents=carousel_content))
-            else:
-                line_bot_api.reply_message(event.reply_token, FlexSendMessage(alt_text="⚡ Báo Cáo Realtime Hôm Nay", contents=flex_msg))
-        except Exception as e:
-            print(f"Lỗi gửi Flex RT1: {e}")
-            try:
-                line_bot_api.push_message(source_id, TextSendMessage(text=f"Lỗi gửi Flex báo cáo realtime: {str(e)}"))
-            except Exception as pe:
-                print(f"Lỗi gửi tin nhắn đẩy dự phòng: {pe}")
-        return
+            reply_dispatcher.reply(event, TextSendMessage(text=f"Lỗi gửi Flex xếp hạng nhân viên: {str(e)}"))
+        except Exception as pe:
+            print(f"Lỗi gửi tin báo lỗi dự phòng: {pe}")
 
-    if user_msg_upper in ['RT', 'CAO'] or user_msg_upper.startswith(('RT ', 'CAO ')):
-        scrape_type = "realtime"
-        if "LK" in user_msg_upper or "LUY" in user_msg_upper:
-            scrape_type = "luyke"
-            
+@command_router.command('realtime', exact=['RT1'])
+def cmd_realtime(event, msg):
+    try:
+        flex_msg = reply_dispatcher.run_heavy(event, build_realtime_flex, "⏳ Đang tổng hợp báo cáo realtime, kết quả sẽ được gửi ngay khi xong...")
+    except Exception as e:
+        print(f"Lỗi khởi tạo báo cáo realtime: {e}")
+        reply_dispatcher.reply(event, TextSendMessage(text=f"Lỗi tạo báo cáo realtime: {str(e)}"))
+        return
+        
+    try:
+        if isinstance(flex_msg, list):
+            carousel_content = {"type": "carousel", "contents": flex_msg}
+            reply_dispatcher.reply(event, FlexSendMessage(alt_text="⚡ BÁO CÁO REALTIME (Cuộn Ngang P.1 & P.2)", contents=carousel_content))
+        else:
+            reply_dispatcher.reply(event, FlexSendMessage(alt_text="⚡ Báo Cáo Realtime Hôm Nay", contents=flex_msg))
+    except Exception as e:
+        print(f"Lỗi gửi Flex RT1: {e}")
         try:
-            # Kích hoạt tín hiệu trên Supabase
-            trigger_success, req_time = trigger_adhoc_scrape(scrape_type)
-            if not trigger_success:
-                print("Lỗi kích hoạt tín hiệu cào dữ liệu.")
-                return
-                
-            # Đợi đồng bộ cào kết quả trực tiếp và đẩy tin nhắn bằng push_message ngầm để tránh timeout
-            def poll_and_push(scrape_type_val, dest_id, requested_at_str):
-                completed = False
-                saw_running = False
-                req_prefix = requested_at_str[:16] if requested_at_str else ""
-                
-                for _ in range(40): # Tối đa 120 giây (40 vòng lặp * 3 giây)
-                    time.sleep(3)
-                    st_info = check_scrape_status()
-                    sig_status = st_info.get("status")
-                    sig_req = st_info.get("requested_at", "")
-                    
-                    if sig_status == "running":
-                        saw_running = True
-                    elif sig_status == "completed":
-                        if saw_running or not sig_req or sig_req >= req_prefix:
-                            completed = True
-                            break
-                            
-                if completed:
-                    try:
-                        if scrape_type_val == "luyke":
-                            flex_msg = build_luyke_flex()
-                            if isinstance(flex_msg, list):
-                                messages = [FlexSendMessage(alt_text=f"Báo Cáo Lũy Kế Savico P.{i+1}", contents=b) for i, b in enumerate(flex_msg)]
-                                line_bot_api.push_message(dest_id, messages)
-                            else:
-                                line_bot_api.push_message(dest_id, FlexSendMessage(alt_text="Báo Cáo Lũy Kế Savico", contents=flex_msg))
-                        else:
-                            flex_msg = build_realtime_flex()
-                            line_bot_api.push_message(dest_id, FlexSendMessage(alt_text="Báo Cáo Realtime Hôm Nay", contents=flex_msg))
-                    except Exception as fe:
-                        print(f"Lỗi gửi Flex báo cáo cào: {fe}")
-                        try:
-                            line_bot_api.push_message(dest_id, TextSendMessage(text=f"❌ Có lỗi xảy ra khi vẽ Flex báo cáo: {str(fe)}"))
-                        except Exception as pe:
-                            print(f"Lỗi gửi tin đẩy báo lỗi: {pe}")
-                else:
-                    try:
-                        line_bot_api.push_message(dest_id, TextSendMessage(text=f"⚠️ Thời gian chờ cào dữ liệu [{scrape_type_val.upper()}] quá hạn. Vui lòng đảm bảo Chrome trên máy trạm đã bật và đã đăng nhập Portal BI."))
-                    except Exception as pe:
-                        print(f"Lỗi gửi tin đẩy quá hạn: {pe}")
+            reply_dispatcher.reply(event, TextSendMessage(text=f"Lỗi gửi Flex báo cáo realtime: {str(e)}"))
+        except Exception as pe:
+            print(f"Lỗi gửi tin báo lỗi dự phòng: {pe}")
+
+@command_router.command('scrape', exact=['RT', 'CAO'], prefix=['RT ', 'CAO '])
+def cmd_scrape(event, msg):
+    user_msg_upper = msg['upper']
+    source_id = msg['source_id']
+    scrape_type = "realtime"
+    if "LK" in user_msg_upper or "LUY" in user_msg_upper:
+        scrape_type = "luyke"
+        
+    try:
+        # Kích hoạt tín hiệu trên Supabase (gộp với lượt cào cùng loại đang chạy nếu có);
+        # kết quả được đẩy bằng push_message ngầm để tránh timeout
+        scrape_watcher.request_scrape(scrape_type, source_id, push_scrape_results)
 
-            threading.Thread(target=poll_and_push, args=(scrape_type, source_id, req_time), daemon=True).start()
+    except Exception as e:
+        print(f"Lỗi xử lý tín hiệu {user_msg_upper}: {e}")
+
+# 7. Lịch làm việc (NV/PG)
+@command_router.command('schedule_day', pattern=re.compile(r'^(NV|PG)([2-8])$', re.IGNORECASE))
+def cmd_schedule_day(event, msg):
+    schedule_match = msg['match']
+    schedule_type_cmd = schedule_match.group(1).upper()
+    day_number = int(schedule_match.group(2))
+    schedule_type = 'employee' if schedule_type_cmd == 'NV' else 'pg'
+    days_map = {2: "Thứ Hai", 3: "Thứ Ba", 4: "Thứ Tư", 5: "Thứ Năm", 6: "Thứ Sáu", 7: "Thứ Bảy", 8: "Chủ Nhật"}
+    day_str = days_map.get(day_number)
+    try:
+        # Trả lời lịch qua reply_dispatcher (tự chuyển sang push nếu reply token đã hết hạn)
+        send_daily_schedule(schedule_type, day_of_week_str=day_str, reply=lambda m: reply_dispatcher.reply(event, m))
+    except Exception as e:
+        print(f"Error schedule: {e}")
 
-        except Exception as e:
-            print(f"Lỗi xử lý tín hiệu {user_msg_upper}: {e}")
-        return
+@command_router.command('schedule_today', exact=['NV', 'PG'])
+def cmd_schedule_today(event, msg):
+    user_msg_upper = msg['upper']
+    schedule_type = 'employee' if user_msg_upper == 'NV' else 'pg'
+    try:
+        # Trả lời lịch qua reply_dispatcher (tự chuyển sang push nếu reply token đã hết hạn)
+        send_daily_schedule(schedule_type, reply=lambda m: reply_dispatcher.reply(event, m))
+    except Exception as e:
+        print(f"Error schedule: {e}")
 
-    # 7. Lịch làm việc (NV/PG)
-    schedule_match = re.match(r"^(NV|PG)([2-8])$", user_msg_upper)
-    if schedule_match:
-        schedule_type_cmd = schedule_match.group(1)
-        day_number = int(schedule_match.group(2))
-        schedule_type = 'employee' if schedule_type_cmd == 'NV' else 'pg'
-        days_map = {2: "Thứ Hai", 3: "Thứ Ba", 4: "Thứ Tư", 5: "Thứ Năm", 6: "Thứ Sáu", 7: "Thứ Bảy", 8: "Chủ Nhật"}
-        day_str = days_map.get(day_number)
-        try:
-            # Gửi lịch với reply_token
-            send_daily_schedule(schedule_type, reply_token=event.reply_token, day_of_week_str=day_str)
-        except Exception as e:
-            print(f"Error schedule: {e}")
-        return
+# 8. Báo cáo (ST, BXH)
+def is_report_query(msg):
+    """Tên cụm / mã siêu thị, tra trong chỉ mục bộ nhớ (không đọc sheet cho tin trò chuyện)."""
+    return store_index.classify(msg['upper']) is not None
 
-    if user_msg_upper in ['NV', 'PG']:
-        schedule_type = 'employee' if user_msg_upper == 'NV' else 'pg'
-        try:
-            # Gửi lịch với reply_token
-            send_daily_schedule(schedule_type, reply_token=event.reply_token)
-        except Exception as e:
-            print(f"Error schedule: {e}")
-        return
-        
-    # 8. Báo cáo (ST, BXH)
+@command_router.command('report', exact=['BXH', 'BXH1', 'BXH2'], prefix=['ST '], match=is_report_query)
+def cmd_report(event, msg):
+    user_message = msg['text']
+    user_msg_upper = msg['upper']
     try:
-        sheet = get_spreadsheet().worksheet(WORKSHEET_NAME)
-        all_data = sheet.get_all_values()
+        all_data = sheet_cache.get_all_values(WORKSHEET_NAME)
         reply_messages = []
-        cluster_names = {row[0].strip().upper() for row in all_data[1:] if len(row) > 0 and row[0]}
+        # Dữ liệu vừa tải cũng dùng để làm mới chỉ mục tên cụm / mã siêu thị
+        cluster_names = store_index.update_from_values(all_data)['clusters']
         header_row = all_data[0]
         
         if user_msg_upper.startswith('ST '):
@@ -1347,7 +1460,7 @@ def handle_message(event):
                         reply_messages.append(summary_message)
         
         if reply_messages:
-            line_bot_api.reply_message(event.reply_token, reply_messages)
+            reply_dispatcher.reply(event, reply_messages)
 
     except Exception as e:
         print(f"!!! GẶP LỖI NGHIÊM TRỌNG KHI XỬ LÝ BÁO CÁO: {repr(e)}")
@@ -0,0 +1,131 @@
+import re
+import threading
+import time
+
+# --- BỘ ĐỊNH TUYẾN LỆNH TIN NHẮN ---
+# handle_message trước đây kiểm tra hơn 30 điều kiện theo thứ tự cho MỌI tin
+# nhắn, và nhánh cuối còn tải cả sheet chi_tiet_cum cho tin nhắn trò chuyện.
+# Mỗi lệnh giờ được đăng ký một lần kèm bộ so khớp biên dịch sẵn; tin nhắn được
+# tra theo thứ tự: bảng khớp chính xác (dict) -> bảng tiền tố -> bảng regex ->
+# các hàm nhận dạng rẻ. Tin không khớp lệnh nào trả về ngay, không chạm I/O.
+#
+# Mỗi tin nhắn có hai dạng khóa:
+#   upper   - nội dung đã strip và viết hoa ("MENU BOT", "ST 123")
+#   compact - dạng upper bỏ hết khoảng trắng ("AN SANG" -> "ANSANG")
+
+_lock = threading.Lock()
+_commands = {}       # name -> lệnh đã đăng ký
+_exact = {}          # upper -> name
+_exact_compact = {}  # compact -> name
+_prefixes = []       # (prefix, dùng compact?, name), tiền tố dài xét trước
+_patterns = []       # (regex đã biên dịch, name), theo thứ tự đăng ký
+_matchers = []       # (hàm nhận dạng(msg) -> bool, name)
+_stats = {'messages': 0, 'matched': 0, 'unmatched': 0, 'denied': 0}
+
+
+def command(name, exact=(), compact=(), prefix=(), compact_prefix=(), pattern=None, match=None,
+            public=False, admin=False):
+    """
+    Decorator đăng ký một lệnh. handler(event, msg) nhận msg là dict gồm text,
+    upper, compact, user_id, source_id và match (kết quả regex nếu khớp theo pattern).
+      public: lệnh chạy được cả ở nhóm/người chưa được cấp quyền.
+      admin:  chỉ ADMIN_USER_ID được chạy (app quyết định cách từ chối).
+    """
+    def register(handler):
+        with _lock:
+            _commands[name] = {
+                'name': name, 'handler': handler, 'public': public, 'admin': admin,
+                'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            }
+            for key in exact:
+                _exact[key.upper()] = name
+            for key in compact:
+                _exact_compact[_compact(key)] = name
+            for key in prefix:
+                _prefixes.append((key.upper(), False, name))
+            for key in compact_prefix:
+                _prefixes.append((_compact(key), True, name))
+            _prefixes.sort(key=lambda p: len(p[0]), reverse=True)
+            if pattern is not None:
+                _patterns.append((re.compile(pattern) if isinstance(pattern, str) else pattern, name))
+            if match is not None:
+                _matchers.append((match, name))
+        return handler
+    return register
+
+
+def _compact(text):
+    return ''.join(text.upper().split())
+
+
+def parse(text, user_id=None, source_id=None):
+    """Chuẩn hóa một tin nhắn thành msg dùng cho so khớp và cho handler."""
+    text = text.strip()
+    upper = text.upper()
+    return {'text': text, 'upper': upper, 'compact': ''.join(upper.split()),
+            'user_id': user_id, 'source_id': source_id, 'match': None}
+
+
+def resolve(msg):
+    """Tìm lệnh cho msg; trả về tên lệnh hoặc None. Có thể gán msg['match']."""
+    name = _exact.get(msg['upper']) or _exact_compact.get(msg['compact'])
+    if name:
+        return name
+    for prefix, use_compact, name in _prefixes:
+        if (msg['compact'] if use_compact else msg['upper']).startswith(prefix):
+            return name
+    for regex, name in _patterns:
+        m = regex.match(msg['text'])
+        if m:
+            msg['match'] = m
+            return name
+    for matcher, name in _matchers:
+        if matcher(msg):
+            return name
+    return None
+
+
+def dispatch(event, msg, authorize=None):
+    """
+    Chạy lệnh khớp với msg. authorize(cmd, event, msg) -> bool quyết định quyền
+    (chỉ được gọi khi đã khớp lệnh). Trả về tên lệnh đã chạy, hoặc None.
+    """
+    name = resolve(msg)
+    with _lock:
+        _stats['messages'] += 1
+        _stats['matched' if name else 'unmatched'] += 1
+        cmd = _commands.get(name)
+    if cmd is None:
+        return None
+    if authorize is not None and not authorize(cmd, event, msg):
+        with _lock:
+            _stats['denied'] += 1
+        return None
+
+    started = time.time()
+    try:
+        cmd['handler'](event, msg)
+    except Exception:
+        with _lock:
+            cmd['errors'] += 1
+        raise
+    finally:
+        elapsed_ms = (time.time() - started) * 1000
+        with _lock:
+            cmd['calls'] += 1
+            cmd['total_ms'] += elapsed_ms
+            cmd['max_ms'] = max(cmd['max_ms'], elapsed_ms)
+    return name
+
+
+def get_router_stats():
+    with _lock:
+        commands = {
+            c['name']: {
+                'calls': c['calls'], 'errors': c['errors'],
+                'avg_ms': round(c['total_ms'] / c['calls'], 1) if c['calls'] else None,
+                'max_ms': round(c['max_ms'], 1),
+            }
+            for c in _commands.values() if c['calls'] or c['errors']
+        }
+        return dict(_stats, commands=commands, registered=len(_commands))
@@ -1,5 +1,7 @@
 import os
 import json
+import threading
+import time
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
@@ -7,21 +9,37 @@ from oauth2client.service_account import ServiceAccountCredentials
 
 # Đọc credentials từ biến môi trường
 GOOGLE_CREDS_JSON = os.environ.get('GOOGLE_CREDENTIALS_JSON')
-if not GOOGLE_CREDS_JSON:
-    raise ValueError("Lỗi: Biến môi trường GOOGLE_CREDENTIALS_JSON không được thiết lập.")
-
-# Xác thực với Google
 SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-google_creds_dict = json.loads(GOOGLE_CREDS_JSON)
-CREDS = ServiceAccountCredentials.from_json_keyfile_dict(google_creds_dict, SCOPE)
-CLIENT = gspread.authorize(CREDS)
 
+# Client và spreadsheet được tạo khi cần lần đầu (không xác thực lúc import),
+# để gunicorn trả lời /ping ngay cả khi Google chậm.
+_CLIENT = None
 _SPREADSHEET = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global _CLIENT
+    if _CLIENT is None:
+        with _client_lock:
+            if _CLIENT is None:
+                if not GOOGLE_CREDS_JSON:
+                    raise ValueError("Lỗi: Biến môi trường GOOGLE_CREDENTIALS_JSON không được thiết lập.")
+                started = time.time()
+                google_creds_dict = json.loads(GOOGLE_CREDS_JSON)
+                creds = ServiceAccountCredentials.from_json_keyfile_dict(google_creds_dict, SCOPE)
+                _CLIENT = gspread.authorize(creds)
+                print(f"Đã xác thực Google Sheets trong {time.time() - started:.2f}s.")
+    return _CLIENT
 
 def get_spreadsheet():
     global _SPREADSHEET
     if _SPREADSHEET is None:
-        _SPREADSHEET = CLIENT.open(SHEET_NAME)
+        client = get_client()
+        with _client_lock:
+            if _SPREADSHEET is None:
+                started = time.time()
+                _SPREADSHEET = client.open(SHEET_NAME)
+                print(f"Đã mở spreadsheet '{SHEET_NAME}' trong {time.time() - started:.2f}s.")
     return _SPREADSHEET
 
 # Tên các trang tính dùng chung
@@ -33,4 +51,5 @@ WORKSHEET_SCHEDULES_NAME = 'schedules'
 # === THÊM MỚI ===
 WORKSHEET_MEAL_TRACKER_NAME = 'meal_tracker'
 WORKSHEET_ADHOC_TASKS = 'adhoc_tasks'
-WORKSHEET_VESINH_TRACKER_NAME = 'vesinh_tracker'
\ No newline at end of file
+WORKSHEET_VESINH_TRACKER_NAME = 'vesinh_tracker'
+WORKSHEET_GROUP_MEMBERS = 'group_members'
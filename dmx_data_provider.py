@@ -1,40 +1,194 @@
+import os
 import requests
 import json
+import time
+import threading
 from datetime import datetime
 import pytz
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 SUPABASE_URL = "https://uybcglehwheygxmzlwbq.supabase.co"
 SUPABASE_KEY = "sb_publishable_tb1cO9NPuNC1cdA-pt_NNQ_1n5I9IkU"
 
+# --- PHIÊN HTTP DÙNG CHUNG (KEEP-ALIVE) ---
+# Mọi lời gọi Supabase đi qua một requests.Session có pool kết nối, nên không
+# phải bắt tay TLS lại cho mỗi lệnh (vòng poll RT gọi tới 40 lần/lượt cào).
+POOL_SIZE = int(os.environ.get('SUPABASE_POOL_SIZE', '10'))
+MAX_RETRIES = int(os.environ.get('SUPABASE_MAX_RETRIES', '2'))
+RETRY_BACKOFF = float(os.environ.get('SUPABASE_RETRY_BACKOFF', '0.3'))
+CONNECT_TIMEOUT = float(os.environ.get('SUPABASE_CONNECT_TIMEOUT', '3'))
+DATA_TIMEOUT = float(os.environ.get('SUPABASE_DATA_TIMEOUT', '12'))
+LOCK_TIMEOUT = float(os.environ.get('SUPABASE_LOCK_TIMEOUT', '6'))
+SIGNAL_TIMEOUT = float(os.environ.get('SUPABASE_SIGNAL_TIMEOUT', '10'))
+
+# Mốc (ms) của histogram độ trễ theo từng endpoint
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_session = None
+_session_lock = threading.Lock()
+_http_stats = {}
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = Retry(
+                    total=MAX_RETRIES, backoff_factor=RETRY_BACKOFF,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    # POST scrape_signals là upsert (merge-duplicates) nên thử lại an toàn
+                    allowed_methods=frozenset(['GET', 'POST'])
+                )
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({
+                    "apikey": SUPABASE_KEY,
+                    "Authorization": f"Bearer {SUPABASE_KEY}"
+                })
+                _session = session
+    return _session
+
+def _record_latency(endpoint, elapsed_ms, ok):
+    with _session_lock:
+        stats = _http_stats.setdefault(endpoint, {
+            'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'buckets': {str(b): 0 for b in LATENCY_BUCKETS_MS + ('inf',)}
+        })
+        stats['count'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        if not ok:
+            stats['errors'] += 1
+        bucket = next((str(b) for b in LATENCY_BUCKETS_MS if elapsed_ms <= b), 'inf')
+        stats['buckets'][bucket] += 1
+
+def _request(endpoint, method, url, timeout, **kwargs):
+    """Gọi Supabase qua phiên dùng chung và ghi nhận độ trễ theo endpoint."""
+    started = time.time()
+    ok = False
+    try:
+        res = get_session().request(method, url, timeout=(CONNECT_TIMEOUT, timeout), **kwargs)
+        ok = res.status_code < 400
+        return res
+    finally:
+        _record_latency(endpoint, (time.time() - started) * 1000, ok)
+
+def get_http_stats():
+    """Histogram độ trễ (ms) của từng endpoint Supabase, dùng cho /metrics."""
+    with _session_lock:
+        return {
+            endpoint: dict(
+                stats, buckets=dict(stats['buckets']),
+                total_ms=round(stats['total_ms'], 1), max_ms=round(stats['max_ms'], 1),
+                avg_ms=round(stats['total_ms'] / stats['count'], 1) if stats['count'] else None
+            )
+            for endpoint, stats in _http_stats.items()
+        }
+
+# --- BỘ NHỚ ĐỆM DATASET THEO sheet_name ---
+# LK1/NV0/NV1/RT1 dùng chung nhiều sheet (Data_BI, Config_ThiDua, Data_ThiDua...).
+# Mỗi sheet được giữ trong bộ nhớ kèm updated_at. Trong DATASET_FRESH_SECONDS
+# giây dùng luôn bản đệm; sau đó chỉ hỏi lại cột updated_at (rất nhẹ) và tải
+# lại đúng những sheet đã thay đổi.
+DATASET_FRESH_SECONDS = float(os.environ.get('SUPABASE_DATASET_FRESH_SECONDS', '15'))
+
+_dataset_cache = {}  # sheet_name -> {'data': ..., 'updated_at': ..., 'checked_at': ...}
+_dataset_lock = threading.Lock()
+_revalidate_lock = threading.Lock()
+_dataset_stats = {'fresh_hits': 0, 'revalidated': 0, 'sheets_refetched': 0, 'sheets_unchanged': 0, 'stale_served': 0}
+
+def _sheet_filter(sheet_names):
+    return ",".join(f'"{s}"' for s in sheet_names)
+
+def _fetch_updated_at(sheet_names):
+    url = f"{SUPABASE_URL}/rest/v1/sheet_data?sheet_name=in.({_sheet_filter(sheet_names)})&select=sheet_name,updated_at"
+    res = _request('dashboard_revalidate', 'GET', url, LOCK_TIMEOUT, headers={"Cache-Control": "no-cache"})
+    if res.status_code != 200:
+        raise ValueError(f"HTTP {res.status_code}")
+    return {row.get("sheet_name"): row.get("updated_at") for row in res.json()}
+
+def _fetch_datasets(sheet_names):
+    url = f"{SUPABASE_URL}/rest/v1/sheet_data?sheet_name=in.({_sheet_filter(sheet_names)})&select=sheet_name,data,updated_at"
+    res = _request('dashboard_data', 'GET', url, DATA_TIMEOUT, headers={"Cache-Control": "no-cache"})
+    if res.status_code != 200:
+        raise ValueError(f"HTTP {res.status_code}")
+    return {row.get("sheet_name"): row for row in res.json()}
+
+def _revalidate_datasets(sheet_names, cached):
+    """Hỏi updated_at của các sheet, chỉ tải lại những sheet đã đổi; lỗi thì giữ bản đệm cũ."""
+    try:
+        remote_updated = _fetch_updated_at(sheet_names)
+        changed = [
+            name for name in sheet_names
+            if name in remote_updated and (not cached[name] or cached[name]['updated_at'] != remote_updated[name])
+        ]
+        fetched = _fetch_datasets(changed) if changed else {}
+        checked_at = time.time()
+        with _dataset_lock:
+            _dataset_stats['revalidated'] += 1
+            _dataset_stats['sheets_refetched'] += len(fetched)
+            _dataset_stats['sheets_unchanged'] += len(sheet_names) - len(changed)
+            for name in sheet_names:
+                if name in fetched:
+                    row = fetched[name]
+                    _dataset_cache[name] = {'data': row.get("data", []), 'updated_at': row.get("updated_at"), 'checked_at': checked_at}
+                elif name not in remote_updated:
+                    # Sheet không còn trên Supabase
+                    _dataset_cache.pop(name, None)
+                elif _dataset_cache.get(name):
+                    _dataset_cache[name]['checked_at'] = checked_at
+            cached = {name: _dataset_cache.get(name) for name in sheet_names}
+    except Exception as e:
+        print(f"Lỗi truy vấn dữ liệu trực tiếp từ Supabase: {e}")
+        with _dataset_lock:
+            if any(cached.values()):
+                _dataset_stats['stale_served'] += 1
+    return cached
+
 def get_dashboard_data(sheets_str):
     """
-    Truy vấn trực tiếp Supabase REST API để lấy dữ liệu mới nhất (bỏ qua Proxy GAS cũ)
+    Truy vấn trực tiếp Supabase REST API để lấy dữ liệu mới nhất (bỏ qua Proxy GAS cũ).
+    Dữ liệu được đệm theo từng sheet_name và chỉ tải lại khi updated_at thay đổi.
     """
     sheet_names = [s.strip() for s in sheets_str.split(',') if s.strip()]
-    sheet_names_str = ",".join(f'"{s}"' for s in sheet_names)
-    url = f"{SUPABASE_URL}/rest/v1/sheet_data?sheet_name=in.({sheet_names_str})"
+    now = time.time()
     
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Cache-Control": "no-cache"
-    }
+    with _dataset_lock:
+        cached = {name: _dataset_cache.get(name) for name in sheet_names}
+        all_fresh = all(entry and now - entry['checked_at'] <= DATASET_FRESH_SECONDS for entry in cached.values())
+        if all_fresh:
+            _dataset_stats['fresh_hits'] += 1
     
-    result = {name: [] for name in sheet_names}
+    if not all_fresh:
+        # Chỉ một luồng hỏi lại Supabase, các luồng khác chờ rồi dùng kết quả vừa tải
+        with _revalidate_lock:
+            with _dataset_lock:
+                cached = {name: _dataset_cache.get(name) for name in sheet_names}
+                all_fresh = all(entry and time.time() - entry['checked_at'] <= DATASET_FRESH_SECONDS for entry in cached.values())
+            if not all_fresh:
+                cached = _revalidate_datasets(sheet_names, cached)
     
-    try:
-        res = requests.get(url, headers=headers, timeout=12)
-        if res.status_code == 200:
-            rows = res.json()
-            for row in rows:
-                s_name = row.get("sheet_name")
-                if s_name in result:
-                    result[s_name] = row.get("data", [])
-    except Exception as e:
-        print(f"Lỗi truy vấn dữ liệu trực tiếp từ Supabase: {e}")
-        
+    result = {name: [] for name in sheet_names}
+    for name, entry in cached.items():
+        if entry:
+            data = entry['data']
+            # Trả bản sao nông để nơi gọi có sắp xếp/thêm bớt cũng không ảnh hưởng bộ đệm
+            result[name] = list(data) if isinstance(data, list) else data
     return result
 
+def get_dataset_cache_stats():
+    with _dataset_lock:
+        now = time.time()
+        return dict(
+            _dataset_stats,
+            fresh_seconds=DATASET_FRESH_SECONDS,
+            sheets={name: {'updated_at': e['updated_at'], 'checked_age_s': round(now - e['checked_at'], 1)}
+                    for name, e in _dataset_cache.items()}
+        )
+
 def get_locked_target_config():
     """
     Lấy cấu hình Target khóa (được lưu từ web app baocao_nhanvien theo tỷ lệ 60-40 hoặc mode chọn)
@@ -46,12 +200,10 @@ def get_locked_target_config():
     # Tìm Target_Lock mới nhất theo tháng (hỗ trợ mọi areaId)
     url = f"{SUPABASE_URL}/rest/v1/sheet_data?sheet_name=like.Target_Lock_%25_{month_str}%25&order=updated_at.desc&limit=1"
     headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
         "Cache-Control": "no-cache"
     }
     try:
-        res = requests.get(url, headers=headers, timeout=6)
+        res = _request('target_lock', 'GET', url, LOCK_TIMEOUT, headers=headers)
         if res.status_code == 200:
             rows = res.json()
             if rows and len(rows) > 0:
@@ -70,8 +222,6 @@ def trigger_adhoc_scrape(scrape_type):
     try:
         url = f"{SUPABASE_URL}/rest/v1/sheet_data"
         headers = {
-            "apikey": SUPABASE_KEY,
-            "Authorization": f"Bearer {SUPABASE_KEY}",
             "Content-Type": "application/json",
             "Prefer": "resolution=merge-duplicates"
         }
@@ -84,7 +234,7 @@ def trigger_adhoc_scrape(scrape_type):
             },
             "updated_at": now_utc
         }
-        res = requests.post(url, headers=headers, json=payload, timeout=10)
+        res = _request('scrape_trigger', 'POST', url, SIGNAL_TIMEOUT, headers=headers, json=payload)
         if res.status_code in [200, 201]:
             return True, now_utc
     except Exception as e:
@@ -96,16 +246,13 @@ def check_scrape_status():
     Kiểm tra chi tiết trạng thái cào (gồm status, requested_at, type)
     """
     try:
-        import time
         timestamp = int(time.time() * 1000)
         url = f"{SUPABASE_URL}/rest/v1/sheet_data?sheet_name=in.(scrape_signals,cb_{timestamp})&select=data"
         headers = {
-            "apikey": SUPABASE_KEY,
-            "Authorization": f"Bearer {SUPABASE_KEY}",
             "Cache-Control": "no-cache",
             "Pragma": "no-cache"
         }
-        res = requests.get(url, headers=headers, timeout=10)
+        res = _request('scrape_status', 'GET', url, SIGNAL_TIMEOUT, headers=headers)
         if res.status_code == 200:
             rows = res.json()
             if rows and len(rows) > 0:
@@ -1,7 +1,66 @@
+import os
+import json
+import hashlib
+import unicodedata
+import threading
+import collections
 import pytz
 from datetime import datetime
 from dmx_data_provider import get_dashboard_data, get_locked_target_config
 
+# --- BỘ NHỚ ĐỆM FLEX ĐÃ VẼ ---
+# LK1/RT1/NV0 dựng lại cả cây Flex lớn ở mỗi lệnh dù dữ liệu Supabase không đổi.
+# Kết quả được nhớ theo mã băm của dữ liệu đầu vào + mốc ngày (ngày, days_passed,
+# thứ); RT thêm giờ:phút vì tiến độ trong ngày tính theo phút. Bản đệm lưu dạng
+# JSON nên mỗi lần trả về là một bản sao mới, chỉ thay lại giờ "Cập nhật".
+RENDER_CACHE_MAX = int(os.environ.get('FLEX_RENDER_CACHE_MAX', '64'))
+
+_render_cache = collections.OrderedDict()
+_render_lock = threading.Lock()
+_render_stats = {'hits': 0, 'misses': 0}
+
+def _fingerprint(*parts):
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+def _date_bucket(now):
+    days_in_month = (datetime(now.year, now.month + 1, 1) - datetime(now.year, now.month, 1)).days if now.month < 12 else 31
+    days_passed = days_in_month if now.day == 1 else now.day - 1
+    return (now.strftime("%Y-%m-%d"), days_passed, now.weekday())
+
+def _render_cached(builder_name, cache_key, now, render):
+    """Trả về Flex đã vẽ nếu cùng khóa, ngược lại gọi render() và nhớ lại kết quả."""
+    now_str = now.strftime("%H:%M - %d/%m/%Y")
+    key = (builder_name, cache_key)
+    with _render_lock:
+        entry = _render_cache.get(key)
+        if entry is not None:
+            _render_cache.move_to_end(key)
+            _render_stats['hits'] += 1
+        else:
+            _render_stats['misses'] += 1
+
+    if entry is not None:
+        cached_json, cached_now_str = entry
+        if cached_now_str != now_str:
+            cached_json = cached_json.replace(f"Cập nhật: {cached_now_str}", f"Cập nhật: {now_str}")
+        return json.loads(cached_json)
+
+    result = render(now)
+    with _render_lock:
+        _render_cache[key] = (json.dumps(result, ensure_ascii=False), now_str)
+        _render_cache.move_to_end(key)
+        while len(_render_cache) > RENDER_CACHE_MAX:
+            _render_cache.popitem(last=False)
+    return result
+
+def get_render_cache_stats():
+    with _render_lock:
+        return dict(_render_stats, entries=len(_render_cache), max_entries=RENDER_CACHE_MAX)
+
+def _now():
+    return datetime.now(pytz.timezone('Asia/Ho_Chi_Minh'))
+
 def parse_number(val):
     if val is None or val == '':
         return 0.0
@@ -9,6 +68,12 @@ def parse_number(val):
         return float(val)
     
     str_val = str(val).strip().replace(" ", "")
+    if ',' not in str_val:
+        # Đường nhanh: phần lớn ô là số thuần, float() đọc thẳng được
+        try:
+            return float(str_val)
+        except ValueError:
+            pass
     if ',' in str_val and '.' in str_val:
         if str_val.rfind(',') > str_val.rfind('.'):
             str_val = str_val.replace(".", "").replace(",", ".")
@@ -23,15 +88,41 @@ def parse_number(val):
     except:
         return 0.0
 
+def numeric_columns(rows, **columns):
+    """
+    Nạp các cột số của một dataset trong một lượt: columns là tên -> tuple các tên gọi
+    (giống get_key_val). Khóa cột được phân giải một lần cho mỗi bộ tiêu đề (các dòng
+    cùng dataset dùng chung), sau đó chỉ là một vòng lặp parse_number.
+    Trả về tên -> danh sách số thực cùng thứ tự với rows.
+    """
+    result = {name: [] for name in columns}
+    plans = {}
+    for row in rows:
+        if not row or not isinstance(row, dict):
+            for values in result.values():
+                values.append(0.0)
+            continue
+        header = tuple(row)
+        plan = plans.get(header)
+        if plan is None:
+            plan = plans[header] = [
+                (result[name], resolve_column(header, aliases)) for name, aliases in columns.items()
+            ]
+        for values, key in plan:
+            values.append(parse_number(row[key]) if key is not None else 0.0)
+    return result
+
 def parse_growth_rate(val):
     if not val:
         return 0.0
-    val_str = str(val).strip().replace(',', '.')
-    if val_str.endswith('%'):
-        val_str = val_str[:-1].strip()
-        return parse_number(val_str)
-    
-    num = parse_number(val_str)
+    if isinstance(val, (int, float)):
+        num = float(val)
+    else:
+        val_str = str(val).strip().replace(',', '.')
+        if val_str.endswith('%'):
+            return parse_number(val_str[:-1])
+        num = parse_number(val_str)
+
     if -2.0 <= num <= 2.0 and num != 0:
         return num * 100.0
     return num
@@ -94,6 +185,47 @@ def shorten_staff_name(name):
     initials = [p[0].upper() + "." for p in parts[:-1]]
     return "".join(initials) + parts[-1]
 
+# Kế hoạch phân giải cột: (bộ tiêu đề của dòng, danh sách tên gọi) -> khóa gốc.
+# Các dòng cùng một dataset có chung bộ tiêu đề nên chỉ phân giải một lần,
+# những lần sau chỉ là một phép tra dict thay vì dựng lại bản đồ chữ thường.
+COLUMN_PLAN_MAX = 4096
+_column_plans = {}
+
+def resolve_column(header_keys, possible_keys):
+    """Trả về khóa gốc trong header_keys khớp với tên gọi đầu tiên (ưu tiên khớp chính xác, sau đó không phân biệt hoa thường), hoặc None."""
+    plan_key = (header_keys, possible_keys)
+    try:
+        return _column_plans[plan_key]
+    except KeyError:
+        pass
+
+    resolved = None
+    for pk in possible_keys:
+        if pk in header_keys:
+            resolved = pk
+            break
+    else:
+        row_keys_lower = {k.strip().lower(): k for k in header_keys}
+        for pk in possible_keys:
+            pk_lower = pk.strip().lower()
+            if pk_lower in row_keys_lower:
+                resolved = row_keys_lower[pk_lower]
+                break
+
+    if len(_column_plans) >= COLUMN_PLAN_MAX:
+        _column_plans.clear()
+    _column_plans[plan_key] = resolved
+    return resolved
+
+def resolve_columns(rows, **columns):
+    """
+    Phân giải một lần các cột của một dataset từ tiêu đề của dòng đầu tiên: columns là
+    tên -> tuple các tên gọi (giống get_key_val). Trả về tên -> khóa gốc (None nếu
+    thiếu cột) để vòng lặp đọc thẳng bằng row.get(khóa) thay vì gọi get_key_val từng ô.
+    """
+    header = next((tuple(r) for r in rows if r and isinstance(r, dict)), ())
+    return {name: resolve_column(header, aliases) for name, aliases in columns.items()}
+
 def get_key_val(row, *possible_keys, default=None):
     if not row or not isinstance(row, dict):
         return default
@@ -101,15 +233,11 @@ def get_key_val(row, *possible_keys, default=None):
     for pk in possible_keys:
         if pk in row:
             return row[pk]
-            
-    row_keys_lower = {k.strip().lower(): k for k in row.keys()}
-    for pk in possible_keys:
-        pk_lower = pk.strip().lower()
-        if pk_lower in row_keys_lower:
-            orig_key = row_keys_lower[pk_lower]
-            return row[orig_key]
-            
-    return default
+
+    key = resolve_column(tuple(row), possible_keys)
+    if key is None:
+        return default
+    return row[key]
 
 def make_table_header(cols, weights, aligns=None, bg_color="#0284c7"):
     if not aligns:
@@ -247,12 +375,15 @@ def make_thidua_progress_row(idx, name, con_lai_str, ht, unit, mt_ngay_str=None)
 
 def build_luyke_flex():
     data = get_dashboard_data("Config_ThiDua,Data_BI,Data_ThiDua")
+    now = _now()
+    return _render_cached("luyke", (_fingerprint(data), _date_bucket(now)), now,
+                          lambda n: _render_luyke_flex(data, n))
+
+def _render_luyke_flex(data, now):
     bi_rows = data.get("Data_BI", [])
     config_rows = data.get("Config_ThiDua", [])
     td_rows = data.get("Data_ThiDua", [])
     
-    tz = pytz.timezone('Asia/Ho_Chi_Minh')
-    now = datetime.now(tz)
     now_str = now.strftime("%H:%M - %d/%m/%Y")
     
     tDT = 0.0
@@ -261,24 +392,38 @@ def build_luyke_flex():
     tDTGoc = 0.0
     tDT_CK_total = 0.0
     parsed_bi = []
+    bi_nums = numeric_columns(
+        bi_rows,
+        dt=("doanh thu quy đổi", "doanh thu"),
+        sl=("số lượng", "quantity"),
+        tg=("target",),
+        dtGoc=("doanh thu",),
+        dtTC=("revenue_installment", "doanh thu trả chậm"),
+    )
+    bi_cols = resolve_columns(
+        bi_rows,
+        nganh=("nhóm ngành hàng", "ngành hàng", "salegroupmastername"),
+        ck_rate=("rev_kft_riserate_lastmonth", "+/- dtck", "+/- so với ck"),
+        dt_ck=("DT Năm ngoái", "doanh thu năm ngoái", "dt năm ngoái", "năm ngoái", "nam ngoai", "doanh thu nam ngoai", "dt nam ngoai", "doanh thu năm ngoái (cùng kỳ)", "doanh thu nam ngoai (cung ky)", "cùng kỳ", "cung ky", "tháng trước", "dt tháng trước"),
+    )
     
-    for b in bi_rows:
-        nganh = get_key_val(b, "nhóm ngành hàng", "ngành hàng", "salegroupmastername", default=None)
+    for i, b in enumerate(bi_rows):
+        nganh = b.get(bi_cols["nganh"])
         if not nganh or str(nganh).strip().upper() == "N/A":
             continue
             
-        dt = parse_number(get_key_val(b, "doanh thu quy đổi", "doanh thu", default=0.0))
-        sl = parse_number(get_key_val(b, "số lượng", "quantity", default=0.0))
-        tg = parse_number(get_key_val(b, "target", default=0.0))
-        dtGoc = parse_number(get_key_val(b, "doanh thu", default=0.0))
-        dtTC = parse_number(get_key_val(b, "revenue_installment", "doanh thu trả chậm", default=0.0))
+        dt = bi_nums["dt"][i]
+        sl = bi_nums["sl"][i]
+        tg = bi_nums["tg"][i]
+        dtGoc = bi_nums["dtGoc"][i]
+        dtTC = bi_nums["dtTC"][i]
         
         tDT += dt
         tTG += tg
         tTC += dtTC
         tDTGoc += dtGoc
 
-        raw_ck_val = get_key_val(b, "rev_kft_riserate_lastmonth", "+/- dtck", "+/- so với ck", default=None)
+        raw_ck_val = b.get(bi_cols["ck_rate"])
         dt_ck = 0.0
         tang_giam_ck = 0.0
         if raw_ck_val is not None and str(raw_ck_val).strip() != "":
@@ -286,7 +431,7 @@ def build_luyke_flex():
             if (1 + tang_giam_ck / 100.0) != 0:
                 dt_ck = dt / (1 + tang_giam_ck / 100.0)
         else:
-            dt_ck = parse_number(get_key_val(b, "DT Năm ngoái", "doanh thu năm ngoái", "dt năm ngoái", "năm ngoái", "nam ngoai", "doanh thu nam ngoai", "dt nam ngoai", "doanh thu năm ngoái (cùng kỳ)", "doanh thu nam ngoai (cung ky)", "cùng kỳ", "cung ky", "tháng trước", "dt tháng trước", default=0.0))
+            dt_ck = parse_number(b.get(bi_cols["dt_ck"], 0.0))
             if dt_ck > 0:
                 tang_giam_ck = ((dt - dt_ck) / dt_ck) * 100.0
 
@@ -324,10 +469,11 @@ def build_luyke_flex():
 
     holiday_target = 0.0
     if config_rows:
+        cfg_cols = resolve_columns(config_rows, day=("ngày", "Ngày"), target=("Mục tiêu", "mục tiêu ngày", "mục tiêu"))
         for r in config_rows:
-            day_val = parse_number(get_key_val(r, "ngày", "Ngày", default=0.0))
+            day_val = parse_number(r.get(cfg_cols["day"], 0.0))
             if int(day_val) == current_day:
-                holiday_target = parse_number(get_key_val(r, "Mục tiêu", "mục tiêu ngày", "mục tiêu", default=0.0))
+                holiday_target = parse_number(r.get(cfg_cols["target"], 0.0))
                 if holiday_target > 0:
                     break
 
@@ -345,28 +491,36 @@ def build_luyke_flex():
     status_badge_text = "🟢 Đang đúng tiến độ" if is_on_track else "🔴 Cần tăng tốc"
 
     config_map = {}
+    map_cols = resolve_columns(config_rows, ten=("ngành hàng", "nhóm ngành hàng"), phan_loai=("phân loại", "loại"))
     for c in config_rows:
-        ten = get_key_val(c, "ngành hàng", "nhóm ngành hàng", default=None)
-        phan_loai = parse_number(get_key_val(c, "phân loại", "loại", default=0.0))
+        ten = c.get(map_cols["ten"])
+        phan_loai = parse_number(c.get(map_cols["phan_loai"], 0.0))
         if ten:
             config_map[str(ten).lower().strip()] = phan_loai
 
     parsed_td = []
     cnt_dk = 0
+    td_cols = resolve_columns(
+        td_rows,
+        nganh=("maingroupname", "main group name", "nhóm ngành hàng", "nhóm ngành hàng chính"),
+        tg=("target", "mục tiêu"),
+        sl=("số lượng", "quantity"),
+        dt=("doanh thu",),
+    )
     for r in td_rows:
-        nganh = get_key_val(r, "maingroupname", "main group name", "nhóm ngành hàng", "nhóm ngành hàng chính", default=None)
+        nganh = r.get(td_cols["nganh"])
         if not nganh or str(nganh).strip().upper() == "N/A":
             continue
         nganh_clean = str(nganh).lower().strip()
         if config_map and config_map.get(nganh_clean, 0.0) == 0.0:
             continue
             
-        tg = parse_number(get_key_val(r, "target", "mục tiêu", default=0.0))
+        tg = parse_number(r.get(td_cols["tg"], 0.0))
         if tg <= 0:
             continue
             
-        sl = parse_number(get_key_val(r, "số lượng", "quantity", default=0.0))
-        dt = parse_number(get_key_val(r, "doanh thu", default=0.0))
+        sl = parse_number(r.get(td_cols["sl"], 0.0))
+        dt = parse_number(r.get(td_cols["dt"], 0.0))
         
         is_dt = False
         if dt > 0 and (sl == 0 or abs((dt / tg) - 1) < abs((sl / tg) - 1)):
@@ -1249,8 +1403,86 @@ def build_individual_staff_card(e, rank, total_emp=11, now_str="", thi_dua_list=
     }
     return bubble
 
-def build_nhanvien_flex():
+def fold_name(text):
+    """Chuẩn hóa tên để tra cứu: bỏ dấu tiếng Việt, viết hoa, gộp khoảng trắng ("Dương" -> "DUONG")."""
+    decomposed = unicodedata.normalize('NFD', str(text or ""))
+    stripped = "".join(ch for ch in decomposed if unicodedata.category(ch) != 'Mn')
+    return " ".join(stripped.replace("đ", "d").replace("Đ", "D").upper().split())
+
+def build_staff_index(emp_list):
+    """
+    Chỉ mục tra cứu NV theo thứ hạng (đánh số từ 1):
+    - user_ids: mã User (viết hoa) -> hạng
+    - names: mọi tiền tố của tên đã bỏ dấu, tính từ từng chữ trong tên -> các hạng
+      (nên "duong", "van d", "nguyen van" đều khớp "Nguyễn Văn Dương")
+    """
+    user_ids = {}
+    names = {}
+    for rank, e in enumerate(emp_list, start=1):
+        user_id = str(e.get("user_id", "")).strip().upper()
+        if user_id and user_id != "NV":
+            user_ids.setdefault(user_id, rank)
+        words = fold_name(e.get("name", "")).split()
+        for start in range(len(words)):
+            tail = " ".join(words[start:])
+            for end in range(1, len(tail) + 1):
+                ranks = names.setdefault(tail[:end], [])
+                if rank not in ranks:
+                    ranks.append(rank)
+    return {"user_ids": user_ids, "names": names, "total": len(emp_list)}
+
+def find_staff_rank(staff_index, query):
+    """Tìm hạng của NV theo mã User, tiền tố tên (không dấu) hoặc số thứ hạng; không thấy trả về None."""
+    q = str(query or "").strip()
+    if not q:
+        return None
+    rank = staff_index["user_ids"].get(q.upper())
+    if rank:
+        return rank
+    ranks = staff_index["names"].get(fold_name(q))
+    if ranks:
+        return ranks[0]
+    if q.isdigit() and 1 <= int(q) <= staff_index["total"]:
+        return int(q)
+    return None
+
+# Các trang thẻ KPI của lệnh NV0/NV1/NV2: (vị trí đầu, vị trí cuối) trong danh sách đã xếp hạng
+NHANVIEN_PAGES = {'nv0': (0, 6), 'nv1': (6, 16), 'nv2': (16, 26)}
+
+def build_nhanvien_report():
+    """
+    Báo cáo NV đã xếp hạng (chưa vẽ thẻ KPI): {"overview": bubble BXH, "staff": [dữ liệu NV theo hạng],
+    "staff_index": chỉ mục tra cứu (xem build_staff_index)}. Thẻ KPI vẽ theo trang bằng render_staff_cards.
+    """
     data = get_dashboard_data("Config_ThiDua,Data_NV_BI,Data_BI,Data_Realtime_NV,Data_NV_ThiDua,Data_ThiDua")
+    lock_config = get_locked_target_config()
+    now = _now()
+    cache_key = (_fingerprint(data, lock_config), _date_bucket(now))
+    report = _render_cached("nhanvien", cache_key, now, lambda n: _render_nhanvien_report(data, lock_config, n))
+    report["cache_key"] = cache_key
+    return report
+
+def render_staff_cards(report, start=0, end=None):
+    """Vẽ (có nhớ đệm theo từng hạng) thẻ KPI của các NV trong report["staff"][start:end]."""
+    staff = report["staff"]
+    total_emp = len(staff)
+    now = _now()
+    now_str = now.strftime("%H:%M - %d/%m/%Y")
+    start, end, _ = slice(start, end).indices(total_emp)
+    cards = []
+    for idx in range(start + 1, end + 1):
+        e = staff[idx - 1]
+        cards.append(_render_cached(
+            "nhanvien_card", (report["cache_key"], idx), now,
+            lambda n, e=e, idx=idx: build_individual_staff_card(e, idx, total_emp, now_str, thi_dua_list=e.get("thi_dua_list"))
+        ))
+    return cards
+
+def build_nhanvien_flex():
+    report = build_nhanvien_report()
+    return [report["overview"]] + render_staff_cards(report)
+
+def _render_nhanvien_report(data, lock_config, now):
     config_rows = data.get("Config_ThiDua", [])
     bi_rows = data.get("Data_BI", [])
     nv_rows = data.get("Data_NV_BI", [])
@@ -1260,23 +1492,23 @@ def build_nhanvien_flex():
     td_store_rows = data.get("Data_ThiDua", [])
     nv_td_rows = data.get("Data_NV_ThiDua", [])
         
-    tz = pytz.timezone('Asia/Ho_Chi_Minh')
-    now = datetime.now(tz)
     now_str = now.strftime("%H:%M - %d/%m/%Y")
     
     current_day = now.day
     days_in_month = (datetime(now.year, now.month + 1, 1) - datetime(now.year, now.month, 1)).days if now.month < 12 else 31
     days_passed = days_in_month if current_day == 1 else current_day - 1
     
-    tDT = sum(parse_number(get_key_val(b, "Doanh thu Quy đổi", "Doanh thu", default=0.0)) for b in bi_rows if get_key_val(b, "nhóm ngành hàng", default="") != "N/A")
-    total_target = sum(parse_number(get_key_val(b, "Target", "target", default=0.0)) for b in bi_rows if get_key_val(b, "nhóm ngành hàng", default="") != "N/A")
+    bi_nums = numeric_columns(bi_rows, dt=("Doanh thu Quy đổi", "Doanh thu"), tg=("Target", "target"))
+    bi_nganh_key = resolve_columns(bi_rows, nganh=("nhóm ngành hàng",))["nganh"]
+    bi_valid = [not isinstance(b, dict) or b.get(bi_nganh_key, "") != "N/A" for b in bi_rows]
+    tDT = sum(v for v, ok in zip(bi_nums["dt"], bi_valid) if ok)
+    total_target = sum(v for v, ok in zip(bi_nums["tg"], bi_valid) if ok)
     if total_target <= 0:
         total_target = 1500.0
         
     emp_targets = {}
     active_staff_names = {}
     
-    lock_config = get_locked_target_config()
     if lock_config and lock_config.get("is_locked") and lock_config.get("staff"):
         locked_staff = lock_config.get("staff", [])
         initial_ratios = {}
@@ -1303,42 +1535,56 @@ def build_nhanvien_flex():
             emp_targets[raw_name] = norm_ratio * total_target
             
     if not emp_targets and config_rows:
+        cfg_cols = resolve_columns(
+            config_rows,
+            user=("user", "User"),
+            name=("user-họ và tên", "Họ và tên", "tên nhân viên"),
+            pct=("tỷ lệ %", "% chia"),
+        )
         for r in config_rows:
-            user_id = get_key_val(r, "user", "User", default=None)
+            user_id = r.get(cfg_cols["user"])
             if not user_id or str(user_id).strip() == "":
                 continue
                 
-            emp_name = get_key_val(r, "user-họ và tên", "Họ và tên", "tên nhân viên", default=None)
+            emp_name = r.get(cfg_cols["name"])
             if not emp_name:
                 continue
             emp_name_str = str(emp_name).strip()
             
-            pct = parse_number(get_key_val(r, "tỷ lệ %", "% chia", default=0.0))
+            pct = parse_number(r.get(cfg_cols["pct"], 0.0))
             ratio = pct if pct <= 1.0 else pct / 100.0
             
             emp_targets[emp_name_str] = ratio * total_target
             active_staff_names[emp_name_str.upper()] = {"name": emp_name_str, "user_id": str(user_id).strip(), "ratio": ratio}
 
     emp_actuals = {}
-    for r in nv_rows:
-        name = get_key_val(r, "staffUserName", "tên nv", "Họ và tên", "user", "mã nv", default=None)
+    nv_actuals = numeric_columns(nv_rows, actual=("Doanh thu Quy đổi", "Doanh thu", "Value_Compe"))["actual"]
+    nv_name_key = resolve_columns(nv_rows, name=("staffUserName", "tên nv", "Họ và tên", "user", "mã nv"))["name"]
+    for r, actual in zip(nv_rows, nv_actuals):
+        name = r.get(nv_name_key)
         if not name: 
             continue
-        name_str = str(name).strip()
-        actual = parse_number(get_key_val(r, "Doanh thu Quy đổi", "Doanh thu", "Value_Compe", default=0.0))
-        emp_actuals[name_str] = emp_actuals.get(name_str, 0.0) + actual
+        # Gộp theo tên viết hoa để mỗi NV chỉ cần một phép tra
+        name_upper = str(name).strip().upper()
+        emp_actuals[name_upper] = emp_actuals.get(name_upper, 0.0) + actual
 
     config_map = {}
+    map_cols = resolve_columns(config_rows, ten=("ngành hàng", "nhóm ngành hàng"), phan_loai=("phân loại", "loại"))
     for c in config_rows:
-        ten = get_key_val(c, "ngành hàng", "nhóm ngành hàng", default=None)
-        phan_loai = parse_number(get_key_val(c, "phân loại", "loại", default=0.0))
+        ten = c.get(map_cols["ten"])
+        phan_loai = parse_number(c.get(map_cols["phan_loai"], 0.0))
         if ten:
             config_map[str(ten).lower().strip()] = phan_loai
 
     # Ngành Hàng Thi Đua Map từ Data_ThiDua và Data_NV_ThiDua theo Config_ThiDua
     store_cat_targets = {}
+    td_cols = resolve_columns(
+        td_store_rows,
+        nganh=("maingroupname", "main group name", "nhóm ngành hàng", "nhóm ngành hàng chính", "programname"),
+        tg=("target", "mục tiêu"),
+    )
     for r in td_store_rows:
-        nganh = get_key_val(r, "maingroupname", "main group name", "nhóm ngành hàng", "nhóm ngành hàng chính", "programname", default=None)
+        nganh = r.get(td_cols["nganh"])
         if not nganh or str(nganh).strip() == "" or str(nganh).strip() == "N/A":
             continue
         nganh_str = str(nganh).strip()
@@ -1346,23 +1592,29 @@ def build_nhanvien_flex():
         if config_map and config_map.get(nganh_clean, 0.0) == 0.0:
             continue
 
-        tg = parse_number(get_key_val(r, "target", "mục tiêu", default=0.0))
+        tg = parse_number(r.get(td_cols["tg"], 0.0))
         if tg <= 0:
             continue
         if nganh_clean not in store_cat_targets:
             store_cat_targets[nganh_clean] = {"name": nganh_str, "store_target": tg}
 
+    # Ma trận thực hiện thi đua: mã/tên NV (viết hoa) -> {ngành hàng: thực hiện}
     nv_td_actuals = {}
-    for r in nv_td_rows:
-        user = get_key_val(r, "staffuser", "user", "mã nv", "employeeid", default=None)
-        nganh = get_key_val(r, "programname", "nhóm ngành hàng", "nhóm ngành hàng chính", default=None)
+    nv_td_nums = numeric_columns(nv_td_rows, actual=("value_compe", "thực hiện", "đã bán"))["actual"]
+    nv_td_cols = resolve_columns(
+        nv_td_rows,
+        user=("staffuser", "user", "mã nv", "employeeid"),
+        nganh=("programname", "nhóm ngành hàng", "nhóm ngành hàng chính"),
+    )
+    for r, actual in zip(nv_td_rows, nv_td_nums):
+        user = r.get(nv_td_cols["user"])
+        nganh = r.get(nv_td_cols["nganh"])
         if not user or not nganh:
             continue
         user_clean = str(user).strip().upper()
         nganh_clean = str(nganh).strip().lower()
-        actual = parse_number(get_key_val(r, "value_compe", "thực hiện", "đã bán", default=0.0))
-        key = (user_clean, nganh_clean)
-        nv_td_actuals[key] = nv_td_actuals.get(key, 0.0) + actual
+        staff_row = nv_td_actuals.setdefault(user_clean, {})
+        staff_row[nganh_clean] = staff_row.get(nganh_clean, 0.0) + actual
 
     emp_list = []
     processed_upper = set()
@@ -1375,10 +1627,9 @@ def build_nhanvien_flex():
             continue
         processed_upper.add(clean_name.upper())
         
-        actual = 0.0
-        for act_name, val in emp_actuals.items():
-            if act_name.upper() == staff_upper or act_name.upper() == clean_name.upper():
-                actual += val
+        actual = emp_actuals.get(staff_upper, 0.0)
+        if clean_name.upper() != staff_upper:
+            actual += emp_actuals.get(clean_name.upper(), 0.0)
                 
         target = emp_targets.get(clean_name, 0.0)
         pct_ht = (actual / target * 100.0) if target > 0 else 0.0
@@ -1397,14 +1648,15 @@ def build_nhanvien_flex():
         count_nh_du_kien = 0
 
         if store_cat_targets:
+            # Dòng thực hiện của NV: ưu tiên theo mã NV, ngành nào bằng 0 thì lấy theo tên
+            acts_by_id = nv_td_actuals.get(user_id.upper(), {})
+            acts_by_name = nv_td_actuals.get(clean_name.upper(), {})
             for cat_clean, cat_info in store_cat_targets.items():
                 cat_name = cat_info["name"]
                 cat_store_tg = cat_info["store_target"]
                 staff_cat_tg = max(1.0, round(cat_store_tg * ratio))
                 
-                staff_cat_act = nv_td_actuals.get((user_id.upper(), cat_clean), 0.0)
-                if staff_cat_act == 0.0:
-                    staff_cat_act = nv_td_actuals.get((clean_name.upper(), cat_clean), 0.0)
+                staff_cat_act = acts_by_id.get(cat_clean, 0.0) or acts_by_name.get(cat_clean, 0.0)
                     
                 con_lai = max(0.0, staff_cat_tg - staff_cat_act)
                 ht_val = (staff_cat_act / staff_cat_tg * 100.0) if staff_cat_tg > 0 else 0.0
@@ -1448,29 +1700,31 @@ def build_nhanvien_flex():
     # 1. Bubble 1: Bảng Xếp Hạng NV Overview
     overview_bubble = build_leaderboard_overview_bubble(emp_list, now_str)
     
-    # 2. Bubbles 2..N: Thẻ KPI Chi Tiết Từng NV (Truyền 23 ngành hàng thi đua)
-    all_bubbles = [overview_bubble]
-    total_emp = len(emp_list)
-    for idx, e in enumerate(emp_list, start=1):
-        staff_bubble = build_individual_staff_card(e, idx, total_emp, now_str, thi_dua_list=e.get("thi_dua_list"))
-        all_bubbles.append(staff_bubble)
-        
-    return all_bubbles
+    # 2. Thẻ KPI Chi Tiết Từng NV (23 ngành hàng thi đua) chỉ vẽ khi cần, xem render_staff_cards
+    return {
+        "overview": overview_bubble,
+        "staff": emp_list,
+        "staff_index": build_staff_index(emp_list)
+    }
 
 def build_realtime_flex():
     data = get_dashboard_data("Data_BI,Data_ThiDua,Config_ThiDua,Data_Realtime_BI,Data_Realtime_ThiDua,Data_Realtime_NV")
+    now = _now()
+    return _render_cached("realtime", (_fingerprint(data), _date_bucket(now), now.strftime("%H:%M")), now,
+                          lambda n: _render_realtime_flex(data, n))
+
+def _render_realtime_flex(data, now):
     config_rows = data.get("Config_ThiDua", [])
     bi_rows = data.get("Data_BI", [])
     rt_rows = data.get("Data_Realtime_BI", [])
     rt_td_rows = data.get("Data_Realtime_ThiDua", [])
     td_rows = data.get("Data_ThiDua", [])
     
-    tz = pytz.timezone('Asia/Ho_Chi_Minh')
-    now = datetime.now(tz)
     now_str = now.strftime("%H:%M - %d/%m/%Y")
     
-    lk_tDT = sum(parse_number(get_key_val(b, "Doanh thu Quy đổi", "Doanh thu", default=0.0)) for b in bi_rows)
-    lk_tTG = sum(parse_number(get_key_val(b, "Target", "target", default=0.0)) for b in bi_rows)
+    bi_nums = numeric_columns(bi_rows, dt=("Doanh thu Quy đổi", "Doanh thu"), tg=("Target", "target"))
+    lk_tDT = sum(bi_nums["dt"])
+    lk_tTG = sum(bi_nums["tg"])
     if lk_tTG <= 0:
         lk_tTG = 1500.0
         
@@ -1488,14 +1742,21 @@ def build_realtime_flex():
     holiday_target = 0.0
     user_map = {}
     if config_rows:
+        cfg_cols = resolve_columns(
+            config_rows,
+            day=("ngày", "Ngày"),
+            target=("Mục tiêu", "mục tiêu ngày", "mục tiêu"),
+            user=("user",),
+            pct=("tỷ lệ %", "% chia"),
+        )
         for r in config_rows:
-            day_val = parse_number(get_key_val(r, "ngày", "Ngày", default=0.0))
+            day_val = parse_number(r.get(cfg_cols["day"], 0.0))
             if int(day_val) == current_day:
-                holiday_target = parse_number(get_key_val(r, "Mục tiêu", "mục tiêu ngày", "mục tiêu", default=0.0))
+                holiday_target = parse_number(r.get(cfg_cols["target"], 0.0))
             
-            user_id = get_key_val(r, "user")
+            user_id = r.get(cfg_cols["user"])
             if user_id and str(user_id).strip():
-                percent = parse_number(get_key_val(r, "tỷ lệ %", "% chia", default=0.0))
+                percent = parse_number(r.get(cfg_cols["pct"], 0.0))
                 ratio = percent if percent <= 1 else percent / 100.0
                 user_map[str(user_id).strip()] = ratio
         
@@ -1510,26 +1771,39 @@ def build_realtime_flex():
     rt_tSL = 0.0
     rt_tTarget = 0.0
     parsed_rt_bi = []
+    rt_cols = resolve_columns(
+        rt_rows,
+        nganh=("Nhóm Ngành Hàng", "nhóm ngành hàng", "Ngành hàng", "salegroupmastername"),
+        dt_kf=("revenue_KFactor_RT",),
+        dt_rt=("revenue_RT",),
+        dt=("Doanh thu", "doanh thu quy đổi"),
+        sl_rt=("quantity_RT",),
+        sl_kf=("quantity_KFactor",),
+        sl=("số lượng",),
+        tg_ave=("revenue_KFactor_AVEDay",),
+        tg_day=("target_Day",),
+        dtTC=("revenue_Installment",),
+    )
     
     for r in rt_rows:
-        nganh = get_key_val(r, "Nhóm Ngành Hàng", "nhóm ngành hàng", "Ngành hàng", "salegroupmastername", default=None)
+        nganh = r.get(rt_cols["nganh"])
         if not nganh or str(nganh).strip().upper() == "N/A":
             continue
         dtqd = max(
-            parse_number(get_key_val(r, "revenue_KFactor_RT")),
-            parse_number(get_key_val(r, "revenue_RT")),
-            parse_number(get_key_val(r, "Doanh thu", "doanh thu quy đổi"))
+            parse_number(r.get(rt_cols["dt_kf"])),
+            parse_number(r.get(rt_cols["dt_rt"])),
+            parse_number(r.get(rt_cols["dt"]))
         )
         sl = max(
-            parse_number(get_key_val(r, "quantity_RT")),
-            parse_number(get_key_val(r, "quantity_KFactor")),
-            parse_number(get_key_val(r, "số lượng"))
+            parse_number(r.get(rt_cols["sl_rt"])),
+            parse_number(r.get(rt_cols["sl_kf"])),
+            parse_number(r.get(rt_cols["sl"]))
         )
         targetDay = max(
-            parse_number(get_key_val(r, "revenue_KFactor_AVEDay")),
-            parse_number(get_key_val(r, "target_Day"))
+            parse_number(r.get(rt_cols["tg_ave"])),
+            parse_number(r.get(rt_cols["tg_day"]))
         )
-        dtTC = parse_number(get_key_val(r, "revenue_Installment"))
+        dtTC = parse_number(r.get(rt_cols["dtTC"]))
         
         rt_total += dtqd
         rt_tTC += dtTC
@@ -1565,14 +1839,21 @@ def build_realtime_flex():
     bi_map = {x["name"].lower().strip(): x["dt"] for x in parsed_rt_bi}
     
     thi_dua_luy_ke = {}
+    td_cols = resolve_columns(
+        td_rows,
+        nganh=("maingroupname", "main group name", "nhóm ngành hàng"),
+        tg=("target", "mục tiêu"),
+        sl=("số lượng",),
+        dt=("doanh thu",),
+    )
     for r in td_rows:
-        nganh = get_key_val(r, "maingroupname", "main group name", "nhóm ngành hàng", default=None)
+        nganh = r.get(td_cols["nganh"])
         if not nganh or str(nganh).strip().upper() == "N/A":
             continue
         nganh_clean = str(nganh).lower().strip()
-        tg = parse_number(get_key_val(r, "target", "mục tiêu", default=0.0))
-        sl = parse_number(get_key_val(r, "số lượng", default=0.0))
-        dt = parse_number(get_key_val(r, "doanh thu", default=0.0))
+        tg = parse_number(r.get(td_cols["tg"], 0.0))
+        sl = parse_number(r.get(td_cols["sl"], 0.0))
+        dt = parse_number(r.get(td_cols["dt"], 0.0))
         
         is_dt = False
         if nganh_clean == "điện tử tcl" or tg > 150.0:
@@ -1590,16 +1871,28 @@ def build_realtime_flex():
         }
 
     config_map = {}
+    map_cols = resolve_columns(config_rows, ten=("ngành hàng", "nhóm ngành hàng"), phan_loai=("phân loại", "loại"))
     for c in config_rows:
-        ten = get_key_val(c, "ngành hàng", "nhóm ngành hàng", default=None)
-        phan_loai = parse_number(get_key_val(c, "phân loại", "loại", default=0.0))
+        ten = c.get(map_cols["ten"])
+        phan_loai = parse_number(c.get(map_cols["phan_loai"], 0.0))
         if ten:
             config_map[str(ten).lower().strip()] = phan_loai
 
     parsed_td = []
     rt_cntVD = 0
+    rt_td_cols = resolve_columns(
+        rt_td_rows,
+        nganh=("maingroupname", "main group name", "nhóm ngành hàng"),
+        dt_rt=("revenue_RT",),
+        dt_kf=("revenue_KFactor_RT",),
+        dt=("doanh thu",),
+        sl_rt=("quantity_RT",),
+        sl_kf=("quantity_KFactor",),
+        sl=("số lượng",),
+        tg_day=("target_Day",),
+    )
     for r in rt_td_rows:
-        nganh = get_key_val(r, "maingroupname", "main group name", "nhóm ngành hàng", default=None)
+        nganh = r.get(rt_td_cols["nganh"])
         if not nganh or str(nganh).strip().upper() == "N/A":
             continue
         nganh_clean = str(nganh).lower().strip()
@@ -1608,9 +1901,9 @@ def build_realtime_flex():
             
         lk_info = thi_dua_luy_ke.get(nganh_clean, {"mt_ngay": 0.0, "is_dt": False, "target_thang": 0.0, "lk_thuc_hien": 0.0})
         
-        rt_dt = max(bi_map.get(nganh_clean, 0.0), parse_number(get_key_val(r, "revenue_RT")), parse_number(get_key_val(r, "revenue_KFactor_RT")), parse_number(get_key_val(r, "doanh thu")))
-        rt_sl = max(parse_number(get_key_val(r, "quantity_RT")), parse_number(get_key_val(r, "quantity_KFactor")), parse_number(get_key_val(r, "số lượng")))
-        target_day = parse_number(get_key_val(r, "target_Day"))
+        rt_dt = max(bi_map.get(nganh_clean, 0.0), parse_number(r.get(rt_td_cols["dt_rt"])), parse_number(r.get(rt_td_cols["dt_kf"])), parse_number(r.get(rt_td_cols["dt"])))
+        rt_sl = max(parse_number(r.get(rt_td_cols["sl_rt"])), parse_number(r.get(rt_td_cols["sl_kf"])), parse_number(r.get(rt_td_cols["sl"])))
+        target_day = parse_number(r.get(rt_td_cols["tg_day"]))
         
         if not lk_info["is_dt"]:
             if target_day > 0:
@@ -1828,11 +2121,18 @@ def build_realtime_flex():
     data_rt_nv = data.get("Data_Realtime_NV", [])
     if data_rt_nv and isinstance(data_rt_nv, list) and len(data_rt_nv) > 0:
         parsed_nv_rt = []
+        nv_cols = resolve_columns(
+            data_rt_nv,
+            m_nv=("mã nv", "ma_nv", "user"),
+            t_nv=("tên nv", "ten_nv", "employeeName"),
+            dt=("doanh thu", "revenue"),
+            sl=("số lượng", "soluong", "quantity", "quantity_RT"),
+        )
         for row in data_rt_nv:
-            m_nv = str(get_key_val(row, "mã nv", "ma_nv", "user", default="")).strip()
-            t_nv = get_key_val(row, "tên nv", "ten_nv", "employeeName", default="") or ""
-            dt_nv = parse_number(get_key_val(row, "doanh thu", "revenue", default=0))
-            sl_nv = parse_number(get_key_val(row, "số lượng", "soluong", "quantity", "quantity_RT", default=0))
+            m_nv = str(row.get(nv_cols["m_nv"], "")).strip()
+            t_nv = row.get(nv_cols["t_nv"], "") or ""
+            dt_nv = parse_number(row.get(nv_cols["dt"], 0))
+            sl_nv = parse_number(row.get(nv_cols["sl"], 0))
             if dt_nv != 0 or sl_nv != 0:
                 ratio = 0.0
                 if 'user_map' in locals() and m_nv in user_map:
@@ -0,0 +1,98 @@
+import os
+import queue
+import threading
+import time
+import collections
+
+# --- HÀNG ĐỢI XỬ LÝ SỰ KIỆN WEBHOOK ---
+# /callback chỉ xác thực chữ ký rồi đẩy sự kiện vào đây và trả 200 ngay, để
+# LINE không phải chờ các lượt gọi Sheets/profile (và không gửi lại webhook).
+# Một nhóm luồng cố định (WEBHOOK_WORKERS) lấy sự kiện ra xử lý. Hàng đợi có
+# giới hạn (WEBHOOK_QUEUE_MAX); khi đầy thì xử lý luôn trong request để không
+# bỏ sót sự kiện.
+
+WORKER_COUNT = int(os.environ.get('WEBHOOK_WORKERS', '4'))
+QUEUE_MAX = int(os.environ.get('WEBHOOK_QUEUE_MAX', '200'))
+LATENCY_SAMPLES = 500
+
+_queue = queue.Queue(maxsize=QUEUE_MAX)
+_lock = threading.Lock()
+_workers = []
+_wait_ms = collections.deque(maxlen=LATENCY_SAMPLES)
+_handle_ms = collections.deque(maxlen=LATENCY_SAMPLES)
+_stats = {'submitted': 0, 'processed': 0, 'errors': 0, 'inline': 0, 'max_depth': 0}
+
+
+def _ensure_workers():
+    # Khởi động luồng khi có sự kiện đầu tiên (sau khi gunicorn đã fork worker)
+    with _lock:
+        _workers[:] = [w for w in _workers if w.is_alive()]
+        for i in range(len(_workers), WORKER_COUNT):
+            worker = threading.Thread(target=_run, name=f'webhook-worker-{i}', daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+
+def _run():
+    while True:
+        func, event, enqueued_at = _queue.get()
+        try:
+            _process(func, event, enqueued_at)
+        finally:
+            _queue.task_done()
+
+
+def _process(func, event, enqueued_at):
+    started = time.time()
+    try:
+        func(event)
+    except Exception as e:
+        with _lock:
+            _stats['errors'] += 1
+        print(f"Lỗi khi xử lý sự kiện webhook {type(event).__name__}: {repr(e)}")
+    finally:
+        finished = time.time()
+        with _lock:
+            _stats['processed'] += 1
+            _wait_ms.append((started - enqueued_at) * 1000)
+            _handle_ms.append((finished - started) * 1000)
+
+
+def submit(func, event):
+    """Đưa một sự kiện vào hàng đợi; nếu hàng đợi đầy thì xử lý ngay tại chỗ."""
+    _ensure_workers()
+    enqueued_at = time.time()
+    with _lock:
+        _stats['submitted'] += 1
+    try:
+        _queue.put_nowait((func, event, enqueued_at))
+    except queue.Full:
+        with _lock:
+            _stats['inline'] += 1
+        print("Hàng đợi webhook đầy, xử lý sự kiện ngay trong request.")
+        _process(func, event, enqueued_at)
+        return
+    with _lock:
+        _stats['max_depth'] = max(_stats['max_depth'], _queue.qsize())
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return round(ordered[index], 1)
+
+
+def get_queue_stats():
+    with _lock:
+        return dict(
+            _stats,
+            depth=_queue.qsize(),
+            workers=sum(1 for w in _workers if w.is_alive()),
+            queue_max=QUEUE_MAX,
+            wait_ms_p50=_percentile(_wait_ms, 50),
+            wait_ms_p95=_percentile(_wait_ms, 95),
+            handle_ms_p50=_percentile(_handle_ms, 50),
+            handle_ms_p95=_percentile(_handle_ms, 95),
+        )
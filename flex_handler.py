@@ -1,7 +1,12 @@
+import os
+import time
 from datetime import datetime
 import pytz
+import threading
 # Import từ file cấu hình trung tâm
-from config import CLIENT, SHEET_NAME, WORKSHEET_TRACKER_NAME, get_spreadsheet
+from config import WORKSHEET_TRACKER_NAME, WORKSHEET_ADHOC_TASKS, WORKSHEET_GROUP_MEMBERS
+import sheet_cache
+import write_queue
 
 # --- Danh sách công việc ---
 TASKS = {
@@ -33,72 +38,96 @@ TASKS = {
     ]
 }
 
+def tracker_row_key(row):
+    """Khóa chỉ mục của một dòng task_tracker: (group_id, date, task_id)."""
+    return (str(row[0]), str(row[1]), str(row[2]))
+
+# Các ca đã khởi tạo trong ngày (date, group_id, shift_type) để khỏi phải đọc lại sheet
+_initialized_shifts = set()
+_tracker_init_lock = threading.Lock()
+
 def initialize_daily_tasks(group_id, shift_type, force=False):
     """
     Reset và khởi tạo lại danh sách công việc cho ca cụ thể.
     Giữ lại các ca khác của ngày hôm nay và xóa các dữ liệu cũ.
     Nếu force=False, sẽ chỉ khởi tạo nếu hôm nay chưa có dữ liệu cho ca này.
+
+    Chạy theo kiểu tăng dần: chỉ đọc 3 cột khóa (A:C), xóa đúng các khoảng dòng
+    cũ trong một lệnh và nối thêm dòng của ca mới, không clear toàn bộ sheet.
     """
     print(f"Bắt đầu khởi tạo công việc ca {shift_type} cho group {group_id} (force={force})...")
+    tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
+    today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
+    marker = (today_str, str(group_id), shift_type)
+
+    if not force and marker in _initialized_shifts:
+        print(f"Ca {shift_type} đã được khởi tạo hôm nay cho group {group_id}. Bỏ qua.")
+        return True
+
     try:
-        sheet = get_spreadsheet().worksheet(WORKSHEET_TRACKER_NAME)
-        all_values = sheet.get_all_values()
-        
-        headers = ['group_id', 'date', 'task_id', 'name', 'time', 'status', 'user_name']
-        tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
-        today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
-        
-        # Kiểm tra xem ca này hôm nay đã có dữ liệu chưa
-        has_today_tasks = False
-        rows_to_keep = []
-        
-        if all_values:
-            headers = all_values[0]
-            for row in all_values[1:]:
-                if len(row) < 3: continue
+        with _tracker_init_lock:
+            key_rows = sheet_cache.get_range(WORKSHEET_TRACKER_NAME, 'A:C')
+            
+            # Kiểm tra xem ca này hôm nay đã có dữ liệu chưa
+            has_today_tasks = False
+            rows_to_delete = []
+            
+            for row_number, row in enumerate(key_rows[1:], start=2):
+                row = list(row) + [''] * (3 - len(row))
                 r_group = str(row[0])
                 r_date = str(row[1])
                 r_task_id = str(row[2])
                 
-                if r_date == today_str and r_group == str(group_id) and r_task_id.startswith(shift_type):
+                # Dòng của những ngày trước (hoặc dòng trống) -> xóa
+                if r_date != today_str:
+                    rows_to_delete.append(row_number)
+                elif r_group == str(group_id) and r_task_id.startswith(shift_type):
                     has_today_tasks = True
-                
-                # Giữ lại các dòng của ngày hôm nay thuộc các ca/group khác
-                if r_date == today_str:
-                    if r_group == str(group_id) and r_task_id.startswith(shift_type):
-                        continue
-                    rows_to_keep.append(row)
-        
-        # Nếu đã có dữ liệu và không yêu cầu force reset, bỏ qua bước khởi tạo lại
-        if has_today_tasks and not force:
-            print(f"Ca {shift_type} đã được khởi tạo hôm nay cho group {group_id}. Bỏ qua.")
-            return True
+                    if force:
+                        rows_to_delete.append(row_number)
             
-        # Ghi đè lại dữ liệu (Clear và Append)
-        sheet.clear()
-        sheet.append_row(headers)
-        if rows_to_keep:
-            sheet.append_rows(rows_to_keep, value_input_option='USER_ENTERED')
+            # Nếu đã có dữ liệu và không yêu cầu force reset, bỏ qua bước khởi tạo lại
+            if has_today_tasks and not force:
+                if rows_to_delete:
+                    sheet_cache.delete_row_ranges(WORKSHEET_TRACKER_NAME, sheet_cache.to_row_ranges(rows_to_delete))
+                _mark_shift_initialized(marker)
+                print(f"Ca {shift_type} đã được khởi tạo hôm nay cho group {group_id}. Bỏ qua.")
+                return True
             
-        # Thêm các task mới của ca này
-        tasks_to_add = []
-        for task in TASKS.get(shift_type, []):
-            new_row = [group_id, today_str, task['id'], task['name'], task['time'], 'incomplete', '']
-            tasks_to_add.append(new_row)
+            if not key_rows:
+                headers = ['group_id', 'date', 'task_id', 'name', 'time', 'status', 'user_name']
+                sheet_cache.append_rows(WORKSHEET_TRACKER_NAME, [headers])
+            
+            # Chỉ xóa các khoảng dòng cần bỏ (dữ liệu cũ + ca bị reset)
+            if rows_to_delete:
+                sheet_cache.delete_row_ranges(WORKSHEET_TRACKER_NAME, sheet_cache.to_row_ranges(rows_to_delete))
+                print(f"Đã xóa {len(rows_to_delete)} dòng cũ khỏi {WORKSHEET_TRACKER_NAME}.")
+                
+            # Thêm các task mới của ca này
+            tasks_to_add = []
+            for task in TASKS.get(shift_type, []):
+                new_row = [group_id, today_str, task['id'], task['name'], task['time'], 'incomplete', '']
+                tasks_to_add.append(new_row)
 
-        if tasks_to_add:
-            sheet.append_rows(tasks_to_add, value_input_option='USER_ENTERED')
-            print(f"Đã khởi tạo mới checklist ca {shift_type} thành công.")
+            if tasks_to_add:
+                sheet_cache.append_rows(WORKSHEET_TRACKER_NAME, tasks_to_add)
+                print(f"Đã khởi tạo mới checklist ca {shift_type} thành công.")
+            _mark_shift_initialized(marker)
         return True
     except Exception as e:
         print(f"Lỗi khi khởi tạo công việc: {e}")
         return False
 
+def _mark_shift_initialized(marker):
+    # Bỏ các đánh dấu của ngày cũ để tập hợp không phình ra
+    for old in [m for m in _initialized_shifts if m[0] != marker[0]]:
+        _initialized_shifts.discard(old)
+    _initialized_shifts.add(marker)
+
 def get_tasks_status_from_sheet(group_id, shift_type, all_records=None):
     try:
         if all_records is None:
-            sheet = get_spreadsheet().worksheet(WORKSHEET_TRACKER_NAME)
-            all_records = sheet.get_all_records()
+            all_records = sheet_cache.get_all_records(WORKSHEET_TRACKER_NAME)
         
         tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
         today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
@@ -413,37 +442,23 @@ def generate_checklist_flex(group_id, shift_type, all_records_prefetched=None):
 # ==========================================
 import uuid
 
-_adhoc_sheet_cache = None
 _last_clean_date = None
 
-def get_or_create_adhoc_worksheet():
+ADHOC_HEADERS = ['group_id', 'date', 'assignee', 'task_id', 'task_name', 'status', 'completed_by', 'completed_at', 'created_at']
+GROUP_MEMBERS_HEADERS = ['group_id', 'user_id', 'display_name', 'last_seen']
+
+def ensure_adhoc_storage():
     """
-    Lấy worksheet adhoc_tasks, nếu chưa tồn tại thì tạo mới.
+    Đảm bảo trang adhoc_tasks tồn tại (tạo mới nếu chưa có). Trả về True/False.
     """
-    global _adhoc_sheet_cache
-    if _adhoc_sheet_cache is not None:
-        return _adhoc_sheet_cache
-        
-    from config import get_spreadsheet, WORKSHEET_ADHOC_TASKS
-    import gspread
     try:
-        spreadsheet = get_spreadsheet()
-        try:
-            worksheet = spreadsheet.worksheet(WORKSHEET_ADHOC_TASKS)
-            _adhoc_sheet_cache = worksheet
-            return worksheet
-        except gspread.exceptions.WorksheetNotFound:
-            headers = ['group_id', 'date', 'assignee', 'task_id', 'task_name', 'status', 'completed_by', 'completed_at', 'created_at']
-            worksheet = spreadsheet.add_worksheet(title=WORKSHEET_ADHOC_TASKS, rows="1000", cols="20")
-            worksheet.append_row(headers)
-            print(f"Đã tạo worksheet mới: {WORKSHEET_ADHOC_TASKS}")
-            _adhoc_sheet_cache = worksheet
-            return worksheet
+        sheet_cache.ensure_worksheet(WORKSHEET_ADHOC_TASKS, headers=ADHOC_HEADERS)
+        return True
     except Exception as e:
         print(f"Lỗi khi lấy/tạo worksheet adhoc_tasks: {e}")
-        return None
+        return False
 
-def clean_old_adhoc_tasks(sheet):
+def clean_old_adhoc_tasks():
     """
     Xóa các công việc cũ (khác ngày hôm nay) trong trang tính adhoc_tasks để giải phóng dữ liệu.
     """
@@ -455,7 +470,8 @@ def clean_old_adhoc_tasks(sheet):
         return
         
     try:
-        all_values = sheet.get_all_values()
+        # Đọc bản mới nhất (max_age=0) vì có thể phải ghi đè toàn bộ sheet
+        all_values = sheet_cache.get_all_values(WORKSHEET_ADHOC_TASKS, max_age=0)
         if len(all_values) <= 1:
             _last_clean_date = today_str
             return
@@ -470,10 +486,9 @@ def clean_old_adhoc_tasks(sheet):
                 has_old_rows = True
                 
         if has_old_rows:
-            sheet.clear()
-            sheet.append_row(headers)
+            sheet_cache.clear(WORKSHEET_ADHOC_TASKS, headers)
             if rows_to_keep:
-                sheet.append_rows(rows_to_keep, value_input_option='USER_ENTERED')
+                sheet_cache.append_rows(WORKSHEET_ADHOC_TASKS, rows_to_keep)
             print("Đã tự động dọn dẹp các công việc phát sinh cũ của những ngày trước.")
         _last_clean_date = today_str
     except Exception as e:
@@ -483,11 +498,10 @@ def add_adhoc_tasks(group_id, assignee, tasks_list):
     """
     Thêm danh sách các công việc phát sinh cho nhân viên vào sheet.
     """
-    sheet = get_or_create_adhoc_worksheet()
-    if not sheet:
+    if not ensure_adhoc_storage():
         return False
         
-    clean_old_adhoc_tasks(sheet)
+    clean_old_adhoc_tasks()
     
     tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
     today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
@@ -510,7 +524,7 @@ def add_adhoc_tasks(group_id, assignee, tasks_list):
         rows_to_add.append(new_row)
         
     if rows_to_add:
-        sheet.append_rows(rows_to_add, value_input_option='USER_ENTERED')
+        sheet_cache.append_rows(WORKSHEET_ADHOC_TASKS, rows_to_add)
         print(f"Đã thêm {len(rows_to_add)} công việc phát sinh cho {assignee}")
         return True
     return False
@@ -519,12 +533,11 @@ def get_adhoc_tasks_today(group_id, assignee):
     """
     Lấy danh sách công việc phát sinh hôm nay của nhân viên đó.
     """
-    sheet = get_or_create_adhoc_worksheet()
-    if not sheet:
+    if not ensure_adhoc_storage():
         return []
     
     try:
-        all_records = sheet.get_all_records()
+        all_records = sheet_cache.get_all_records(WORKSHEET_ADHOC_TASKS)
         tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
         today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
         
@@ -543,12 +556,11 @@ def get_adhoc_tasks_for_group_today(group_id):
     """
     Lấy toàn bộ công việc phát sinh trong ngày của nhóm (mọi nhân viên).
     """
-    sheet = get_or_create_adhoc_worksheet()
-    if not sheet or not group_id:
+    if not ensure_adhoc_storage() or not group_id:
         return []
     
     try:
-        all_records = sheet.get_all_records()
+        all_records = sheet_cache.get_all_records(WORKSHEET_ADHOC_TASKS)
         tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
         today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
         
@@ -562,33 +574,33 @@ def get_adhoc_tasks_for_group_today(group_id):
         print(f"Lỗi khi lấy adhoc tasks của nhóm hôm nay: {e}")
         return []
 
+def adhoc_row_key(row):
+    """Khóa chỉ mục của một dòng adhoc_tasks: (group_id, task_id)."""
+    return (str(row[0]), str(row[3]))
+
 def update_adhoc_task_status(group_id, task_id, target_status, completed_by):
     """
     Cập nhật trạng thái của adhoc task.
     """
-    sheet = get_or_create_adhoc_worksheet()
-    if not sheet:
+    if not ensure_adhoc_storage():
         return False, None, None
     
     try:
-        all_records = sheet.get_all_records()
         tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
-        today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
         time_str = datetime.now(tz_vietnam).strftime('%H:%M')
         
         row_idx = -1
         assignee = None
         task_group_hash = None
-        for i, record in enumerate(all_records):
-            if (str(record.get('group_id')) == str(group_id) and 
-                record.get('task_id') == task_id):
-                row_idx = i + 2  # 1-indexed and header row
-                assignee = record.get('assignee')
-                if str(task_id).startswith('all_') or str(task_id).startswith('multi_'):
-                    parts = str(task_id).split('_')
-                    if len(parts) >= 3:
-                        task_group_hash = parts[1]
-                break
+        task_key = (str(group_id), task_id)
+        matches = sheet_cache.lookup_rows(WORKSHEET_ADHOC_TASKS, 'adhoc_task', adhoc_row_key, task_key)
+        if matches:
+            row_idx, row_values = matches[0]
+            assignee = row_values[2] if len(row_values) > 2 else None
+            if str(task_id).startswith('all_') or str(task_id).startswith('multi_'):
+                parts = str(task_id).split('_')
+                if len(parts) >= 3:
+                    task_group_hash = parts[1]
                 
         if row_idx != -1:
             comp_by = completed_by if target_status == 'complete' else ''
@@ -596,7 +608,8 @@ def update_adhoc_task_status(group_id, task_id, target_status, completed_by):
             
             # Cột F: status, Cột G: completed_by, Cột H: completed_at
             range_to_update = f'F{row_idx}:H{row_idx}'
-            sheet.update(range_name=range_to_update, values=[[target_status, comp_by, comp_at]])
+            write_queue.enqueue_update(WORKSHEET_ADHOC_TASKS, range_to_update, [[target_status, comp_by, comp_at]],
+                                       row_key=(adhoc_row_key, task_key))
             return True, assignee, task_group_hash
         return False, None, None
     except Exception as e:
@@ -751,11 +764,10 @@ def add_all_adhoc_tasks(group_id, members, task_name):
     """
     Giao việc chung @all cho toàn bộ thành viên trong nhóm.
     """
-    sheet = get_or_create_adhoc_worksheet()
-    if not sheet:
+    if not ensure_adhoc_storage():
         return None
         
-    clean_old_adhoc_tasks(sheet)
+    clean_old_adhoc_tasks()
         
     tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
     today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
@@ -780,7 +792,7 @@ def add_all_adhoc_tasks(group_id, members, task_name):
         rows_to_add.append(new_row)
         
     if rows_to_add:
-        sheet.append_rows(rows_to_add, value_input_option='USER_ENTERED')
+        sheet_cache.append_rows(WORKSHEET_ADHOC_TASKS, rows_to_add)
         print(f"Đã thêm việc @all {task_name} cho {len(rows_to_add)} thành viên")
         return task_group_hash
     return None
@@ -789,12 +801,11 @@ def generate_all_adhoc_flex(group_id, task_group_hash):
     """
     Tạo Flex Message hiển thị danh sách thành viên thực hiện việc chung @all.
     """
-    sheet = get_or_create_adhoc_worksheet()
-    if not sheet:
+    if not ensure_adhoc_storage():
         return None
         
     try:
-        all_records = sheet.get_all_records()
+        all_records = sheet_cache.get_all_records(WORKSHEET_ADHOC_TASKS)
         tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
         today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
         today_display_str = datetime.now(tz_vietnam).strftime('%d/%m/%Y')
@@ -934,13 +945,60 @@ def generate_all_adhoc_flex(group_id, task_group_hash):
         print(f"Lỗi khi tạo flex công việc chung: {e}")
         return None
 
-_group_members_sheet_cache_flex = None
+# --- DANH BẠ THÀNH VIÊN NHÓM TRONG BỘ NHỚ ---
+# Mỗi tin nhắn/lần bấm đều gọi register_group_member. Thay vì tải cả sheet và ghi
+# last_seen mỗi lần, giữ bản đồ (group_id, user_id) -> tên + lần ghi gần nhất;
+# chỉ ghi khi là thành viên mới, đổi tên, hoặc last_seen đã cũ hơn
+# GROUP_MEMBER_REFRESH_SECONDS. Việc ghi đi qua write_queue (gom lô, chạy nền);
+# lần ghi chỉ được tính (written_at) khi hàng đợi báo đã ghi thật lên sheet.
+GROUP_MEMBER_REFRESH_SECONDS = float(os.environ.get('GROUP_MEMBER_REFRESH_SECONDS', '21600'))
+
+_members_lock = threading.Lock()
+_members = None  # (group_id, user_id) -> {'name': ..., 'written_at': epoch, 'pending': đang chờ ghi?}
+_member_stats = {'skipped': 0, 'updated': 0, 'added': 0}
+
+def group_member_key(row):
+    """Khóa chỉ mục dòng group_members: (group_id, user_id)."""
+    if len(row) < 2:
+        return None
+    return (str(row[0]).strip(), str(row[1]).strip())
+
+def _parse_last_seen(value):
+    try:
+        tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
+        return tz_vietnam.localize(datetime.strptime(str(value), '%Y-%m-%d %H:%M:%S')).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+def _load_members():
+    """Nạp danh bạ từ sheet group_members một lần (gọi khi đang giữ _members_lock)."""
+    global _members
+    if _members is None:
+        sheet_cache.ensure_worksheet(WORKSHEET_GROUP_MEMBERS, headers=GROUP_MEMBERS_HEADERS, cols=10)
+        members = {}
+        for r in sheet_cache.get_all_records(WORKSHEET_GROUP_MEMBERS):
+            key = (str(r.get('group_id')).strip(), str(r.get('user_id')).strip())
+            members[key] = {'name': str(r.get('display_name', '')), 'written_at': _parse_last_seen(r.get('last_seen'))}
+        _members = members
+    return _members
+
+def _member_written(key, display_name):
+    """Callback của write_queue: cập nhật written_at khi ghi xong, bỏ cờ chờ nếu bị bỏ."""
+    def on_written(ok):
+        with _members_lock:
+            entry = _members.get(key) if _members is not None else None
+            # Đã đổi tên trong lúc chờ thì lần ghi mới hơn sẽ tự cập nhật
+            if entry is None or entry['name'] != display_name:
+                return
+            entry['pending'] = False
+            if ok:
+                entry['written_at'] = time.time()
+    return on_written
 
 def register_group_member(group_id, user_id, display_name):
     """
     Lưu thành viên của nhóm vào sheet group_members để phục vụ cho việc giao việc @all.
     """
-    global _group_members_sheet_cache_flex
     if not group_id or not user_id or not display_name:
         return
     # Nếu group_id giống user_id (chat 1-1), bỏ qua
@@ -948,49 +1006,51 @@ def register_group_member(group_id, user_id, display_name):
         return
         
     try:
-        from config import get_spreadsheet
-        import gspread
-        
-        if _group_members_sheet_cache_flex is None:
-            spreadsheet = get_spreadsheet()
-            try:
-                _group_members_sheet_cache_flex = spreadsheet.worksheet('group_members')
-            except gspread.exceptions.WorksheetNotFound:
-                headers = ['group_id', 'user_id', 'display_name', 'last_seen']
-                _group_members_sheet_cache_flex = spreadsheet.add_worksheet(title='group_members', rows="1000", cols="10")
-                _group_members_sheet_cache_flex.append_row(headers)
-                print("Đã tạo worksheet lưu thành viên nhóm: group_members")
-                
-        sheet = _group_members_sheet_cache_flex
-        all_records = sheet.get_all_records()
-        
-        row_idx = -1
-        for i, r in enumerate(all_records):
-            if str(r.get('group_id')) == str(group_id) and str(r.get('user_id')) == str(user_id):
-                row_idx = i + 2
-                break
-                
+        key = (str(group_id).strip(), str(user_id).strip())
+        now = time.time()
+        with _members_lock:
+            members = _load_members()
+            entry = members.get(key)
+            if entry and entry['name'] == display_name and (
+                    entry.get('pending') or now - entry['written_at'] < GROUP_MEMBER_REFRESH_SECONDS):
+                _member_stats['skipped'] += 1
+                return
+            members[key] = {'name': display_name, 'written_at': entry['written_at'] if entry else 0.0, 'pending': True}
+            _member_stats['updated' if entry else 'added'] += 1
+        on_written = _member_written(key, display_name)
+
         tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
         now_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d %H:%M:%S')
         
-        if row_idx != -1:
-            sheet.update(range_name=f'C{row_idx}:D{row_idx}', values=[[display_name, now_str]])
+        try:
+            rows = sheet_cache.lookup_rows(WORKSHEET_GROUP_MEMBERS, 'group_member', group_member_key, key) if entry else []
+        except Exception:
+            on_written(False)
+            raise
+        if rows:
+            for row_idx, _ in rows:
+                write_queue.enqueue_update(WORKSHEET_GROUP_MEMBERS, f'C{row_idx}:D{row_idx}', [[display_name, now_str]],
+                                           row_key=(group_member_key, key), on_written=on_written)
         else:
-            new_row = [str(group_id), str(user_id), display_name, now_str]
-            sheet.append_row(new_row)
+            write_queue.enqueue_append(WORKSHEET_GROUP_MEMBERS, [key[0], key[1], display_name, now_str],
+                                       on_written=on_written)
     except Exception as e:
         print(f"Lỗi khi lưu group member: {e}")
 
+def get_member_registry_stats():
+    with _members_lock:
+        return dict(_member_stats, members=len(_members) if _members is not None else None,
+                    refresh_seconds=GROUP_MEMBER_REFRESH_SECONDS)
+
 def add_multi_adhoc_tasks(group_id, job_name, task_assignments):
     """
     Thêm danh sách các công việc phát sinh cho nhiều nhân viên dưới một tên công việc chung (multi-assignee checklist).
     task_assignments là danh sách các tuple dạng (sub_task_name, assignee).
     """
-    sheet = get_or_create_adhoc_worksheet()
-    if not sheet:
+    if not ensure_adhoc_storage():
         return None
         
-    clean_old_adhoc_tasks(sheet)
+    clean_old_adhoc_tasks()
     
     tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
     today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
@@ -1016,7 +1076,7 @@ def add_multi_adhoc_tasks(group_id, job_name, task_assignments):
         rows_to_add.append(new_row)
         
     if rows_to_add:
-        sheet.append_rows(rows_to_add, value_input_option='USER_ENTERED')
+        sheet_cache.append_rows(WORKSHEET_ADHOC_TASKS, rows_to_add)
         print(f"Đã thêm checklist công việc '{job_name}' cho {len(rows_to_add)} nhân sự")
         return task_group_hash
     return None
@@ -1025,12 +1085,11 @@ def generate_multi_adhoc_flex(group_id, task_group_hash):
     """
     Tạo Flex Message hiển thị danh sách checklist công việc (multi-assignee) với nhiều người/nhiều việc khác nhau.
     """
-    sheet = get_or_create_adhoc_worksheet()
-    if not sheet:
+    if not ensure_adhoc_storage():
         return None
         
     try:
-        all_records = sheet.get_all_records()
+        all_records = sheet_cache.get_all_records(WORKSHEET_ADHOC_TASKS)
         tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
         today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
         today_display_str = datetime.now(tz_vietnam).strftime('%d/%m/%Y')
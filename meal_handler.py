@@ -3,11 +3,13 @@ import math
 from datetime import datetime
 import pytz
 import unicodedata
-import gspread
 from linebot.models import FlexSendMessage
 
 # Import từ file cấu hình trung tâm
-from config import CLIENT, SHEET_NAME, WORKSHEET_SCHEDULES_NAME, WORKSHEET_MEAL_TRACKER_NAME, get_spreadsheet
+from config import WORKSHEET_MEAL_TRACKER_NAME
+import sheet_cache
+import schedule_repository
+import write_queue
 
 # Định nghĩa Header chuẩn (8 cột)
 MEAL_HEADERS = ['group_id', 'date', 'session', 'type', 'name', 'status', 'time_clicked', 'clicked_by']
@@ -24,40 +26,19 @@ def get_vietnamese_day_of_week():
     days = ["Thứ Hai", "Thứ Ba", "Thứ Tư", "Thứ Năm", "Thứ Sáu", "Thứ Bảy", "Chủ Nhật"]
     return days[weekday]
 
-def clean_staff_name(name):
-    # Loại bỏ các ký tự thừa
-    name = re.sub(r'^\(\d+.*?\):?\s*', '', name)
-    name = re.sub(r'^[•\-\+:\.]\s*', '', name)
-    return name.strip()
-
 def get_working_staff(session_type):
     day_str = get_vietnamese_day_of_week()
     target_shift_name = "Ca Sáng" if session_type == 'ansang' else "Ca Chiều"
     exclude_pattern = r'off\s*ca\s*3' if session_type == 'ansang' else r'off\s*ca\s*4'
     
     try:
-        sheet = get_spreadsheet().worksheet(WORKSHEET_SCHEDULES_NAME)
-        records = sheet.get_all_records()
-        today_schedule = next((row for row in records if row.get('day_of_week') == day_str), None)
-        if not today_schedule: return {}
+        if not schedule_repository.get_day(day_str): return {}
 
         results = {'NV': [], 'PG': []}
-        
-        for staff_type, col_name in [('NV', 'employee_schedule'), ('PG', 'pg_schedule')]:
-            raw_text = today_schedule.get(col_name, "")
-            pattern = f"{target_shift_name}(.*?)(Ca Chiều|Nghỉ|Vệ Sinh|$)"
-            match = re.search(pattern, raw_text, re.DOTALL | re.IGNORECASE)
-            
-            if match:
-                staff_block = match.group(1).strip()
-                staff_block = staff_block.lstrip(':').lstrip(';').strip()
-                raw_names = re.split(r'[,\n]', staff_block)
-                
-                for name in raw_names:
-                    clean_name = clean_staff_name(name)
-                    if not clean_name or clean_name.isdigit(): continue
-                    if re.search(exclude_pattern, clean_name, re.IGNORECASE): continue
-                    results[staff_type].append(clean_name)
+        for staff_type in results:
+            for clean_name in schedule_repository.get_shift_staff(day_str, staff_type, target_shift_name):
+                if re.search(exclude_pattern, clean_name, re.IGNORECASE): continue
+                results[staff_type].append(clean_name)
         return results
     except Exception as e:
         print(f"Lỗi lấy lịch: {e}")
@@ -65,24 +46,21 @@ def get_working_staff(session_type):
 
 def sync_meal_sheet(group_id, session_type):
     try:
-        sheet = get_spreadsheet().worksheet(WORKSHEET_MEAL_TRACKER_NAME)
         tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
         today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
         
-        # 1. Kiểm tra ngày để reset sheet
+        # 1. Kiểm tra ngày để reset sheet (đọc ô B2 từ bản chụp thay vì gọi acell)
+        all_values = sheet_cache.get_all_values(WORKSHEET_MEAL_TRACKER_NAME)
         first_data_date = None
-        try:
-            val = sheet.acell('B2').value 
-            if val: first_data_date = val
-        except: pass
+        if len(all_values) > 1 and len(all_values[1]) > 1 and all_values[1][1]:
+            first_data_date = all_values[1][1]
 
         if first_data_date and first_data_date != today_str:
             print(f"Ngày mới! Xóa dữ liệu cũ ({first_data_date})...")
-            sheet.clear()
-            sheet.append_row(MEAL_HEADERS)
+            sheet_cache.clear(WORKSHEET_MEAL_TRACKER_NAME, MEAL_HEADERS)
             all_records = []
         else:
-            all_records = sheet.get_all_records()
+            all_records = sheet_cache.get_all_records(WORKSHEET_MEAL_TRACKER_NAME)
 
         # 2. Đồng bộ
         existing_entries = {}
@@ -113,7 +91,7 @@ def sync_meal_sheet(group_id, session_type):
                     final_data.append(entry)
         
         if new_rows:
-            sheet.append_rows(new_rows, value_input_option='USER_ENTERED')
+            sheet_cache.append_rows(WORKSHEET_MEAL_TRACKER_NAME, new_rows)
             
         return final_data
 
@@ -121,40 +99,31 @@ def sync_meal_sheet(group_id, session_type):
         print(f"Lỗi sync sheet: {e}")
         return []
 
+def tracker_staff_key(row):
+    """Khóa chỉ mục dòng meal/vesinh tracker: (group_id, date, session, tên đã chuẩn hóa)."""
+    if len(row) < 5:
+        return None
+    return (str(row[0]).strip(), str(row[1]).strip(), str(row[2]).strip(), normalize_text(row[4]))
+
 def update_meal_status(group_id, session_type, staff_name, clicker_name, target_status='done'):
     """
     Cập nhật trạng thái và Nick LINE người bấm.
     """
     try:
-        sheet = get_spreadsheet().worksheet(WORKSHEET_MEAL_TRACKER_NAME)
-        all_values = sheet.get_all_values()
-        
         tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
         today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
         time_now = datetime.now(tz_vietnam).strftime('%H:%M') if target_status == 'done' else ''
 
-        target_name_norm = normalize_text(staff_name)
-        target_group_id = str(group_id).strip()
+        target_key = (str(group_id).strip(), today_str, session_type, normalize_text(staff_name))
 
         row_index = -1
         current_status = None
-        # Tìm dòng tương ứng
-        for i, row in enumerate(all_values[1:], start=2):
-            if len(row) < 5: continue
-            
-            row_group = str(row[0]).strip()
-            row_date = str(row[1]).strip()
-            row_session = str(row[2]).strip()
-            row_name_norm = normalize_text(row[4])
-
-            if (row_group == target_group_id and 
-                row_date == today_str and 
-                row_session == session_type and 
-                row_name_norm == target_name_norm):
-                row_index = i
-                if len(row) >= 6:
-                    current_status = row[5].strip()
-                break
+        # Tìm dòng tương ứng qua chỉ mục thay vì quét toàn bộ sheet
+        matches = sheet_cache.lookup_rows(WORKSHEET_MEAL_TRACKER_NAME, 'meal_staff', tracker_staff_key, target_key)
+        if matches:
+            row_index, row = matches[0]
+            if len(row) >= 6:
+                current_status = row[5].strip()
         
         if row_index != -1:
             # Nếu trạng thái hiện tại đã khớp với mục tiêu, bỏ qua (tránh duplicate)
@@ -168,12 +137,9 @@ def update_meal_status(group_id, session_type, staff_name, clicker_name, target_
             # Cột 8 (H): Clicked By -> Nick Line hoặc rỗng
             
             clicked_user = clicker_name if target_status == 'done' else ''
-            cells = [
-                gspread.Cell(row_index, 6, target_status),
-                gspread.Cell(row_index, 7, time_now),
-                gspread.Cell(row_index, 8, clicked_user)
-            ]
-            sheet.update_cells(cells)
+            write_queue.enqueue_update(WORKSHEET_MEAL_TRACKER_NAME, f'F{row_index}:H{row_index}',
+                                       [[target_status, time_now, clicked_user]],
+                                       row_key=(tracker_staff_key, target_key))
             return True, time_now
         
         print(f"Không tìm thấy dòng khớp cho: {staff_name}")
@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+import collections
+
+# --- BỘ NHỚ ĐỆM TÊN HIỂN THỊ LINE ---
+# Mỗi tin nhắn/lần bấm đều gọi get_group_member_profile (một lượt HTTPS chặn),
+# postback còn gọi hai lần: lúc lưu thành viên và lúc lấy tên người bấm. Module
+# này giữ (group_id, user_id) -> display_name với hạn sống PROFILE_CACHE_TTL_SECONDS
+# và tối đa PROFILE_CACHE_MAX mục (bỏ mục ít dùng nhất). Nhiều luồng cùng hỏi một
+# người chưa có trong bộ nhớ thì chỉ một luồng gọi LINE, các luồng khác chờ kết quả.
+TTL_SECONDS = float(os.environ.get('PROFILE_CACHE_TTL_SECONDS', '3600'))
+MAX_ENTRIES = int(os.environ.get('PROFILE_CACHE_MAX', '2048'))
+WAIT_TIMEOUT_SECONDS = float(os.environ.get('PROFILE_CACHE_WAIT_SECONDS', '10'))
+
+_lock = threading.Lock()
+_entries = collections.OrderedDict()  # (group_id, user_id) -> (display_name, expires_at)
+_inflight = {}  # (group_id, user_id) -> {'event', 'name', 'error'}
+_stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0, 'evictions': 0, 'expired': 0}
+
+
+def _key(group_id, user_id):
+    return (str(group_id or ''), str(user_id))
+
+
+def get_display_name(group_id, user_id, loader):
+    """
+    Tên hiển thị của user_id trong group_id (group_id rỗng = hồ sơ 1-1).
+    loader() gọi LINE và trả về tên; chỉ được gọi khi chưa có/đã hết hạn.
+    Lỗi của loader được ném lại cho mọi luồng đang chờ và không được lưu.
+    """
+    key = _key(group_id, user_id)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            if entry[1] > time.time():
+                _entries.move_to_end(key)
+                _stats['hits'] += 1
+                return entry[0]
+            del _entries[key]
+            _stats['expired'] += 1
+        flight = _inflight.get(key)
+        if flight is not None:
+            _stats['coalesced'] += 1
+            leader = False
+        else:
+            flight = {'event': threading.Event(), 'name': None, 'error': None}
+            _inflight[key] = flight
+            _stats['misses'] += 1
+            leader = True
+
+    if not leader:
+        if not flight['event'].wait(WAIT_TIMEOUT_SECONDS):
+            raise TimeoutError(f"Quá hạn chờ hồ sơ LINE của {user_id}")
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['name']
+
+    try:
+        name = loader()
+    except Exception as e:
+        flight['error'] = e
+        with _lock:
+            _stats['errors'] += 1
+            _inflight.pop(key, None)
+        flight['event'].set()
+        raise
+
+    flight['name'] = name
+    with _lock:
+        if name:
+            _put(key, name)
+        _inflight.pop(key, None)
+    flight['event'].set()
+    return name
+
+
+def _put(key, name):
+    """Gọi khi đang giữ _lock: lưu một tên và bỏ bớt mục cũ nếu vượt giới hạn."""
+    _entries[key] = (name, time.time() + TTL_SECONDS)
+    _entries.move_to_end(key)
+    while len(_entries) > MAX_ENTRIES:
+        _entries.popitem(last=False)
+        _stats['evictions'] += 1
+
+
+def invalidate(group_id=None, user_id=None):
+    """Xóa một mục, hoặc toàn bộ bộ nhớ nếu không truyền tham số."""
+    with _lock:
+        if user_id is None:
+            _entries.clear()
+        else:
+            _entries.pop(_key(group_id, user_id), None)
+
+
+def get_cache_stats():
+    with _lock:
+        lookups = _stats['hits'] + _stats['misses'] + _stats['coalesced']
+        return dict(_stats, size=len(_entries), inflight=len(_inflight), ttl_seconds=TTL_SECONDS,
+                    max_entries=MAX_ENTRIES,
+                    hit_rate=round(_stats['hits'] / lookups, 3) if lookups else None)
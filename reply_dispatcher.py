@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+import collections
+import concurrent.futures
+
+from event_queue import _percentile
+
+# --- GỬI TRẢ LỜI CÓ TÍNH HẠN REPLY TOKEN ---
+# Reply token của LINE chỉ dùng được một lần và trong một khoảng ngắn sau khi
+# webhook tới. Các lệnh nặng (thẻ NV, RT1, LK1, giao việc @all) cộng thêm thời
+# gian chờ hàng đợi webhook có thể làm token hết hạn, và tin trả lời bị mất.
+# Module này ghi lại lúc sự kiện tới (/callback), tính thời gian còn lại và:
+#   - còn hạn: reply_message như cũ;
+#   - đã quá hạn / token đã dùng / LINE báo token không hợp lệ: chuyển sang push;
+#   - việc nặng chưa xong sau REPLY_INTERIM_AFTER_SECONDS: trả lời ngay một tin
+#     "đang xử lý" bằng token, kết quả thật được push khi xong.
+# Push tính vào hạn mức tin nhắn của kênh nên chỉ dùng khi không còn cách khác.
+REPLY_TOKEN_TTL_SECONDS = float(os.environ.get('REPLY_TOKEN_TTL_SECONDS', '30'))
+REPLY_SAFETY_MARGIN_SECONDS = float(os.environ.get('REPLY_SAFETY_MARGIN_SECONDS', '5'))
+REPLY_INTERIM_AFTER_SECONDS = float(os.environ.get('REPLY_INTERIM_AFTER_SECONDS', '5'))
+HEAVY_WORKERS = int(os.environ.get('REPLY_HEAVY_WORKERS', '4'))
+LATENCY_SAMPLES = 500
+
+_api = None
+_lock = threading.Lock()
+_heavy_pool = concurrent.futures.ThreadPoolExecutor(max_workers=HEAVY_WORKERS, thread_name_prefix='reply-heavy')
+_elapsed_ms = collections.deque(maxlen=LATENCY_SAMPLES)
+_stats = {'reply': 0, 'interim': 0, 'push_after_interim': 0, 'push_expired': 0, 'push_fallback': 0,
+          'failed': 0, 'heavy_fast': 0}
+
+
+def configure(line_bot_api):
+    """Dùng chung LineBotApi của app (gọi một lần lúc khởi động)."""
+    global _api
+    _api = line_bot_api
+
+
+def mark_arrival(event, at=None):
+    """Ghi lại thời điểm sự kiện tới webhook, trước khi vào hàng đợi xử lý."""
+    event.received_at = at if at is not None else time.time()
+    return event
+
+
+def elapsed(event):
+    """Số giây đã trôi qua từ lúc sự kiện tới (dùng timestamp của LINE nếu chưa được đánh dấu)."""
+    received_at = getattr(event, 'received_at', None)
+    if received_at is None:
+        timestamp = getattr(event, 'timestamp', None)
+        received_at = timestamp / 1000.0 if timestamp else time.time()
+    return max(0.0, time.time() - received_at)
+
+
+def remaining(event):
+    """Số giây còn lại trước khi reply token được coi là hết hạn (đã trừ biên an toàn)."""
+    return REPLY_TOKEN_TTL_SECONDS - REPLY_SAFETY_MARGIN_SECONDS - elapsed(event)
+
+
+def destination(event):
+    """ID nhận tin đẩy: nhóm, phòng, hoặc người dùng 1-1."""
+    source = event.source
+    return getattr(source, 'group_id', None) or getattr(source, 'room_id', None) or getattr(source, 'user_id', None)
+
+
+def _count(path, event):
+    with _lock:
+        _stats[path] += 1
+        _elapsed_ms.append(elapsed(event) * 1000)
+
+
+def _is_reply_token_error(error):
+    detail = getattr(getattr(error, 'error', None), 'message', '') or str(error)
+    return getattr(error, 'status_code', None) == 400 and 'reply token' in detail.lower()
+
+
+def _push(event, messages, path):
+    try:
+        _api.push_message(destination(event), messages)
+    except Exception:
+        with _lock:
+            _stats['failed'] += 1
+        raise
+    _count(path, event)
+
+
+def reply(event, messages):
+    """
+    Trả lời sự kiện bằng reply token nếu còn hạn, nếu không thì đẩy (push) tới
+    nguồn của sự kiện. Nhận một tin hoặc danh sách tin như reply_message.
+    """
+    if getattr(event, 'reply_used', False):
+        return _push(event, messages, 'push_after_interim')
+    if remaining(event) <= 0:
+        print(f"Reply token đã quá {elapsed(event):.1f}s, chuyển sang push.")
+        return _push(event, messages, 'push_expired')
+    try:
+        _api.reply_message(event.reply_token, messages)
+    except Exception as e:
+        if not _is_reply_token_error(e):
+            with _lock:
+                _stats['failed'] += 1
+            raise
+        print(f"Reply token không còn hợp lệ ({e}), chuyển sang push.")
+        event.reply_used = True
+        return _push(event, messages, 'push_fallback')
+    event.reply_used = True
+    _count('reply', event)
+
+
+def run_heavy(event, func, interim_text):
+    """
+    Chạy func() (việc nặng: tải dữ liệu, vẽ Flex...) và trả về kết quả của nó.
+    Nếu func chưa xong khi sắp hết hạn chờ, gửi ngay interim_text bằng reply token;
+    lần reply() sau đó sẽ tự chuyển sang push. Lỗi của func được ném lại.
+    """
+    budget = min(REPLY_INTERIM_AFTER_SECONDS, remaining(event))
+    if getattr(event, 'reply_used', False) or budget <= 0:
+        return func()
+    future = _heavy_pool.submit(func)
+    try:
+        result = future.result(timeout=budget)
+    except concurrent.futures.TimeoutError:
+        pass
+    else:
+        with _lock:
+            _stats['heavy_fast'] += 1
+        return result
+
+    from linebot.models import TextSendMessage
+    try:
+        _api.reply_message(event.reply_token, TextSendMessage(text=interim_text))
+        event.reply_used = True
+        _count('interim', event)
+    except Exception as e:
+        print(f"Lỗi gửi tin chờ xử lý: {e}")
+    return future.result()
+
+
+def get_dispatch_stats():
+    with _lock:
+        return dict(
+            _stats,
+            token_ttl_s=REPLY_TOKEN_TTL_SECONDS,
+            interim_after_s=REPLY_INTERIM_AFTER_SECONDS,
+            elapsed_ms_p50=_percentile(_elapsed_ms, 50),
+            elapsed_ms_p95=_percentile(_elapsed_ms, 95),
+        )
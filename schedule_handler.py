@@ -3,10 +3,8 @@ from datetime import datetime
 import pytz
 from linebot import LineBotApi
 from linebot.models import FlexSendMessage, TextSendMessage
-import re
 
-# Import từ file cấu hình trung tâm
-from config import CLIENT, SHEET_NAME, WORKSHEET_SCHEDULES_NAME, get_spreadsheet
+import schedule_repository
 
 # Khởi tạo LineBotApi
 CHANNEL_ACCESS_TOKEN = os.environ.get('CHANNEL_ACCESS_TOKEN')
@@ -23,25 +21,8 @@ def get_vietnamese_day_of_week():
     days = ["Thứ Hai", "Thứ Ba", "Thứ Tư", "Thứ Năm", "Thứ Sáu", "Thứ Bảy", "Chủ Nhật"]
     return days[weekday]
 
-def parse_schedule_text(schedule_text):
-    """Phân tích văn bản lịch làm việc thành các ca và nhân viên."""
-    keywords = ["Ca Sáng", "Ca Chiều", "Nghỉ", "Vệ Sinh Kho"]
-    pattern = '|'.join(keywords)
-    
-    parts = re.split(f'({pattern})', schedule_text.replace('<br>', '\n'))
-    
-    schedule_parts = []
-    i = 1 if parts and not parts[0].strip() else 0
-    while i < len(parts):
-        keyword = parts[i].strip()
-        content = parts[i+1].strip().lstrip(':').lstrip(';').strip() if i + 1 < len(parts) else ""
-        schedule_parts.append({"shift": keyword, "staff": content})
-        i += 2
-        
-    return schedule_parts
-
-def create_schedule_flex_message(schedule_type, schedule_text, schedule_day_str):
-    """Tạo tin nhắn Flex Message cho lịch làm việc."""
+def create_schedule_flex_message(schedule_type, parsed_schedule, schedule_day_str):
+    """Tạo tin nhắn Flex Message cho lịch làm việc từ các ca đã phân tích (schedule_repository.parse_shifts)."""
     if schedule_type == 'pg':
         title = f"LỊCH LÀM VIỆC PG - {schedule_day_str.upper()}"
         header_color = "#FF6B6B"
@@ -49,13 +30,12 @@ def create_schedule_flex_message(schedule_type, schedule_text, schedule_day_str)
         title = f"LỊCH LÀM VIỆC NHÂN VIÊN - {schedule_day_str.upper()}"
         header_color = "#4D96FF"
 
-    shift_icons = {"Ca Sáng": "☀️", "Ca Chiều": "🌙", "Nghỉ": "⚪️", "Vệ Sinh Kho": "🧹"}
-    parsed_schedule = parse_schedule_text(schedule_text)
-    
+    shift_icons = {"Ca Sáng": "☀️", "Ca Chiều": "🌙", "Nghỉ": "⚪️", "Vệ Sinh Kho": "🧹", "Vệ Sinh": "🧹"}
+
     body_components = []
     for part in parsed_schedule:
         shift_name = part["shift"]
-        staff_list_text = part["staff"]
+        staff_list_text = part["text"]
         icon = shift_icons.get(shift_name, "📌")
 
         section_header = {
@@ -69,13 +49,13 @@ def create_schedule_flex_message(schedule_type, schedule_text, schedule_day_str)
         content_box = None
 
         if schedule_type == 'employee' and shift_name in ["Ca Sáng", "Ca Chiều"]:
-            special_roles = ['(ERP)', '(GH1)', '(GH2)']
+            # Vai trò lấy từ mô hình lịch: nhận cả "GH2" không có ngoặc, giống quy tắc
+            # phân công vệ sinh, nên cột đặc biệt khớp với danh sách chấm cơm/vệ sinh
+            special_roles = ['ERP', 'GH1', 'GH2']
             special_staff, regular_staff = [], []
-            staff_list_text_clean = re.sub(r'\(\d+\s*NV\):\s*', '', staff_list_text)
-            all_staff = [s.strip() for s in staff_list_text_clean.split(',') if s.strip()]
 
-            for staff in all_staff:
-                if any(role in staff for role in special_roles):
+            for staff in part["staff"]:
+                if any(role in part["roles"].get(staff, []) for role in special_roles):
                     special_staff.append(staff)
                 else:
                     regular_staff.append(staff)
@@ -91,8 +71,7 @@ def create_schedule_flex_message(schedule_type, schedule_text, schedule_day_str)
             }
         
         elif schedule_type == 'pg' and shift_name in ["Ca Sáng", "Ca Chiều"]:
-            staff_list_text_clean = re.sub(r'\(\d+\):\s*', '', staff_list_text)
-            all_staff = [s.strip() for s in staff_list_text_clean.split('\n') if s.strip()]
+            all_staff = part["staff"]
             
             pgs_per_column = 3
             chunks = [all_staff[i:i + pgs_per_column] for i in range(0, len(all_staff), pgs_per_column)]
@@ -130,15 +109,20 @@ def create_schedule_flex_message(schedule_type, schedule_text, schedule_day_str)
     }
     return flex_content
 
-def send_daily_schedule(schedule_type, target_id=None, reply_token=None, day_of_week_str=None, return_msg_only=False):
+def send_daily_schedule(schedule_type, target_id=None, reply_token=None, day_of_week_str=None, return_msg_only=False,
+                        reply=None):
     """
     Hàm chính để tìm và gửi lịch làm việc.
     CẬP NHẬT: Thêm return_msg_only để gom tin nhắn và TẮT push báo lỗi.
+    reply: hàm reply(message) của bên gọi (vd. reply_dispatcher cho lệnh chat), dùng thay
+    cho reply_token để lời trả lời đi qua cùng đường gửi với các lệnh khác.
     """
+    if reply is None and reply_token:
+        reply = lambda message: line_bot_api.reply_message(reply_token, message)
     column_to_read = 'pg_schedule' if schedule_type == 'pg' else 'employee_schedule'
 
     # Nếu không có target_id và không phải chế độ lấy tin thì tự tìm ID từ env
-    if not target_id and not return_msg_only and not reply_token:
+    if not target_id and not return_msg_only and not reply:
         if schedule_type == 'pg':
             target_id = os.environ.get('PG_GROUP_ID')
         else:
@@ -147,13 +131,12 @@ def send_daily_schedule(schedule_type, target_id=None, reply_token=None, day_of_
     try:
         schedule_day_str = day_of_week_str if day_of_week_str else get_vietnamese_day_of_week()
         
-        sheet = get_spreadsheet().worksheet(WORKSHEET_SCHEDULES_NAME)
-        all_schedules = sheet.get_all_records()
-        
-        schedule_text_for_day = next((row.get(column_to_read) for row in all_schedules if row.get('day_of_week') == schedule_day_str), None)
+        day_schedule = schedule_repository.get_day(schedule_day_str)
+        schedule_text_for_day = day_schedule.get(column_to_read) if day_schedule else None
         
         if schedule_text_for_day:
-            flex_message_content = create_schedule_flex_message(schedule_type, schedule_text_for_day, schedule_day_str)
+            staff_type = 'PG' if schedule_type == 'pg' else 'NV'
+            flex_message_content = create_schedule_flex_message(schedule_type, day_schedule[staff_type], schedule_day_str)
             alt_text = f"Lịch làm việc {schedule_day_str} cho {schedule_type}"
             message = FlexSendMessage(alt_text=alt_text, contents=flex_message_content)
             
@@ -162,8 +145,8 @@ def send_daily_schedule(schedule_type, target_id=None, reply_token=None, day_of_
                 return message
 
             # Logic cũ: Gửi ngay (Dùng cho lệnh chat thủ công "NV", "PG")
-            if reply_token:
-                line_bot_api.reply_message(reply_token, message)
+            if reply:
+                reply(message)
                 print(f"Đã trả lời (reply) lịch thành công.")
             elif target_id:
                 line_bot_api.push_message(target_id, message)
@@ -171,13 +154,13 @@ def send_daily_schedule(schedule_type, target_id=None, reply_token=None, day_of_
             return message
         else:
             # --- CẬP NHẬT QUAN TRỌNG: KHÔNG PUSH LỖI ---
-            # Chỉ gửi tin báo lỗi nếu là người dùng chat hỏi (có reply_token)
+            # Chỉ gửi tin báo lỗi nếu là người dùng chat hỏi (có reply)
             # Nếu là Cron Job chạy tự động thì IM LẶNG để tránh tốn tiền.
             error_text = f"Không tìm thấy lịch làm việc cho {schedule_day_str}."
             print(f"[LOG] {error_text}") 
             
-            if reply_token:
-                line_bot_api.reply_message(reply_token, TextSendMessage(text=error_text))
+            if reply:
+                reply(TextSendMessage(text=error_text))
             return None
 
     except Exception as e:
@@ -0,0 +1,147 @@
+import re
+import threading
+import unicodedata
+
+# Import từ file cấu hình trung tâm
+from config import WORKSHEET_SCHEDULES_NAME
+import sheet_cache
+
+# --- KHO LỊCH LÀM VIỆC DÙNG CHUNG ---
+# Trang 'schedules' (day_of_week, employee_schedule, pg_schedule) được đọc qua
+# sheet_cache và chỉ phân tích lại khi nội dung trang thay đổi. Mỗi ngày được
+# tách sẵn thành các ca, mỗi ca có danh sách NV/PG đã làm sạch kèm vai trò
+# (ERP, GH1, GH2, '*' = nữ), nên lệnh lịch, chấm cơm, vệ sinh và @all fallback
+# đều đọc cùng một mô hình thay vì tự tải và tự parse bằng regex.
+
+SCHEDULE_COLUMNS = {'NV': 'employee_schedule', 'PG': 'pg_schedule'}
+SHIFT_KEYWORDS = ["Ca Sáng", "Ca Chiều", "Nghỉ", "Vệ Sinh Kho", "Vệ Sinh"]
+ROLE_TAGS = ["ERP", "GH1", "GH2"]
+
+_lock = threading.Lock()
+_state = {'values': None, 'days': {}}
+_stats = {'reads': 0, 'parses': 0}
+
+# Bộ tách từ duy nhất cho văn bản lịch: mỗi token là một tên ca, một dấu ngăn
+# cách tên (',', xuống dòng, ';', '•', '+', '<br>') hoặc một đoạn tên. Một lần
+# quét tuyến tính cho ra cả danh sách ca lẫn nhân viên của từng ca.
+_SHIFT_ALT = '|'.join(re.escape(k) for k in SHIFT_KEYWORDS)
+_BR = r'<br\s*/?>'
+_TOKEN_RE = re.compile(
+    rf'(?P<shift>{_SHIFT_ALT})|(?P<sep>{_BR}|[,\n;•+])|(?P<name>(?:(?!{_SHIFT_ALT}|{_BR})[^,\n;•+])+)',
+    re.IGNORECASE
+)
+_BR_RE = re.compile(_BR, re.IGNORECASE)
+_CANONICAL_SHIFTS = {k.lower(): k for k in SHIFT_KEYWORDS}
+_ROLE_RE = re.compile(r'\b(' + '|'.join(ROLE_TAGS) + r')\b', re.IGNORECASE)
+_NAME_PREFIX_RE = re.compile(r'^\s*(?:\(\d+.*?\):?\s*)?(?:[•\-\+:\.]\s*)?')
+
+
+def clean_staff_name(name):
+    # Loại bỏ các ký tự thừa: "(5 NV): ", gạch đầu dòng...
+    return _NAME_PREFIX_RE.sub('', name, count=1).strip()
+
+
+def _name_key(name):
+    return unicodedata.normalize('NFC', str(name).strip().lower())
+
+
+def staff_roles(name):
+    """Các vai trò ghi kèm tên NV, vd "Bình (GH2)" -> ['GH2'], "Hoa *" -> ['*']."""
+    roles = [r.upper() for r in _ROLE_RE.findall(name)]
+    if '*' in name:
+        roles.append('*')
+    return roles
+
+
+def parse_shifts(raw_text):
+    """
+    Tách văn bản lịch một ngày thành [{'shift', 'text', 'staff', 'roles'}] theo thứ tự
+    xuất hiện, trong một lần quét. Phần chữ đứng trước ca đầu tiên bị bỏ qua.
+    """
+    if not raw_text:
+        return []
+    raw_text = str(raw_text)
+    shifts = []
+    current = None
+    seen = set()
+
+    def close(end):
+        if current is not None:
+            text = _BR_RE.sub('\n', raw_text[current['start']:end]).strip().lstrip(':').lstrip(';').strip()
+            current['text'] = text
+            del current['start']
+
+    for token in _TOKEN_RE.finditer(raw_text):
+        kind = token.lastgroup
+        if kind == 'shift':
+            close(token.start())
+            current = {
+                "shift": _CANONICAL_SHIFTS.get(token.group().lower(), token.group()),
+                "text": "", "staff": [], "roles": {}, "start": token.end()
+            }
+            shifts.append(current)
+            seen = set()
+        elif kind == 'name' and current is not None:
+            cn = clean_staff_name(token.group())
+            if cn and not cn.isdigit() and len(cn) > 1 and _name_key(cn) not in seen:
+                seen.add(_name_key(cn))
+                current["staff"].append(cn)
+                current["roles"][cn] = staff_roles(cn)
+    close(len(raw_text))
+    return shifts
+
+
+def _parse_values(values):
+    days = {}
+    if not values:
+        return days
+    headers = values[0]
+    for row in values[1:]:
+        record = dict(zip(headers, row))
+        day_str = str(record.get('day_of_week', '')).strip()
+        if not day_str or day_str in days:
+            continue
+        day = {'day_of_week': day_str}
+        for staff_type, column in SCHEDULE_COLUMNS.items():
+            raw_text = record.get(column, '') or ''
+            day[column] = raw_text
+            day[staff_type] = parse_shifts(raw_text)
+        days[day_str] = day
+    return days
+
+
+def _get_days():
+    values = sheet_cache.get_all_values(WORKSHEET_SCHEDULES_NAME)
+    with _lock:
+        _stats['reads'] += 1
+        if values != _state['values']:
+            _state['days'] = _parse_values(values)
+            _state['values'] = values
+            _stats['parses'] += 1
+        return _state['days']
+
+
+def get_day(day_str):
+    """Mô hình lịch của một ngày ("Thứ Hai"...), hoặc None nếu không có. Không được sửa đối tượng trả về."""
+    return _get_days().get(day_str)
+
+
+def get_shift_staff(day_str, staff_type, shift_name):
+    """Danh sách tên NV/PG (staff_type 'NV' hoặc 'PG') của một ca trong ngày, không trùng lặp."""
+    day = get_day(day_str)
+    if not day:
+        return []
+    names, seen = [], set()
+    for shift in day.get(staff_type, []):
+        if shift["shift"].lower() != shift_name.lower():
+            continue
+        for n in shift["staff"]:
+            if _name_key(n) not in seen:
+                seen.add(_name_key(n))
+                names.append(n)
+    return names
+
+
+def get_repository_stats():
+    with _lock:
+        return dict(_stats, days=len(_state['days']))
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+
+from dmx_data_provider import check_scrape_status, trigger_adhoc_scrape
+
+# --- BỘ THEO DÕI TRẠNG THÁI CÀO DÙNG CHUNG ---
+# Trước đây mỗi lệnh RT/CAO tự mở một luồng, ngủ 3 giây x 40 vòng để hỏi
+# check_scrape_status, nên 10 người hỏi cùng lúc là 10 luồng cùng gọi Supabase.
+# Giờ chỉ có một luồng poll duy nhất (chỉ chạy khi còn người chờ); mỗi người
+# chờ đăng ký một callback và được báo đúng một lần khi tín hiệu chuyển sang
+# completed, hoặc khi quá hạn chờ.
+POLL_INTERVAL_SECONDS = float(os.environ.get('SCRAPE_POLL_INTERVAL_SECONDS', '3'))
+WAIT_TIMEOUT_SECONDS = float(os.environ.get('SCRAPE_WAIT_TIMEOUT_SECONDS', '120'))
+
+_lock = threading.Lock()
+_subscribers = []
+_poller = None
+_stats = {'polls': 0, 'subscribed': 0, 'completed': 0, 'timed_out': 0, 'callback_errors': 0,
+          'jobs_started': 0, 'requests_coalesced': 0, 'trigger_failed': 0}
+
+# Lượt cào đang chờ theo loại (realtime/luyke): {'requested_at', 'destinations'}
+_jobs = {}
+
+
+def subscribe(requested_at, callback, scrape_type=None):
+    """
+    Đăng ký chờ lượt cào được yêu cầu lúc requested_at (chuỗi ISO UTC).
+    callback(completed, status_info) được gọi đúng một lần từ luồng poll.
+    scrape_type: nếu có, chỉ tính tín hiệu cùng loại (RT và LK dùng chung một dòng
+    scrape_signals, lượt LK ghi đè tín hiệu RT thì người chờ RT không được báo xong).
+    """
+    subscriber = {
+        'req_prefix': requested_at[:16] if requested_at else "",
+        'scrape_type': scrape_type,
+        'callback': callback,
+        'deadline': time.time() + WAIT_TIMEOUT_SECONDS,
+        'saw_running': False,
+    }
+    with _lock:
+        _subscribers.append(subscriber)
+        _stats['subscribed'] += 1
+        _start_poller()
+    return subscriber
+
+
+def _start_poller():
+    """Gọi khi đang giữ _lock: mở luồng poll nếu chưa chạy."""
+    global _poller
+    if _poller is None or not _poller.is_alive():
+        _poller = threading.Thread(target=_run_poller, name='scrape-watcher', daemon=True)
+        _poller.start()
+
+
+def _run_poller():
+    global _poller
+    while True:
+        time.sleep(POLL_INTERVAL_SECONDS)
+        _poll_once()
+        with _lock:
+            if not _subscribers:
+                _poller = None
+                return
+
+
+def _is_done(subscriber, status_info):
+    if subscriber['scrape_type'] and status_info.get("type") != subscriber['scrape_type']:
+        return False
+    sig_status = status_info.get("status")
+    sig_req = status_info.get("requested_at", "")
+    if sig_status == "running":
+        subscriber['saw_running'] = True
+    elif sig_status == "completed":
+        return subscriber['saw_running'] or not sig_req or sig_req >= subscriber['req_prefix']
+    return False
+
+
+def _poll_once():
+    """Hỏi Supabase một lần cho tất cả người đang chờ, rồi báo cho những ai đã xong/quá hạn."""
+    with _lock:
+        if not _subscribers:
+            return
+    status_info = check_scrape_status()
+    now = time.time()
+
+    finished = []
+    with _lock:
+        _stats['polls'] += 1
+        for subscriber in list(_subscribers):
+            if _is_done(subscriber, status_info):
+                finished.append((subscriber, True))
+            elif now >= subscriber['deadline']:
+                finished.append((subscriber, False))
+            else:
+                continue
+            _subscribers.remove(subscriber)
+            _stats['completed' if finished[-1][1] else 'timed_out'] += 1
+
+    # Gọi callback ngoài khóa để việc vẽ Flex/đẩy tin không chặn người đăng ký mới
+    for subscriber, completed in finished:
+        try:
+            subscriber['callback'](completed, status_info)
+        except Exception as e:
+            with _lock:
+                _stats['callback_errors'] += 1
+            print(f"Lỗi xử lý kết quả cào: {e}")
+
+
+# --- GỘP CÁC YÊU CẦU CÀO TRÙNG NHAU ---
+# Mỗi lệnh RT/CAO ghi đè dòng scrape_signals. Nếu đang có một lượt cào cùng loại
+# chờ xử lý/đang chạy thì không kích hoạt lại, chỉ thêm người hỏi vào danh sách
+# nhận kết quả; khi xong, on_finish được gọi một lần cho cả danh sách để báo cáo
+# chỉ phải vẽ một lần.
+
+def request_scrape(scrape_type, dest_id, on_finish):
+    """
+    Yêu cầu một lượt cào scrape_type và nhận kết quả tại dest_id.
+    on_finish(scrape_type, destinations, completed) được gọi một lần khi lượt cào kết thúc,
+    kể cả khi không kích hoạt được tín hiệu (completed=False) để người đã gộp vào được báo.
+    Trả về 'started', 'joined', hoặc None nếu không kích hoạt được tín hiệu.
+    """
+    with _lock:
+        job = _jobs.get(scrape_type)
+        if job is not None:
+            if dest_id not in job['destinations']:
+                job['destinations'].append(dest_id)
+            _stats['requests_coalesced'] += 1
+            return 'joined'
+        job = {'requested_at': None, 'destinations': [dest_id]}
+        _jobs[scrape_type] = job
+
+    # Kích hoạt tín hiệu ngoài khóa; người hỏi trong lúc này vẫn được gộp vào job
+    trigger_success, req_time = trigger_adhoc_scrape(scrape_type)
+    if not trigger_success:
+        with _lock:
+            _jobs.pop(scrape_type, None)
+            _stats['trigger_failed'] += 1
+            destinations = list(job['destinations'])
+        print("Lỗi kích hoạt tín hiệu cào dữ liệu.")
+        on_finish(scrape_type, destinations, False)
+        return None
+
+    def finish_job(completed, status_info):
+        with _lock:
+            if _jobs.get(scrape_type) is job:
+                _jobs.pop(scrape_type)
+            destinations = list(job['destinations'])
+        on_finish(scrape_type, destinations, completed)
+
+    with _lock:
+        job['requested_at'] = req_time
+        _stats['jobs_started'] += 1
+    subscribe(req_time, finish_job, scrape_type)
+    return 'started'
+
+
+def get_watcher_stats():
+    with _lock:
+        return dict(
+            _stats, waiting=len(_subscribers), poller_alive=bool(_poller and _poller.is_alive()),
+            jobs={t: {'requested_at': j['requested_at'], 'destinations': len(j['destinations'])} for t, j in _jobs.items()}
+        )
@@ -0,0 +1,321 @@
+import os
+import threading
+import time
+import collections
+
+from gspread.utils import numericise_all, a1_range_to_grid_range
+
+import storage
+
+# --- BỘ NHỚ ĐỆM BẢN CHỤP WORKSHEET DÙNG CHUNG ---
+# Mỗi worksheet được tải toàn bộ (get_all_values) một lần và giữ trong bộ nhớ
+# SNAPSHOT_TTL_SECONDS giây. Các lần đọc trong cùng một loạt thao tác (vd: nhiều
+# người bấm "Hoàn tất" liên tục) sẽ đọc từ bộ nhớ thay vì gọi Sheets API.
+# Mọi thao tác ghi đi qua module này sẽ tự động hủy bản chụp tương ứng.
+# Dữ liệu thật được đọc/ghi qua storage (Google Sheets hoặc SQLite).
+
+SNAPSHOT_TTL_SECONDS = float(os.environ.get('SHEET_CACHE_TTL_SECONDS', '30'))
+# Tra cứu dòng theo khóa (postback) dùng bản chụp không cũ hơn TTL: số dòng tìm được
+# sẽ thành đích ghi, nên không được dựa vào bản chụp đã quá hạn. Hàng đợi ghi còn
+# kiểm tra lại khóa của dòng đích ngay trước khi ghi (xem write_queue).
+# Khóa dòng của mọi trang trạng thái (task_tracker, adhoc_tasks, meal/vesinh tracker,
+# group_members) nằm trong 5 cột đầu: kiểm tra khóa chỉ đọc chừng ấy cột, không tải cả sheet.
+KEY_COLUMNS_RANGE = 'A:E'
+INDEX_MAX_AGE_SECONDS = min(float(os.environ.get('SHEET_INDEX_MAX_AGE_SECONDS', str(SNAPSHOT_TTL_SECONDS))),
+                            SNAPSHOT_TTL_SECONDS)
+
+_lock = threading.RLock()
+_fetch_locks = collections.defaultdict(threading.Lock)
+_snapshots = {}
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_sheet_stats = collections.defaultdict(lambda: {'hits': 0, 'misses': 0, 'invalidations': 0})
+
+
+def ensure_worksheet(title, headers=None, rows=1000, cols=20):
+    """
+    Đảm bảo worksheet tồn tại: nếu chưa có và có truyền headers thì tạo mới với
+    dòng tiêu đề đó, ngược lại ném lỗi của backend (vd: WorksheetNotFound).
+    """
+    return storage.ensure(title, headers=headers, rows=rows, cols=cols)
+
+
+def _fresh_snapshot(title, max_age):
+    with _lock:
+        snapshot = _snapshots.get(title)
+        if snapshot and time.time() - snapshot['fetched_at'] <= max_age:
+            _stats['hits'] += 1
+            _sheet_stats[title]['hits'] += 1
+            return snapshot
+    return None
+
+
+def _get_snapshot(title, max_age=None):
+    max_age = SNAPSHOT_TTL_SECONDS if max_age is None else max_age
+    snapshot = _fresh_snapshot(title, max_age)
+    if snapshot is not None:
+        return snapshot
+
+    # Chỉ một luồng tải lại worksheet, các luồng khác chờ và dùng chung kết quả
+    with _fetch_locks[title]:
+        snapshot = _fresh_snapshot(title, max_age)
+        if snapshot is not None:
+            return snapshot
+
+        # Đẩy các thay đổi còn chờ ghi lên Sheets trước để bản chụp mới không bị thiếu
+        _flush_pending(title)
+        values = storage.get_values(title)
+        snapshot = {'values': values, 'records': None, 'indexes': {}, 'fetched_at': time.time()}
+        with _lock:
+            _stats['misses'] += 1
+            _sheet_stats[title]['misses'] += 1
+            _snapshots[title] = snapshot
+        _reapply_pending(title)
+        return snapshot
+
+
+def _build_records(values):
+    """Chuyển bản chụp dạng bảng sang dạng records giống worksheet.get_all_records()."""
+    if not values or values == [[]]:
+        return []
+    headers = values[0]
+    return [dict(zip(headers, numericise_all(row))) for row in values[1:]]
+
+
+def get_all_values(title, max_age=None):
+    """Tương đương worksheet.get_all_values() nhưng đọc từ bản chụp trong bộ nhớ."""
+    snapshot = _get_snapshot(title, max_age)
+    return [list(row) for row in snapshot['values']]
+
+
+def get_all_records(title, max_age=None):
+    """Tương đương worksheet.get_all_records() nhưng đọc từ bản chụp trong bộ nhớ."""
+    snapshot = _get_snapshot(title, max_age)
+    with _lock:
+        if snapshot['records'] is None:
+            snapshot['records'] = _build_records(snapshot['values'])
+        records = snapshot['records']
+    return [dict(record) for record in records]
+
+
+def _index_rows(index, key_fn, rows, start_row):
+    for row_number, row in enumerate(rows, start=start_row):
+        try:
+            key = key_fn(row)
+        except (IndexError, ValueError):
+            continue
+        if key is not None:
+            index.setdefault(key, []).append(row_number)
+
+
+def build_row_index(values, key_fn):
+    """Dựng chỉ mục khóa -> [số dòng] từ giá trị cả sheet (dòng đầu là tiêu đề)."""
+    index = {}
+    _index_rows(index, key_fn, values[1:], 2)
+    return index
+
+
+def lookup_rows(title, index_name, key_fn, key):
+    """
+    Tìm các dòng có khóa `key` qua chỉ mục băm (dựng một lần từ bản chụp, cập nhật
+    khi append/xóa) thay vì quét tuần tự. key_fn(row) trả về khóa của một dòng
+    dạng list giá trị (hoặc None để bỏ qua). Trả về [(số dòng, giá trị dòng), ...].
+    Nếu không thấy khóa thì chỉ đọc các cột khóa (KEY_COLUMNS_RANGE); khóa có trên sheet
+    (bản chụp thiếu dòng) mới tải lại cả sheet rồi tìm lại.
+    """
+    matches = _lookup_snapshot(_get_snapshot(title, INDEX_MAX_AGE_SECONDS), index_name, key_fn, key)
+    if matches:
+        return matches
+    if key not in build_row_index(get_range(title, KEY_COLUMNS_RANGE), key_fn):
+        return []
+    return _lookup_snapshot(_get_snapshot(title, 0), index_name, key_fn, key)
+
+
+def _lookup_snapshot(snapshot, index_name, key_fn, key):
+    with _lock:
+        entry = snapshot['indexes'].get(index_name)
+        if entry is None:
+            entry = (key_fn, {})
+            _index_rows(entry[1], key_fn, snapshot['values'][1:], 2)
+            snapshot['indexes'][index_name] = entry
+        values = snapshot['values']
+        return [(r, list(values[r - 1])) for r in entry[1].get(key, []) if r - 1 < len(values)]
+
+
+def invalidate(title=None):
+    """Hủy bản chụp của một worksheet (hoặc toàn bộ nếu không truyền title)."""
+    with _lock:
+        titles = [title] if title else list(_snapshots.keys())
+        for t in titles:
+            if _snapshots.pop(t, None) is not None:
+                _stats['invalidations'] += 1
+                _sheet_stats[t]['invalidations'] += 1
+
+
+def _flush_pending(title):
+    import write_queue
+    write_queue.flush(title)
+
+
+def _reapply_pending(title):
+    # Nếu lần đẩy trước bị lỗi, các vùng ô vẫn còn trong hàng đợi: áp lại lên bản chụp mới
+    import write_queue
+    for range_name, values in write_queue.pending_updates(title):
+        patch(title, range_name, values)
+
+
+def patch(title, range_name, values):
+    """
+    Ghi đè một vùng ô trực tiếp lên bản chụp trong bộ nhớ (không gọi API).
+    Dùng cho hàng đợi ghi trễ: Flex trả lời ngay từ trạng thái mới trong khi
+    việc ghi thật lên Sheets được gom lại sau.
+    """
+    grid = a1_range_to_grid_range(range_name)
+    start_row = grid.get('startRowIndex', 0)
+    start_col = grid.get('startColumnIndex', 0)
+    with _lock:
+        snapshot = _snapshots.get(title)
+        if snapshot is None:
+            return False
+        rows = snapshot['values']
+        for r_offset, row_values in enumerate(values):
+            r = start_row + r_offset
+            while len(rows) <= r:
+                rows.append([])
+            row = rows[r]
+            for c_offset, value in enumerate(row_values):
+                c = start_col + c_offset
+                while len(row) <= c:
+                    row.append('')
+                row[c] = '' if value is None else str(value)
+        snapshot['records'] = None
+        return True
+
+
+# --- GHI XUYÊN (WRITE-THROUGH) ---
+
+def update_range(title, range_name, values):
+    """Ghi một vùng ô rồi hủy bản chụp của worksheet."""
+    try:
+        return storage.batch_update(title, [{'range': range_name, 'values': values}])
+    finally:
+        invalidate(title)
+
+
+def batch_update(title, data):
+    """Ghi nhiều vùng ô trong một lần gọi API. data: [{'range': 'F2:H2', 'values': [[...]]}, ...]"""
+    if not data:
+        return None
+    try:
+        return storage.batch_update(title, data)
+    finally:
+        invalidate(title)
+
+
+def _extend_snapshot(title, rows, start_row):
+    # Nối các dòng vừa append vào bản chụp nếu vị trí backend trả về khớp với bản chụp
+    if not start_row:
+        return False
+    start_index = start_row - 1
+    with _lock:
+        snapshot = _snapshots.get(title)
+        if snapshot is None or len(snapshot['values']) != start_index:
+            return False
+        new_rows = [['' if v is None else str(v) for v in row] for row in rows]
+        snapshot['values'].extend(new_rows)
+        snapshot['records'] = None
+        for key_fn, index in snapshot['indexes'].values():
+            _index_rows(index, key_fn, new_rows, start_index + 1)
+        return True
+
+
+def append_rows(title, rows, value_input_option='USER_ENTERED'):
+    """Thêm nhiều dòng vào cuối worksheet, cập nhật luôn bản chụp (hoặc hủy nếu không khớp)."""
+    if not rows:
+        return None
+    start_row = None
+    try:
+        start_row = storage.append_rows(title, rows, value_input_option=value_input_option)
+        return start_row
+    finally:
+        if not _extend_snapshot(title, rows, start_row):
+            invalidate(title)
+
+
+def get_range(title, range_name):
+    """
+    Đọc trực tiếp một vùng nhỏ (vd: 'A:C' chỉ các cột khóa) thay vì tải cả sheet.
+    Các ô đang chờ ghi được đẩy lên trước để số dòng trả về là chính xác.
+    """
+    _flush_pending(title)
+    return storage.get_range(title, range_name)
+
+
+def to_row_ranges(row_numbers):
+    """Gom danh sách số dòng thành các khoảng liên tiếp: [2, 3, 4, 7] -> [(2, 4), (7, 7)]."""
+    ranges = []
+    for row in sorted(set(row_numbers)):
+        if ranges and row == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], row)
+        else:
+            ranges.append((row, row))
+    return ranges
+
+
+def delete_row_ranges(title, row_ranges):
+    """
+    Xóa nhiều khoảng dòng liên tiếp [(start, end), ...] (đánh số từ 1, gồm cả end)
+    trong MỘT lệnh. Các khoảng được xóa từ dưới lên để số dòng không bị lệch.
+    """
+    if not row_ranges:
+        return None
+    import write_queue
+    # Giữ hàng đợi ghi đứng yên từ lúc đẩy các vùng đang chờ tới lúc dời số dòng,
+    # để không lô nào ghi theo số dòng cũ sau khi đã xóa
+    with write_queue.paused():
+        try:
+            _flush_pending(title)
+            response = storage.delete_row_ranges(title, row_ranges)
+        except Exception:
+            invalidate(title)
+            raise
+        # Các vùng ô còn chờ ghi (vd. đang chờ thử lại) trỏ theo số dòng cũ: dời theo
+        write_queue.shift_rows(title, row_ranges)
+    # Xóa các dòng tương ứng khỏi bản chụp (chỉ mục sẽ được dựng lại khi cần).
+    # Bản chụp đã cũ thì hủy luôn vì số dòng sau khi xóa có thể bị lệch.
+    with _lock:
+        snapshot = _snapshots.get(title)
+        if snapshot is not None and time.time() - snapshot['fetched_at'] <= SNAPSHOT_TTL_SECONDS:
+            for start, end in sorted(row_ranges, reverse=True):
+                del snapshot['values'][start - 1:end]
+            snapshot['records'] = None
+            snapshot['indexes'] = {}
+        elif snapshot is not None:
+            invalidate(title)
+    return response
+
+
+def clear(title, headers=None):
+    """Xóa trắng worksheet (ghi lại dòng tiêu đề nếu có) rồi hủy bản chụp."""
+    try:
+        _flush_pending(title)
+        storage.clear(title, headers=headers)
+    finally:
+        invalidate(title)
+
+
+def get_cache_stats():
+    """Số liệu hit/miss để theo dõi số lần gọi Sheets API đã tiết kiệm được."""
+    with _lock:
+        total = _stats['hits'] + _stats['misses']
+        now = time.time()
+        return {
+            'hits': _stats['hits'],
+            'misses': _stats['misses'],
+            'invalidations': _stats['invalidations'],
+            'hit_rate': round(_stats['hits'] / total, 3) if total else 0.0,
+            'ttl_seconds': SNAPSHOT_TTL_SECONDS,
+            'worksheets': {
+                title: dict(counts, age_seconds=round(now - _snapshots[title]['fetched_at'], 1) if title in _snapshots else None)
+                for title, counts in _sheet_stats.items()
+            }
+        }
@@ -0,0 +1,104 @@
+import threading
+
+import gspread
+from gspread.utils import a1_range_to_grid_range, rowcol_to_a1
+
+# Import từ file cấu hình trung tâm
+from config import get_spreadsheet
+
+# --- BACKEND GOOGLE SHEETS (gspread) ---
+# Cài đặt mặc định của storage: mọi thao tác đọc/ghi đi thẳng lên Google Sheets.
+
+_lock = threading.Lock()
+_worksheets = {}
+
+
+def get_worksheet(title, headers=None, rows=1000, cols=20):
+    """
+    Lấy đối tượng worksheet (có nhớ đệm). Nếu chưa tồn tại và có truyền headers
+    thì tạo mới worksheet với dòng tiêu đề đó, ngược lại ném WorksheetNotFound.
+    """
+    with _lock:
+        worksheet = _worksheets.get(title)
+    if worksheet is not None:
+        return worksheet
+
+    spreadsheet = get_spreadsheet()
+    try:
+        worksheet = spreadsheet.worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        if headers is None:
+            raise
+        worksheet = spreadsheet.add_worksheet(title=title, rows=str(rows), cols=str(cols))
+        worksheet.append_row(headers)
+        print(f"Đã tạo worksheet mới: {title}")
+
+    with _lock:
+        _worksheets[title] = worksheet
+    return worksheet
+
+
+def ensure(title, headers=None, rows=1000, cols=20):
+    get_worksheet(title, headers=headers, rows=rows, cols=cols)
+    return True
+
+
+def get_values(title):
+    return get_worksheet(title).get_all_values()
+
+
+def get_range(title, range_name):
+    return get_worksheet(title).get(range_name)
+
+
+def batch_update(title, data):
+    return get_worksheet(title).batch_update(data)
+
+
+def append_rows(title, rows, value_input_option='USER_ENTERED'):
+    """Thêm dòng vào cuối sheet, trả về số dòng (đánh số từ 1) của dòng đầu tiên vừa thêm."""
+    response = get_worksheet(title).append_rows(rows, value_input_option=value_input_option)
+    try:
+        updated_range = response['updates']['updatedRange'].split('!')[-1]
+        return a1_range_to_grid_range(updated_range).get('startRowIndex', 0) + 1
+    except (TypeError, KeyError, ValueError):
+        return None
+
+
+def delete_row_ranges(title, row_ranges):
+    """Xóa các khoảng dòng [(start, end), ...] trong một lệnh batch_update, từ dưới lên."""
+    worksheet = get_worksheet(title)
+    requests = [
+        {'deleteDimension': {'range': {
+            'sheetId': worksheet.id, 'dimension': 'ROWS',
+            'startIndex': start - 1, 'endIndex': end
+        }}}
+        for start, end in sorted(row_ranges, reverse=True)
+    ]
+    return worksheet.spreadsheet.batch_update({'requests': requests})
+
+
+def clear(title, headers=None):
+    worksheet = get_worksheet(title)
+    worksheet.clear()
+    if headers:
+        worksheet.append_row(headers)
+
+
+def _column_letter(col):
+    return rowcol_to_a1(1, col)[:-1]
+
+
+def replace_all(title, values):
+    """Ghi đè toàn bộ nội dung sheet (dùng cho bản sao đồng bộ từ SQLite)."""
+    worksheet = get_worksheet(title, headers=values[0] if values else None)
+    # Ghi đè dữ liệu mới trước rồi mới xóa phần thừa (dưới/phải), để trang không bao
+    # giờ trống (kể cả khi lệnh thứ hai lỗi, trang vẫn giữ dữ liệu mới)
+    if values:
+        worksheet.update(range_name='A1', values=values, value_input_option='USER_ENTERED')
+    last_col = _column_letter(max(worksheet.col_count, 1))
+    tail = [f"A{len(values) + 1}:{last_col}"]  # mọi dòng phía dưới dữ liệu mới
+    width = max((len(row) for row in values), default=0)
+    if values and width < worksheet.col_count:
+        tail.append(f"{_column_letter(width + 1)}1:{last_col}{len(values)}")
+    worksheet.batch_clear(tail)
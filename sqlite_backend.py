@@ -0,0 +1,194 @@
+import os
+import json
+import sqlite3
+import threading
+import contextlib
+from datetime import datetime
+
+from gspread.utils import a1_range_to_grid_range
+
+# --- BACKEND SQLITE (WAL) ---
+# Lưu các trang trạng thái (task_tracker, adhoc_tasks, meal/vesinh tracker, ...)
+# ngay trên đĩa cục bộ với cùng "hình dạng" worksheet: mỗi dòng là một danh
+# sách ô, đánh số dòng từ 1 (dòng 1 là tiêu đề) giống hệt Google Sheets, nên
+# các handler và sheet_cache không cần biết dữ liệu đang nằm ở đâu.
+# Lần đầu dùng một trang còn trống, dữ liệu được nạp (seed) từ Google Sheets.
+
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'bot_state.db')
+SEED_FROM_SHEETS = os.environ.get('STORAGE_SEED_FROM_SHEETS', '1') != '0'
+
+_lock = threading.RLock()
+_conn = None
+_seeded = set()
+
+
+def _connect():
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS sheet_rows (sheet TEXT NOT NULL, position INTEGER NOT NULL, cells TEXT NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sheet_rows_position ON sheet_rows (sheet, position)')
+        conn.execute('CREATE TABLE IF NOT EXISTS sheet_meta (sheet TEXT PRIMARY KEY, seeded_at TEXT)')
+        _conn = conn
+        print(f"Đã mở kho SQLite tại {SQLITE_PATH} (WAL).")
+    return _conn
+
+
+@contextlib.contextmanager
+def _transaction(title):
+    with _lock:
+        conn = _connect()
+        _ensure_seeded(conn, title)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+def _row_count(conn, title):
+    return conn.execute('SELECT COUNT(*) FROM sheet_rows WHERE sheet = ?', (title,)).fetchone()[0]
+
+
+def _insert_rows(conn, title, rows, start_position):
+    conn.executemany(
+        'INSERT INTO sheet_rows (sheet, position, cells) VALUES (?, ?, ?)',
+        [(title, start_position + i, json.dumps(_to_cells(row), ensure_ascii=False)) for i, row in enumerate(rows)]
+    )
+
+
+def _to_cells(row):
+    return ['' if v is None else str(v) for v in row]
+
+
+def _ensure_seeded(conn, title):
+    if title in _seeded:
+        return
+    if conn.execute('SELECT 1 FROM sheet_meta WHERE sheet = ?', (title,)).fetchone() or not SEED_FROM_SHEETS:
+        _seeded.add(title)
+        return
+    if _row_count(conn, title) > 0:
+        return
+    try:
+        import gspread
+        import sheets_backend
+        try:
+            values = sheets_backend.get_values(title)
+        except gspread.exceptions.WorksheetNotFound:
+            values = []
+    except Exception as e:
+        # Chưa nạp được thì báo lỗi cho thao tác hiện tại và lần sau thử lại. Không để
+        # thao tác nào ghi vào trang còn trống, nếu không trang sẽ bị coi như đã có dữ liệu.
+        print(f"Không nạp được dữ liệu ban đầu của {title} từ Google Sheets: {e}")
+        raise
+    conn.execute('BEGIN IMMEDIATE')
+    _insert_rows(conn, title, values, 1)
+    conn.execute('INSERT OR REPLACE INTO sheet_meta (sheet, seeded_at) VALUES (?, ?)', (title, datetime.now().isoformat()))
+    conn.execute('COMMIT')
+    _seeded.add(title)
+    print(f"Đã nạp {len(values)} dòng của {title} từ Google Sheets vào SQLite.")
+
+
+def _read_rows(conn, title):
+    return [json.loads(cells) for (cells,) in conn.execute(
+        'SELECT cells FROM sheet_rows WHERE sheet = ? ORDER BY position', (title,))]
+
+
+def _strip_trailing_empty(rows):
+    while rows and not any(rows[-1]):
+        rows.pop()
+    return rows
+
+
+def ensure(title, headers=None, rows=1000, cols=20):
+    with _lock:
+        conn = _connect()
+        _ensure_seeded(conn, title)
+        if headers and _row_count(conn, title) == 0:
+            with _transaction(title) as tx:
+                _insert_rows(tx, title, [headers], 1)
+    return True
+
+
+def get_values(title):
+    """Giống worksheet.get_all_values(): bảng chữ nhật, bỏ các dòng trống ở cuối."""
+    with _lock:
+        conn = _connect()
+        _ensure_seeded(conn, title)
+        rows = _strip_trailing_empty(_read_rows(conn, title))
+    width = max((len(r) for r in rows), default=0)
+    return [r + [''] * (width - len(r)) for r in rows]
+
+
+def get_range(title, range_name):
+    """Giống worksheet.get('A:C'): chỉ lấy các cột trong vùng, bỏ ô trống ở cuối mỗi dòng."""
+    grid = a1_range_to_grid_range(range_name)
+    start_col = grid.get('startColumnIndex', 0)
+    end_col = grid.get('endColumnIndex')
+    result = []
+    for row in get_values(title):
+        cells = row[start_col:end_col]
+        while cells and cells[-1] == '':
+            cells.pop()
+        result.append(cells)
+    return _strip_trailing_empty(result)
+
+
+def batch_update(title, data):
+    with _transaction(title) as conn:
+        count = _row_count(conn, title)
+        for item in data:
+            grid = a1_range_to_grid_range(item['range'])
+            start_row = grid.get('startRowIndex', 0)
+            start_col = grid.get('startColumnIndex', 0)
+            for r_offset, row_values in enumerate(item['values']):
+                position = start_row + r_offset + 1
+                if position > count:
+                    _insert_rows(conn, title, [[] for _ in range(position - count)], count + 1)
+                    count = position
+                (cells,) = conn.execute(
+                    'SELECT cells FROM sheet_rows WHERE sheet = ? AND position = ?', (title, position)).fetchone()
+                cells = json.loads(cells)
+                for c_offset, value in enumerate(_to_cells(row_values)):
+                    c = start_col + c_offset
+                    while len(cells) <= c:
+                        cells.append('')
+                    cells[c] = value
+                conn.execute('UPDATE sheet_rows SET cells = ? WHERE sheet = ? AND position = ?',
+                             (json.dumps(cells, ensure_ascii=False), title, position))
+    return None
+
+
+def append_rows(title, rows, value_input_option='USER_ENTERED'):
+    """Thêm dòng sau dòng có dữ liệu cuối cùng, trả về số dòng của dòng đầu tiên vừa thêm."""
+    with _transaction(title) as conn:
+        start = len(_strip_trailing_empty(_read_rows(conn, title))) + 1
+        conn.execute('DELETE FROM sheet_rows WHERE sheet = ? AND position >= ?', (title, start))
+        _insert_rows(conn, title, rows, start)
+    return start
+
+
+def delete_row_ranges(title, row_ranges):
+    with _transaction(title) as conn:
+        for start, end in sorted(row_ranges, reverse=True):
+            conn.execute('DELETE FROM sheet_rows WHERE sheet = ? AND position BETWEEN ? AND ?', (title, start, end))
+            conn.execute('UPDATE sheet_rows SET position = position - ? WHERE sheet = ? AND position > ?',
+                         (end - start + 1, title, end))
+    return None
+
+
+def clear(title, headers=None):
+    with _transaction(title) as conn:
+        conn.execute('DELETE FROM sheet_rows WHERE sheet = ?', (title,))
+        if headers:
+            _insert_rows(conn, title, [headers], 1)
+
+
+def get_row_counts():
+    with _lock:
+        conn = _connect()
+        return dict(conn.execute('SELECT sheet, COUNT(*) FROM sheet_rows GROUP BY sheet'))
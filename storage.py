@@ -0,0 +1,133 @@
+import os
+import atexit
+import threading
+import time
+
+import sheets_backend
+
+# Import từ file cấu hình trung tâm
+from config import (
+    WORKSHEET_TRACKER_NAME, WORKSHEET_ADHOC_TASKS, WORKSHEET_MEAL_TRACKER_NAME,
+    WORKSHEET_VESINH_TRACKER_NAME, WORKSHEET_GROUP_MEMBERS, WORKSHEET_NAME_USERS
+)
+
+# --- LỚP LƯU TRỮ CÓ THỂ THAY BACKEND ---
+# Mọi thao tác đọc/ghi theo dạng worksheet (sheet_cache, write_queue) đi qua đây.
+# STORAGE_BACKEND=sheets (mặc định): giữ nguyên hành vi cũ, đọc/ghi Google Sheets.
+# STORAGE_BACKEND=sqlite: các trang trạng thái bên dưới nằm trong SQLite cục bộ;
+# lịch làm việc (schedules) và báo cáo (chi_tiet_cum) vẫn đọc từ Google Sheets
+# vì do quản lý nhập tay. Khi bật STORAGE_SHEETS_MIRROR=1, các trang cục bộ được
+# chép ngược lên Google Sheets định kỳ (bất đồng bộ) để quản lý vẫn xem được.
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sheets').strip().lower()
+MIRROR_ENABLED = os.environ.get('STORAGE_SHEETS_MIRROR', '0') == '1'
+MIRROR_INTERVAL_SECONDS = float(os.environ.get('STORAGE_MIRROR_INTERVAL_SECONDS', '60'))
+
+LOCAL_WORKSHEETS = {
+    WORKSHEET_TRACKER_NAME, WORKSHEET_ADHOC_TASKS, WORKSHEET_MEAL_TRACKER_NAME,
+    WORKSHEET_VESINH_TRACKER_NAME, WORKSHEET_GROUP_MEMBERS, WORKSHEET_NAME_USERS
+}
+
+_lock = threading.Lock()
+_dirty = set()
+_mirror_thread = None
+_mirror_stats = {'runs': 0, 'sheets_written': 0, 'errors': 0, 'last_run_at': None}
+
+
+def backend_for(title):
+    """Trả về module backend phụ trách worksheet này."""
+    if STORAGE_BACKEND == 'sqlite' and title in LOCAL_WORKSHEETS:
+        import sqlite_backend
+        return sqlite_backend
+    return sheets_backend
+
+
+def _after_write(title):
+    if not MIRROR_ENABLED or backend_for(title) is sheets_backend:
+        return
+    global _mirror_thread
+    with _lock:
+        _dirty.add(title)
+        if _mirror_thread is None or not _mirror_thread.is_alive():
+            _mirror_thread = threading.Thread(target=_run_mirror, name='sheets-mirror', daemon=True)
+            _mirror_thread.start()
+
+
+def _run_mirror():
+    while True:
+        time.sleep(MIRROR_INTERVAL_SECONDS)
+        mirror_now()
+
+
+def mirror_now():
+    """Chép các trang cục bộ đã thay đổi lên Google Sheets (ghi đè cả trang)."""
+    with _lock:
+        titles = list(_dirty)
+        _dirty.clear()
+    for title in titles:
+        try:
+            values = backend_for(title).get_values(title)
+            sheets_backend.replace_all(title, values)
+            with _lock:
+                _mirror_stats['sheets_written'] += 1
+        except Exception as e:
+            with _lock:
+                _dirty.add(title)
+                _mirror_stats['errors'] += 1
+            print(f"Lỗi đồng bộ {title} lên Google Sheets: {e}")
+    with _lock:
+        _mirror_stats['runs'] += 1
+        _mirror_stats['last_run_at'] = time.time()
+
+
+if MIRROR_ENABLED:
+    atexit.register(mirror_now)
+
+
+# --- GIAO DIỆN DẠNG WORKSHEET ---
+
+def ensure(title, headers=None, rows=1000, cols=20):
+    return backend_for(title).ensure(title, headers=headers, rows=rows, cols=cols)
+
+
+def get_values(title):
+    return backend_for(title).get_values(title)
+
+
+def get_range(title, range_name):
+    return backend_for(title).get_range(title, range_name)
+
+
+def batch_update(title, data):
+    result = backend_for(title).batch_update(title, data)
+    _after_write(title)
+    return result
+
+
+def append_rows(title, rows, value_input_option='USER_ENTERED'):
+    """Trả về số dòng (đánh số từ 1) của dòng đầu tiên vừa thêm, hoặc None nếu không rõ."""
+    start_row = backend_for(title).append_rows(title, rows, value_input_option=value_input_option)
+    _after_write(title)
+    return start_row
+
+
+def delete_row_ranges(title, row_ranges):
+    result = backend_for(title).delete_row_ranges(title, row_ranges)
+    _after_write(title)
+    return result
+
+
+def clear(title, headers=None):
+    result = backend_for(title).clear(title, headers=headers)
+    _after_write(title)
+    return result
+
+
+def get_storage_stats():
+    stats = {'backend': STORAGE_BACKEND, 'mirror_enabled': MIRROR_ENABLED}
+    if STORAGE_BACKEND == 'sqlite':
+        import sqlite_backend
+        stats['sqlite_rows'] = sqlite_backend.get_row_counts()
+        with _lock:
+            stats['mirror'] = dict(_mirror_stats, pending=sorted(_dirty))
+    return stats
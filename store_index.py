@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+
+# Import từ file cấu hình trung tâm
+from config import WORKSHEET_NAME
+import sheet_cache
+
+# --- CHỈ MỤC TÊN CỤM / MÃ SIÊU THỊ ---
+# Khối báo cáo cuối handle_message từng tải cả trang chi_tiet_cum chỉ để biết
+# tin nhắn có phải tên cụm hay mã siêu thị không, nên mọi câu trò chuyện trong
+# nhóm đều thành một lượt đọc Sheets. Chỉ mục này giữ sẵn hai tập khóa (tên cụm
+# viết hoa, mã siêu thị = từ đầu cột C) trong bộ nhớ; tra cứu không bao giờ gọi
+# I/O. Khi chỉ mục cũ hơn STORE_INDEX_REFRESH_SECONDS, một luồng nền dựng lại,
+# trong lúc đó vẫn dùng bản cũ. Chưa có chỉ mục (khởi động nguội) thì dựng đồng bộ
+# một lần qua sheet_cache để không bỏ sót tin nhắn; nếu lần dựng đó lỗi thì trong
+# STORE_INDEX_COLD_RETRY_SECONDS giây tiếp theo tin nhắn không gọi I/O nữa, một
+# luồng hẹn giờ tự thử dựng lại. Dữ liệu báo cáo đầy đủ chỉ được tải khi khớp.
+REFRESH_SECONDS = float(os.environ.get('STORE_INDEX_REFRESH_SECONDS', '600'))
+COLD_RETRY_SECONDS = float(os.environ.get('STORE_INDEX_COLD_RETRY_SECONDS', '60'))
+
+_lock = threading.Lock()
+_build_lock = threading.Lock()
+_index = None  # {'clusters': frozenset, 'stores': frozenset, 'built_at': epoch}
+_refreshing = False
+_cold_failed_at = None  # lần dựng gần nhất lỗi khi chưa có chỉ mục
+_retry_timer = None
+_stats = {'lookups': 0, 'matched': 0, 'refreshes': 0, 'refresh_errors': 0, 'cold_misses': 0, 'cold_skipped': 0}
+
+
+def build_index(all_data):
+    """Dựng chỉ mục từ toàn bộ giá trị trang chi_tiet_cum (dòng đầu là tiêu đề)."""
+    rows = all_data[1:] if all_data else []
+    return {
+        'clusters': frozenset(row[0].strip().upper() for row in rows if len(row) > 0 and row[0]),
+        'stores': frozenset(row[2].strip().split(' ')[0] for row in rows if len(row) > 2 and row[2]),
+        'built_at': time.time(),
+    }
+
+
+def update_from_values(all_data):
+    """Thay chỉ mục bằng dữ liệu vừa tải được ở nơi khác (vd. lúc trả lời báo cáo)."""
+    global _index
+    index = build_index(all_data)
+    with _lock:
+        _index = index
+    return index
+
+
+def refresh():
+    """Tải lại chi_tiet_cum (qua sheet_cache) và dựng lại chỉ mục. Gọi từ luồng nền/khởi động."""
+    global _refreshing, _cold_failed_at
+    try:
+        update_from_values(sheet_cache.get_all_values(WORKSHEET_NAME))
+        with _lock:
+            _stats['refreshes'] += 1
+            _cold_failed_at = None
+        return True
+    except Exception as e:
+        with _lock:
+            _stats['refresh_errors'] += 1
+            if _index is None:
+                _cold_failed_at = time.time()
+                _schedule_cold_retry()
+        print(f"Lỗi dựng chỉ mục cụm/siêu thị: {e}")
+        return False
+    finally:
+        with _lock:
+            _refreshing = False
+
+
+def _refresh_in_background():
+    """Gọi khi đang giữ _lock: mở một luồng làm mới nếu chưa có luồng nào chạy."""
+    global _refreshing
+    if _refreshing:
+        return
+    _refreshing = True
+    threading.Thread(target=refresh, name='store-index-refresh', daemon=True).start()
+
+
+def _schedule_cold_retry():
+    """Gọi khi đang giữ _lock: hẹn một lần dựng lại nền sau COLD_RETRY_SECONDS."""
+    global _retry_timer
+    if _retry_timer is not None and _retry_timer.is_alive():
+        return
+    _retry_timer = threading.Timer(COLD_RETRY_SECONDS, refresh)
+    _retry_timer.daemon = True
+    _retry_timer.start()
+
+
+def _cold_backoff():
+    """Gọi khi đang giữ _lock: True nếu lần dựng nguội vừa lỗi, chưa nên thử lại."""
+    if _cold_failed_at is not None and time.time() - _cold_failed_at < COLD_RETRY_SECONDS:
+        _stats['cold_skipped'] += 1
+        return True
+    return False
+
+
+def _build_cold():
+    """Dựng chỉ mục đồng bộ khi chưa có; các luồng cùng lúc chờ chung một lần tải."""
+    with _build_lock:
+        with _lock:
+            if _index is not None:
+                return _index
+            if _cold_backoff():
+                return None
+            _stats['cold_misses'] += 1
+        refresh()
+        with _lock:
+            return _index
+
+
+def classify(text_upper):
+    """
+    Phân loại tin nhắn (đã viết hoa) theo chỉ mục, không gọi I/O khi chỉ mục đã có:
+    'cluster_channel' ("<CỤM> 1"), 'cluster', 'store', hoặc None.
+    """
+    with _lock:
+        _stats['lookups'] += 1
+        index = _index
+        if index is not None and time.time() - index['built_at'] > REFRESH_SECONDS:
+            _refresh_in_background()
+        if index is None and _cold_backoff():
+            return None
+    if index is None:
+        index = _build_cold()
+        if index is None:
+            return None
+
+    parts = text_upper.split()
+    kind = None
+    if len(parts) == 2 and parts[0] in index['clusters']:
+        kind = 'cluster_channel'
+    elif text_upper in index['clusters']:
+        kind = 'cluster'
+    elif text_upper in index['stores']:
+        kind = 'store'
+    if kind:
+        with _lock:
+            _stats['matched'] += 1
+    return kind
+
+
+def get_index_stats():
+    with _lock:
+        return dict(
+            _stats,
+            clusters=len(_index['clusters']) if _index else None,
+            stores=len(_index['stores']) if _index else None,
+            age_s=round(time.time() - _index['built_at'], 1) if _index else None,
+            refresh_seconds=REFRESH_SECONDS,
+        )
@@ -0,0 +1,80 @@
+import os
+import re
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import command_router
+
+
+class TestCommandRouter(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in [('_commands', {}), ('_exact', {}), ('_exact_compact', {}), ('_prefixes', []),
+                            ('_patterns', []), ('_matchers', []),
+                            ('_stats', {'messages': 0, 'matched': 0, 'unmatched': 0, 'denied': 0})]:
+            patcher = patch.object(command_router, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.calls = []
+        for name, kwargs in [
+            ('menu', {'exact': ['MENU']}),
+            ('menu_bot', {'exact': ['MENU BOT'], 'public': True}),
+            ('meal', {'compact': ['an', 'ansang']}),
+            ('vesinh', {'compact_prefix': ['vesinh']}),
+            ('nhanvien', {'prefix': ['NV ', 'NV0 ']}),
+            ('schedule_day', {'pattern': re.compile(r'^(NV|PG)([2-8])$', re.IGNORECASE)}),
+            ('report', {'match': lambda msg: len(msg['upper'].split()) == 1}),
+        ]:
+            command_router.command(name, **kwargs)(self.recorder(name))
+
+    def recorder(self, name):
+        def handler(event, msg):
+            self.calls.append((name, msg['match'].group(2) if msg['match'] else None))
+        return handler
+
+    def route(self, text, authorize=None):
+        return command_router.dispatch(None, command_router.parse(text), authorize=authorize)
+
+    def test_exact_then_prefix_then_regex_then_matcher(self):
+        self.assertEqual(self.route('  menu bot '), 'menu_bot')
+        self.assertEqual(self.route('menu'), 'menu')
+        self.assertEqual(self.route('An Sang'), 'meal')
+        self.assertEqual(self.route('ve sinh chieu'), 'vesinh')
+        self.assertEqual(self.route('nv0 Dương'), 'nhanvien')
+        self.assertEqual(self.route('nv3'), 'schedule_day')
+        self.assertEqual(self.route('12345'), 'report')
+        self.assertEqual(self.calls[-2], ('schedule_day', '3'))
+
+    def test_unmatched_message_runs_nothing(self):
+        self.assertIsNone(self.route('hôm nay ai trực kho vậy mọi người'))
+        self.assertEqual(self.calls, [])
+        stats = command_router.get_router_stats()
+        self.assertEqual((stats['messages'], stats['unmatched']), (1, 1))
+
+    def test_authorize_sees_flags_and_can_deny(self):
+        seen = []
+
+        def authorize(cmd, event, msg):
+            seen.append((cmd['name'], cmd['public']))
+            return cmd['public']
+
+        self.assertIsNone(self.route('menu', authorize))
+        self.assertEqual(self.route('menu bot', authorize), 'menu_bot')
+        self.assertEqual(seen, [('menu', False), ('menu_bot', True)])
+        self.assertEqual(self.calls, [('menu_bot', None)])
+        self.assertEqual(command_router.get_router_stats()['denied'], 1)
+
+    def test_latency_counters_per_command(self):
+        self.route('menu')
+        self.route('menu')
+        stats = command_router.get_router_stats()['commands']
+        self.assertEqual(list(stats), ['menu'])
+        self.assertEqual(stats['menu']['calls'], 2)
+        self.assertIsNotNone(stats['menu']['avg_ms'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import unittest
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import dmx_data_provider
+
+
+def make_response(rows, status_code=200):
+    res = MagicMock()
+    res.status_code = status_code
+    res.json.return_value = rows
+    return res
+
+
+class TestDatasetCache(unittest.TestCase):
+
+    def setUp(self):
+        dmx_data_provider._dataset_cache.clear()
+        self.remote = {
+            'Data_BI': {'data': [{'dt': 1}], 'updated_at': 't1'},
+            'Config_ThiDua': {'data': [{'ten': 'A'}], 'updated_at': 't1'},
+        }
+        self.fetched = []
+        patcher = patch.object(dmx_data_provider, '_request', side_effect=self.fake_request)
+        self.request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_request(self, endpoint, method, url, timeout, **kwargs):
+        names = [n for n in self.remote if f'"{n}"' in url]
+        if endpoint == 'dashboard_revalidate':
+            return make_response([{'sheet_name': n, 'updated_at': self.remote[n]['updated_at']} for n in names])
+        self.fetched.append(sorted(names))
+        return make_response([dict(self.remote[n], sheet_name=n) for n in names])
+
+    def test_refetches_only_changed_sheets(self):
+        first = dmx_data_provider.get_dashboard_data("Data_BI,Config_ThiDua")
+        self.assertEqual(first['Data_BI'], [{'dt': 1}])
+
+        self.remote['Data_BI'] = {'data': [{'dt': 2}], 'updated_at': 't2'}
+        with patch.object(dmx_data_provider, 'DATASET_FRESH_SECONDS', 0):
+            second = dmx_data_provider.get_dashboard_data("Data_BI,Config_ThiDua")
+
+        self.assertEqual(second['Data_BI'], [{'dt': 2}])
+        self.assertEqual(second['Config_ThiDua'], [{'ten': 'A'}])
+        self.assertEqual(self.fetched, [['Config_ThiDua', 'Data_BI'], ['Data_BI']])
+
+    def test_fresh_cache_skips_network(self):
+        dmx_data_provider.get_dashboard_data("Data_BI")
+        calls = self.request.call_count
+        dmx_data_provider.get_dashboard_data("Data_BI")
+        self.assertEqual(self.request.call_count, calls)
+
+    def test_serves_stale_data_when_supabase_fails(self):
+        dmx_data_provider.get_dashboard_data("Data_BI")
+        self.request.side_effect = ConnectionError("down")
+        with patch.object(dmx_data_provider, 'DATASET_FRESH_SECONDS', 0):
+            result = dmx_data_provider.get_dashboard_data("Data_BI,Missing")
+        self.assertEqual(result, {'Data_BI': [{'dt': 1}], 'Missing': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,11 +5,13 @@ import os
 
 sys.path.insert(0, os.path.dirname(__file__))
 
+import dmx_flex_messages
 from dmx_flex_messages import build_realtime_flex, build_luyke_flex, build_nhanvien_flex, parse_number, fmt_num, shorten_name
 
 class TestDmxFlexMessages(unittest.TestCase):
 
     def setUp(self):
+        dmx_flex_messages._render_cache.clear()
         bi_rows = [
             {"nhóm ngành hàng": f"Ngành {i}", "doanh thu quy đổi": 120.9 + i * 10, "số lượng": 25 + i, "target": 45.1 + i * 5}
             for i in range(1, 10)
@@ -60,6 +62,38 @@ class TestDmxFlexMessages(unittest.TestCase):
         self.assertEqual(shorten_name("Điện gia dụng"), "Đ.Gia Dụng")
         self.assertEqual(shorten_name("Nhóm Thi Đua 23"), "T.Đua 23")
 
+    def test_numeric_columns_matches_parse_number(self):
+        from dmx_flex_messages import numeric_columns, get_key_val
+        values = [None, "", " 1.234,5 ", "1,234.5", "12,5", "45%", "abc", 3, 2.5, "1 000", "-3,2%", "12.345.678,9"]
+        rows = [{"Doanh thu": v, "Target": "1.000"} for v in values] + [{"doanh thu quy đổi": "7,5"}, None]
+        result = numeric_columns(rows, dt=("Doanh thu Quy đổi", "Doanh thu"), tg=("target",))
+        self.assertEqual(result["dt"], [parse_number(get_key_val(r, "Doanh thu Quy đổi", "Doanh thu", default=0.0)) for r in rows])
+        self.assertEqual(result["tg"], [1.0] * len(values) + [0.0, 0.0])
+        self.assertEqual(numeric_columns([], dt=("Doanh thu",)), {"dt": []})
+
+    def test_parse_growth_rate(self):
+        from dmx_flex_messages import parse_growth_rate
+        for val, expected in [(0.05, 5.0), ("0,12", 12.0), ("-15%", -15.0), ("12,5 %", 12.5), (30, 30.0), ("", 0.0), (None, 0.0)]:
+            self.assertAlmostEqual(parse_growth_rate(val), expected)
+
+    def test_get_key_val_column_plan(self):
+        from dmx_flex_messages import get_key_val
+        row = {" Doanh Thu ": 5, "target": 7}
+        self.assertEqual(get_key_val(row, "doanh thu quy đổi", "doanh thu", default=0), 5)
+        self.assertEqual(get_key_val({" Doanh Thu ": 9, "target": 1}, "doanh thu quy đổi", "doanh thu"), 9)
+        self.assertEqual(get_key_val(row, "target", "Target"), 7)
+        self.assertEqual(get_key_val(row, "không có", default="x"), "x")
+        self.assertEqual(get_key_val(None, "target", default="x"), "x")
+
+    def test_resolve_columns_from_first_row(self):
+        from dmx_flex_messages import resolve_columns
+        rows = [None, {" Doanh Thu ": 5, "target": 7}, {" Doanh Thu ": 6, "target": 8}]
+        cols = resolve_columns(rows, dt=("doanh thu quy đổi", "doanh thu"), tg=("Target", "target"), sl=("số lượng",))
+        self.assertEqual(cols, {"dt": " Doanh Thu ", "tg": "target", "sl": None})
+        self.assertEqual([r.get(cols["dt"]) for r in rows[1:]], [5, 6])
+        self.assertEqual(rows[1].get(cols["sl"], 0.0), 0.0)
+        self.assertEqual(resolve_columns([], dt=("doanh thu",)), {"dt": None})
+
     @patch("dmx_flex_messages.get_dashboard_data")
     def test_build_realtime_flex_light_theme(self, mock_get_data):
         mock_get_data.return_value = self.mock_data
@@ -124,5 +158,87 @@ class TestDmxFlexMessages(unittest.TestCase):
         self.assertIn("Tiến độ Thi đua", staff_card_str)
         self.assertIn("LK / TG", staff_card_str)
 
+    @patch("dmx_flex_messages.get_dashboard_data")
+    def test_render_cache_reuses_flex_until_data_changes(self, mock_get_data):
+        mock_get_data.return_value = self.mock_data
+        first = build_luyke_flex()
+
+        with patch.object(dmx_flex_messages, "_render_luyke_flex", side_effect=AssertionError("không được vẽ lại")):
+            second = build_luyke_flex()
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+
+        changed = dict(self.mock_data, Data_BI=self.mock_data["Data_BI"][:3])
+        mock_get_data.return_value = changed
+        with patch.object(dmx_flex_messages, "_render_luyke_flex", return_value=["mới"]) as render:
+            self.assertEqual(build_luyke_flex(), ["mới"])
+        render.assert_called_once()
+
+    @patch("dmx_flex_messages.get_locked_target_config")
+    @patch("dmx_flex_messages.get_dashboard_data")
+    def test_nhanvien_staff_actuals_indexed_by_name_and_user(self, mock_get_data, mock_lock):
+        mock_lock.return_value = {"is_locked": True, "staff": [
+            {"name": "101 - Nguyễn Văn A", "userId": "101", "lockedRatio": 0.5},
+            {"name": "Trần Thị B", "userId": "102", "lockedRatio": 0.5},
+        ]}
+        mock_get_data.return_value = dict(
+            self.mock_data,
+            Data_NV_BI=[
+                {"staffUserName": "Nguyễn Văn A", "Doanh thu Quy đổi": 100},
+                {"staffUserName": "NGUYỄN VĂN A", "Doanh thu Quy đổi": 50},
+                {"staffUserName": "Trần Thị B", "Doanh thu Quy đổi": 70},
+            ],
+            Data_NV_ThiDua=[
+                {"staffuser": "101", "programname": "Nhóm Thi Đua 1", "value_compe": 4},
+                {"staffuser": "101", "programname": "Nhóm Thi Đua 1", "value_compe": 1},
+                {"staffuser": "Trần Thị B", "programname": "Nhóm Thi Đua 2", "value_compe": 3},
+            ],
+        )
+        cards = {}
+        with patch.object(dmx_flex_messages, "build_individual_staff_card",
+                          side_effect=lambda e, *a, **k: cards.setdefault(e["name"], e)):
+            build_nhanvien_flex()
+
+        self.assertEqual(cards["Nguyễn Văn A"]["actual"], 150.0)
+        self.assertEqual(cards["Trần Thị B"]["actual"], 70.0)
+        acts_a = {i["name"]: i["actual"] for i in cards["Nguyễn Văn A"]["thi_dua_list"]}
+        acts_b = {i["name"]: i["actual"] for i in cards["Trần Thị B"]["thi_dua_list"]}
+        self.assertEqual((acts_a["Nhóm Thi Đua 1"], acts_a["Nhóm Thi Đua 2"]), (5, 0))
+        self.assertEqual((acts_b["Nhóm Thi Đua 1"], acts_b["Nhóm Thi Đua 2"]), (0, 3))
+
+    def test_staff_index_lookup(self):
+        from dmx_flex_messages import build_staff_index, find_staff_rank
+        index = build_staff_index([
+            {"name": "Nguyễn Văn Dương", "user_id": "61169"},
+            {"name": "Đỗ Thị Dung", "user_id": "NV"},
+        ])
+        self.assertEqual(find_staff_rank(index, "61169"), 1)
+        self.assertEqual(find_staff_rank(index, "duong"), 1)
+        self.assertEqual(find_staff_rank(index, "Văn D"), 1)
+        self.assertEqual(find_staff_rank(index, "do thi"), 2)
+        self.assertEqual(find_staff_rank(index, "2"), 2)
+        self.assertIsNone(find_staff_rank(index, "NV"))
+        self.assertIsNone(find_staff_rank(index, "Lan"))
+
+    @patch("dmx_flex_messages.get_locked_target_config")
+    @patch("dmx_flex_messages.get_dashboard_data")
+    def test_nhanvien_cards_render_per_page(self, mock_get_data, mock_lock):
+        mock_lock.return_value = {"is_locked": True, "staff": [
+            {"name": f"Nhân viên {i}", "userId": str(100 + i), "lockedRatio": 0.1} for i in range(1, 9)
+        ]}
+        mock_get_data.return_value = self.mock_data
+        with patch.object(dmx_flex_messages, "build_individual_staff_card",
+                          side_effect=lambda e, rank, *a, **k: {"type": "bubble", "rank": rank}) as card:
+            report = dmx_flex_messages.build_nhanvien_report()
+            self.assertEqual(card.call_count, 0)
+
+            page = dmx_flex_messages.render_staff_cards(report, *dmx_flex_messages.NHANVIEN_PAGES['nv1'])
+            self.assertEqual([b["rank"] for b in page], [7, 8])
+            self.assertEqual(card.call_count, 2)
+
+            dmx_flex_messages.render_staff_cards(dmx_flex_messages.build_nhanvien_report(), 6, 16)
+            self.assertEqual(card.call_count, 2)
+            self.assertEqual(dmx_flex_messages.render_staff_cards(report, 16, 26), [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,80 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import profile_cache
+
+
+class TestProfileCache(unittest.TestCase):
+
+    def setUp(self):
+        profile_cache.invalidate()
+        profile_cache._stats.update({k: 0 for k in profile_cache._stats})
+        self.calls = []
+
+    def loader(self, name):
+        def load():
+            self.calls.append(name)
+            return name
+        return load
+
+    def test_hit_after_first_lookup_and_ttl_expiry(self):
+        self.assertEqual(profile_cache.get_display_name('G1', 'U1', self.loader('An')), 'An')
+        self.assertEqual(profile_cache.get_display_name('G1', 'U1', self.loader('An')), 'An')
+        self.assertEqual(self.calls, ['An'])
+
+        with patch.object(profile_cache, 'TTL_SECONDS', -1):
+            profile_cache.invalidate()
+            profile_cache.get_display_name('G1', 'U1', self.loader('An'))
+        profile_cache.get_display_name('G1', 'U1', self.loader('An mới'))
+        self.assertEqual(self.calls, ['An', 'An', 'An mới'])
+        stats = profile_cache.get_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['expired']), (1, 3, 1))
+
+    def test_lru_bound(self):
+        with patch.object(profile_cache, 'MAX_ENTRIES', 2):
+            for uid in ('U1', 'U2', 'U1', 'U3'):
+                profile_cache.get_display_name('G1', uid, self.loader(uid))
+        self.assertEqual(list(profile_cache._entries), [('G1', 'U1'), ('G1', 'U3')])
+        self.assertEqual(profile_cache.get_cache_stats()['evictions'], 1)
+
+    def test_concurrent_misses_share_one_call(self):
+        release = threading.Event()
+
+        def slow_load():
+            self.calls.append('x')
+            release.wait(5)
+            return 'Bình'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(profile_cache.get_display_name('G1', 'U2', slow_load)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        deadline = time.time() + 5
+        while profile_cache.get_cache_stats()['coalesced'] < 4:
+            if time.time() > deadline:
+                release.set()
+                self.fail("Các luồng không gộp vào lượt tải đang chạy trong 5 giây")
+            threading.Event().wait(0.01)
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(results, ['Bình'] * 5)
+        self.assertEqual(self.calls, ['x'])
+
+    def test_errors_are_raised_and_not_cached(self):
+        def fail():
+            raise RuntimeError("LINE lỗi")
+        with self.assertRaises(RuntimeError):
+            profile_cache.get_display_name('G1', 'U3', fail)
+        self.assertEqual(profile_cache.get_display_name('G1', 'U3', self.loader('Cường')), 'Cường')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from linebot.exceptions import LineBotApiError
+from linebot.models.error import Error
+
+import reply_dispatcher
+
+
+class TestReplyDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.api = MagicMock()
+        reply_dispatcher.configure(self.api)
+        reply_dispatcher._stats.update({k: 0 for k in reply_dispatcher._stats})
+
+    def make_event(self, age=0.0):
+        event = SimpleNamespace(reply_token='tok', source=SimpleNamespace(type='group', group_id='G1', user_id='U1'))
+        return reply_dispatcher.mark_arrival(event, time.time() - age)
+
+    def test_fresh_event_uses_reply_token(self):
+        reply_dispatcher.reply(self.make_event(), 'msg')
+        self.api.reply_message.assert_called_once_with('tok', 'msg')
+        self.api.push_message.assert_not_called()
+        self.assertEqual(reply_dispatcher.get_dispatch_stats()['reply'], 1)
+
+    def test_expired_window_pushes_to_source(self):
+        reply_dispatcher.reply(self.make_event(age=reply_dispatcher.REPLY_TOKEN_TTL_SECONDS), 'msg')
+        self.api.reply_message.assert_not_called()
+        self.api.push_message.assert_called_once_with('G1', 'msg')
+        self.assertEqual(reply_dispatcher.get_dispatch_stats()['push_expired'], 1)
+
+    def test_invalid_token_error_falls_back_to_push(self):
+        self.api.reply_message.side_effect = LineBotApiError(400, {}, error=Error(message='Invalid reply token'))
+        reply_dispatcher.reply(self.make_event(), 'msg')
+        self.api.push_message.assert_called_once_with('G1', 'msg')
+        self.assertEqual(reply_dispatcher.get_dispatch_stats()['push_fallback'], 1)
+
+    def test_slow_work_sends_interim_then_pushes_result(self):
+        release = threading.Event()
+        event = self.make_event()
+        with patch.object(reply_dispatcher, 'REPLY_INTERIM_AFTER_SECONDS', 0.05):
+            threading.Timer(0.2, release.set).start()
+            result = reply_dispatcher.run_heavy(event, lambda: release.wait(5) and 'flex', 'đang xử lý')
+        self.assertEqual(result, 'flex')
+        self.assertEqual(self.api.reply_message.call_args[0][1].text, 'đang xử lý')
+
+        reply_dispatcher.reply(event, result)
+        self.api.push_message.assert_called_once_with('G1', 'flex')
+        stats = reply_dispatcher.get_dispatch_stats()
+        self.assertEqual((stats['interim'], stats['push_after_interim']), (1, 1))
+
+    def test_fast_work_keeps_single_reply(self):
+        event = self.make_event()
+        result = reply_dispatcher.run_heavy(event, lambda: 'flex', 'đang xử lý')
+        reply_dispatcher.reply(event, result)
+        self.api.reply_message.assert_called_once_with('tok', 'flex')
+        self.assertEqual(reply_dispatcher.get_dispatch_stats()['heavy_fast'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
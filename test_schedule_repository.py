@@ -0,0 +1,88 @@
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import schedule_repository
+
+HEADERS = ['day_of_week', 'employee_schedule', 'pg_schedule']
+MONDAY = [
+    'Thứ Hai',
+    'Ca Sáng (3 NV): An (ERP), Bình GH2, Hoa *<br>Ca Chiều (2 NV): Cường, Dũng (off ca 4)<br>Nghỉ: Em',
+    'Ca Sáng (2):\nLan\nMai\nCa Chiều (1):\nNga\nVệ Sinh Kho: Lan, Mai',
+]
+
+
+class TestScheduleRepository(unittest.TestCase):
+
+    def setUp(self):
+        schedule_repository._state.update({'values': None, 'days': {}})
+        schedule_repository._stats.update({'reads': 0, 'parses': 0})
+        self.values = [HEADERS, MONDAY]
+        patcher = patch.object(schedule_repository.sheet_cache, 'get_all_values',
+                               side_effect=lambda title: [list(r) for r in self.values])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_day_model_has_shift_staff_and_roles(self):
+        self.assertEqual(schedule_repository.get_shift_staff('Thứ Hai', 'NV', 'Ca Sáng'), ['An (ERP)', 'Bình GH2', 'Hoa *'])
+        self.assertEqual(schedule_repository.get_shift_staff('Thứ Hai', 'PG', 'Ca Chiều'), ['Nga'])
+        self.assertEqual(schedule_repository.get_shift_staff('Thứ Hai', 'PG', 'Vệ Sinh Kho'), ['Lan', 'Mai'])
+        self.assertEqual(schedule_repository.get_shift_staff('Thứ Ba', 'NV', 'Ca Sáng'), [])
+
+        morning = schedule_repository.get_day('Thứ Hai')['NV'][0]
+        self.assertEqual(morning['roles'], {'An (ERP)': ['ERP'], 'Bình GH2': ['GH2'], 'Hoa *': ['*']})
+
+    def test_parses_only_when_sheet_changes(self):
+        schedule_repository.get_day('Thứ Hai')
+        schedule_repository.get_day('Thứ Hai')
+        self.assertEqual(schedule_repository.get_repository_stats()['parses'], 1)
+
+        self.values = [HEADERS, ['Thứ Hai', 'Ca Sáng: Minh', '']]
+        self.assertEqual(schedule_repository.get_shift_staff('Thứ Hai', 'NV', 'Ca Sáng'), ['Minh'])
+        self.assertEqual(schedule_repository.get_repository_stats()['parses'], 2)
+
+    def test_meal_staff_reads_model_and_applies_off_shift_rule(self):
+        import meal_handler
+        with patch.object(meal_handler, 'get_vietnamese_day_of_week', return_value='Thứ Hai'):
+            self.assertEqual(meal_handler.get_working_staff('anchieu'), {'NV': ['Cường'], 'PG': ['Nga']})
+
+    def test_tokenizer_single_pass_structure(self):
+        shifts = schedule_repository.parse_shifts("ca sáng: An + Bình<br/>Nghỉ; Cường • Dũng<BR>Vệ Sinh: 12, Em")
+        self.assertEqual([(s['shift'], s['staff']) for s in shifts], [
+            ('Ca Sáng', ['An', 'Bình']),
+            ('Nghỉ', ['Cường', 'Dũng']),
+            ('Vệ Sinh', ['Em']),
+        ])
+        self.assertEqual(shifts[1]['text'], 'Cường • Dũng')
+
+    def test_schedule_flex_uses_model_roles(self):
+        import schedule_handler
+        shifts = schedule_repository.get_day('Thứ Hai')['NV']
+        flex = schedule_handler.create_schedule_flex_message('employee', shifts, 'Thứ Hai')
+        morning_columns = flex['body']['contents'][0]['contents'][1]['contents']
+        special = [t['text'] for t in morning_columns[0]['contents']]
+        regular = [t['text'] for t in morning_columns[1]['contents']]
+        self.assertEqual(special, ['• An (ERP)', '• Bình GH2'])
+        self.assertEqual(regular, ['• Hoa *'])
+
+    def test_schedule_flex_icons_cover_every_shift_keyword(self):
+        import schedule_handler
+        shifts = schedule_repository.parse_shifts("Ca Sáng: An<br>Vệ Sinh: Bình<br>Vệ Sinh Kho: Cường")
+        flex = schedule_handler.create_schedule_flex_message('pg', shifts, 'Thứ Hai')
+        icons = [section['contents'][0]['contents'][0]['text'] for section in flex['body']['contents']]
+        self.assertEqual(icons, ['☀️', '🧹', '🧹'])
+
+    def test_send_daily_schedule_replies_through_callable(self):
+        import schedule_handler
+        sent = []
+        message = schedule_handler.send_daily_schedule('pg', day_of_week_str='Thứ Hai', reply=sent.append)
+        self.assertEqual(sent, [message])
+        schedule_handler.send_daily_schedule('pg', day_of_week_str='Thứ Ba', reply=sent.append)
+        self.assertEqual(sent[-1].text, 'Không tìm thấy lịch làm việc cho Thứ Ba.')
+
+
+if __name__ == '__main__':
+    unittest.main()
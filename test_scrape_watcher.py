@@ -0,0 +1,104 @@
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import scrape_watcher
+
+
+class TestScrapeWatcher(unittest.TestCase):
+
+    def setUp(self):
+        scrape_watcher._subscribers.clear()
+        scrape_watcher._jobs.clear()
+        self.status = {}
+        patchers = [
+            patch.object(scrape_watcher, '_start_poller'),
+            patch.object(scrape_watcher, 'check_scrape_status', side_effect=lambda: dict(self.status)),
+        ]
+        for p in patchers:
+            self.addCleanup(p.stop)
+        self.start_poller, self.check = [p.start() for p in patchers]
+        self.results = []
+
+    def subscribe(self, requested_at):
+        return scrape_watcher.subscribe(requested_at, lambda done, info: self.results.append((requested_at, done)))
+
+    def test_one_poll_notifies_every_waiter_once(self):
+        self.subscribe("2026-10-17T01:00:00.000Z")
+        self.subscribe("2026-10-17T01:00:05.000Z")
+
+        self.status = {'status': 'running', 'requested_at': "2026-10-17T01:00:05.000Z"}
+        scrape_watcher._poll_once()
+        self.assertEqual(self.results, [])
+
+        self.status = {'status': 'completed', 'requested_at': "2026-10-17T01:00:05.000Z"}
+        scrape_watcher._poll_once()
+        scrape_watcher._poll_once()
+
+        self.assertEqual(sorted(self.results), [("2026-10-17T01:00:00.000Z", True), ("2026-10-17T01:00:05.000Z", True)])
+        self.assertEqual(self.check.call_count, 2)  # lần poll thứ 3 không còn ai chờ
+
+    def test_old_completed_signal_does_not_count(self):
+        self.subscribe("2026-10-17T02:00:00.000Z")
+        self.status = {'status': 'completed', 'requested_at': "2026-10-17T01:00:00.000Z"}
+        scrape_watcher._poll_once()
+        self.assertEqual(self.results, [])
+
+    def test_timeout_notifies_not_completed(self):
+        subscriber = self.subscribe("2026-10-17T02:00:00.000Z")
+        subscriber['deadline'] = 0
+        scrape_watcher._poll_once()
+        self.assertEqual(self.results, [("2026-10-17T02:00:00.000Z", False)])
+
+    def test_duplicate_requests_join_one_job(self):
+        finished = []
+        with patch.object(scrape_watcher, 'trigger_adhoc_scrape', return_value=(True, "2026-10-17T03:00:00.000Z")) as trigger:
+            on_finish = lambda t, dests, done: finished.append((t, dests, done))
+            self.assertEqual(scrape_watcher.request_scrape('realtime', 'G1', on_finish), 'started')
+            self.assertEqual(scrape_watcher.request_scrape('realtime', 'U2', on_finish), 'joined')
+            self.assertEqual(scrape_watcher.request_scrape('realtime', 'G1', on_finish), 'joined')
+        self.assertEqual(trigger.call_count, 1)
+
+        self.status = {'status': 'completed', 'type': 'realtime', 'requested_at': "2026-10-17T03:00:00.000Z"}
+        scrape_watcher._poll_once()
+        self.assertEqual(finished, [('realtime', ['G1', 'U2'], True)])
+        self.assertEqual(scrape_watcher._jobs, {})
+
+    def test_other_type_signal_does_not_finish_job(self):
+        finished = []
+        on_finish = lambda t, dests, done: finished.append((t, dests, done))
+        with patch.object(scrape_watcher, 'trigger_adhoc_scrape', return_value=(True, "2026-10-17T03:00:00.000Z")):
+            scrape_watcher.request_scrape('realtime', 'G1', on_finish)
+        # CAO LK ghi đè dòng tín hiệu dùng chung: lượt LK xong không phải lượt RT xong
+        self.status = {'status': 'running', 'type': 'luyke', 'requested_at': "2026-10-17T03:00:10.000Z"}
+        scrape_watcher._poll_once()
+        self.status = {'status': 'completed', 'type': 'luyke', 'requested_at': "2026-10-17T03:00:10.000Z"}
+        scrape_watcher._poll_once()
+        self.assertEqual(finished, [])
+
+    def test_failed_trigger_does_not_leave_a_job(self):
+        finished = []
+        with patch.object(scrape_watcher, 'trigger_adhoc_scrape', return_value=(False, "x")):
+            self.assertIsNone(scrape_watcher.request_scrape('luyke', 'G1', lambda *a: finished.append(a)))
+        self.assertEqual(scrape_watcher._jobs, {})
+        self.assertEqual(finished, [('luyke', ['G1'], False)])
+
+    def test_failed_trigger_notifies_callers_that_joined(self):
+        finished = []
+        on_finish = lambda t, dests, done: finished.append((t, dests, done))
+
+        def trigger(scrape_type):
+            # Người khác hỏi đúng lúc tín hiệu đang được kích hoạt
+            self.assertEqual(scrape_watcher.request_scrape(scrape_type, 'U2', on_finish), 'joined')
+            return False, None
+
+        with patch.object(scrape_watcher, 'trigger_adhoc_scrape', side_effect=trigger):
+            self.assertIsNone(scrape_watcher.request_scrape('realtime', 'G1', on_finish))
+        self.assertEqual(finished, [('realtime', ['G1', 'U2'], False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
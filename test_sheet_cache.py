@@ -0,0 +1,318 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ['GOOGLE_CREDENTIALS_JSON'] = '{"type": "service_account", "project_id": "test"}'
+
+with patch("gspread.authorize"):
+    with patch("oauth2client.service_account.ServiceAccountCredentials.from_json_keyfile_dict"):
+        import sheet_cache
+        import sheets_backend
+        import sqlite_backend
+        import write_queue
+
+
+class TestSheetCache(unittest.TestCase):
+
+    def setUp(self):
+        sheet_cache.invalidate()
+        self.worksheet = MagicMock()
+        self.worksheet.get_all_values.return_value = [
+            ['group_id', 'date', 'task_id', 'status'],
+            ['G1', '2024-01-01', 'sang_1', 'incomplete'],
+            ['G1', '2024-01-01', 'sang_2', '5'],
+        ]
+        # worksheet.get('A:E'): chỉ các cột khóa của cùng dữ liệu
+        self.worksheet.get.side_effect = lambda range_name: [r[:5] for r in self.worksheet.get_all_values.return_value]
+        patcher = patch.object(sheets_backend, 'get_worksheet', return_value=self.worksheet)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_share_one_snapshot(self):
+        values = sheet_cache.get_all_values('task_tracker')
+        records = sheet_cache.get_all_records('task_tracker')
+        sheet_cache.get_all_records('task_tracker')
+
+        self.assertEqual(self.worksheet.get_all_values.call_count, 1)
+        self.assertEqual(len(values), 3)
+        self.assertEqual(records[0]['task_id'], 'sang_1')
+        # Giống get_all_records của gspread: số được chuyển kiểu
+        self.assertEqual(records[1]['status'], 5)
+
+    def test_returned_rows_are_copies(self):
+        records = sheet_cache.get_all_records('task_tracker')
+        records[0]['status'] = 'complete'
+        self.assertEqual(sheet_cache.get_all_records('task_tracker')[0]['status'], 'incomplete')
+
+    def test_write_invalidates_snapshot(self):
+        sheet_cache.get_all_values('task_tracker')
+        sheet_cache.update_range('task_tracker', 'D2:D2', [['complete']])
+        sheet_cache.get_all_values('task_tracker')
+
+        self.worksheet.batch_update.assert_called_once_with([{'range': 'D2:D2', 'values': [['complete']]}])
+        self.assertEqual(self.worksheet.get_all_values.call_count, 2)
+
+    def test_max_age_zero_forces_refetch(self):
+        sheet_cache.get_all_values('task_tracker')
+        sheet_cache.get_all_values('task_tracker', max_age=0)
+        self.assertEqual(self.worksheet.get_all_values.call_count, 2)
+
+    def test_delete_row_ranges_bottom_up_in_one_call(self):
+        self.worksheet.id = 7
+        ranges = sheet_cache.to_row_ranges([2, 3, 4, 9, 7, 8])
+        self.assertEqual(ranges, [(2, 4), (7, 9)])
+
+        sheet_cache.delete_row_ranges('task_tracker', ranges)
+
+        body = self.worksheet.spreadsheet.batch_update.call_args[0][0]
+        starts = [r['deleteDimension']['range']['startIndex'] for r in body['requests']]
+        self.assertEqual(starts, [6, 1])
+
+    def test_replace_all_writes_before_clearing_tail(self):
+        self.worksheet.col_count = 4
+        sheets_backend.replace_all('task_tracker', [['group_id', 'date'], ['G1', 'd']])
+        calls = [c[0] for c in self.worksheet.method_calls]
+        self.assertEqual(calls, ['update', 'batch_clear'])
+        self.assertEqual(self.worksheet.batch_clear.call_args[0][0], ['A3:D', 'C1:D2'])
+
+    def test_lookup_rows_uses_index_and_follows_appends(self):
+        key_fn = lambda row: (row[0], row[2])
+        self.assertEqual(sheet_cache.lookup_rows('task_tracker', 'task', key_fn, ('G1', 'sang_2'))[0][0], 3)
+
+        self.worksheet.append_rows.return_value = {'updates': {'updatedRange': "'task_tracker'!A4:D4"}}
+        sheet_cache.append_rows('task_tracker', [['G2', '2024-01-01', 'chieu_1', 'incomplete']])
+
+        matches = sheet_cache.lookup_rows('task_tracker', 'task', key_fn, ('G2', 'chieu_1'))
+        self.assertEqual(matches, [(4, ['G2', '2024-01-01', 'chieu_1', 'incomplete'])])
+        self.assertEqual(self.worksheet.get_all_values.call_count, 1)
+
+    def test_lookup_rows_miss_reads_only_key_columns(self):
+        key_fn = lambda row: (row[0], row[2])
+        self.assertEqual(sheet_cache.lookup_rows('task_tracker', 'task', key_fn, ('G9', 'x')), [])
+        self.assertEqual(self.worksheet.get_all_values.call_count, 1)
+        self.worksheet.get.assert_called_once_with(sheet_cache.KEY_COLUMNS_RANGE)
+
+        # Dòng được thêm từ nơi khác: có trên sheet nhưng thiếu trong bản chụp -> tải lại
+        self.worksheet.get_all_values.return_value = self.worksheet.get_all_values.return_value + [
+            ['G9', '2024-01-01', 'x', 'incomplete']]
+        self.assertEqual(sheet_cache.lookup_rows('task_tracker', 'task', key_fn, ('G9', 'x'))[0][0], 4)
+        self.assertEqual(self.worksheet.get_all_values.call_count, 2)
+
+
+class TestWriteQueue(unittest.TestCase):
+
+    setUp = TestSheetCache.setUp
+
+    def test_enqueue_patches_snapshot_and_coalesces(self):
+        with patch.object(write_queue, '_ensure_worker'):
+            sheet_cache.get_all_values('task_tracker')
+            write_queue.enqueue_update('task_tracker', 'D2:D2', [['complete']])
+            write_queue.enqueue_update('task_tracker', 'D3:D3', [['complete']])
+            write_queue.enqueue_update('task_tracker', 'D2:D2', [['incomplete']])
+
+            records = sheet_cache.get_all_records('task_tracker')
+            self.assertEqual(records[0]['status'], 'incomplete')
+            self.assertEqual(records[1]['status'], 'complete')
+            self.worksheet.batch_update.assert_not_called()
+
+            write_queue.flush()
+
+        self.worksheet.batch_update.assert_called_once_with([
+            {'range': 'D3:D3', 'values': [['complete']]},
+            {'range': 'D2:D2', 'values': [['incomplete']]},
+        ])
+        self.assertEqual(self.worksheet.get_all_values.call_count, 1)
+
+    def test_refetch_flushes_pending_first(self):
+        with patch.object(write_queue, '_ensure_worker'):
+            write_queue.enqueue_update('task_tracker', 'D2:D2', [['complete']])
+            sheet_cache.get_all_values('task_tracker')
+        self.worksheet.batch_update.assert_called_once()
+
+    def test_appends_are_batched_per_worksheet(self):
+        with patch.object(write_queue, '_ensure_worker'):
+            sheet_cache.get_all_values('task_tracker')
+            write_queue.enqueue_append('task_tracker', ['G1', '2024-01-01', 'sang_3', 'incomplete'])
+            write_queue.enqueue_append('task_tracker', ['G1', '2024-01-01', 'sang_4', 'incomplete'])
+            self.worksheet.append_rows.assert_not_called()
+            write_queue.flush()
+        self.worksheet.append_rows.assert_called_once()
+        self.assertEqual([r[2] for r in self.worksheet.append_rows.call_args[0][0]], ['sang_3', 'sang_4'])
+
+    def test_failed_batch_stays_pending_with_backoff(self):
+        error = Exception("429 quota")
+        error.response = MagicMock(status_code=429, headers={'Retry-After': '30'})
+        self.worksheet.batch_update.side_effect = error
+        self.addCleanup(write_queue._backoff.clear)
+        with patch.object(write_queue, '_ensure_worker'):
+            write_queue.enqueue_update('task_tracker', 'D2:D2', [['complete']])
+            write_queue.flush()
+            self.assertEqual(write_queue.pending_updates('task_tracker'), [('D2:D2', [['complete']])])
+            retry_in = write_queue.get_queue_stats()['failing']['task_tracker']['retry_in_s']
+            self.assertTrue(30 <= retry_in <= 30 * (1 + write_queue.RETRY_JITTER) + 1)
+
+            # Đang chờ thử lại: lần đẩy kế tiếp không gọi API
+            write_queue.flush()
+            self.assertEqual(self.worksheet.batch_update.call_count, 1)
+
+            self.worksheet.batch_update.side_effect = None
+            write_queue.flush(force=True)
+        self.assertEqual(write_queue.pending_updates('task_tracker'), [])
+        self.assertEqual(write_queue.get_queue_stats()['failing'], {})
+
+    def test_on_written_reports_success(self):
+        results = []
+        with patch.object(write_queue, '_ensure_worker'):
+            write_queue.enqueue_update('task_tracker', 'D2:D2', [['complete']], on_written=results.append)
+            write_queue.enqueue_append('task_tracker', ['G1', '2024-01-01', 'sang_3', 'incomplete'],
+                                       on_written=results.append)
+            self.assertEqual(results, [])
+            write_queue.flush()
+        self.assertEqual(results, [True, True])
+
+    def test_keyed_range_follows_shifted_row(self):
+        key_fn = lambda row: (row[0], row[2])
+        with patch.object(write_queue, '_ensure_worker'):
+            row, _ = sheet_cache.lookup_rows('task_tracker', 'task', key_fn, ('G1', 'sang_2'))[0]
+            write_queue.enqueue_update('task_tracker', f'D{row}:D{row}', [['complete']], row_key=(key_fn, ('G1', 'sang_2')))
+            write_queue.enqueue_update('task_tracker', 'D2:D2', [['complete']], row_key=(key_fn, ('G1', 'sang_1')))
+            # Dòng sang_1 bị xóa từ nơi khác: sang_2 dồn lên dòng 2
+            self.worksheet.get_all_values.return_value = [
+                ['group_id', 'date', 'task_id', 'status'],
+                ['G1', '2024-01-01', 'sang_2', '5'],
+            ]
+            write_queue.flush()
+        self.worksheet.batch_update.assert_called_once_with([{'range': 'D2:D2', 'values': [['complete']]}])
+        self.worksheet.get.assert_called_once_with(sheet_cache.KEY_COLUMNS_RANGE)
+        self.assertEqual(self.worksheet.get_all_values.call_count, 1)
+        stats = write_queue.get_queue_stats()
+        self.assertGreaterEqual(stats['rows_relocated'], 1)
+        self.assertGreaterEqual(stats['rows_dropped'], 1)
+
+    def test_delete_shifts_ranges_still_pending(self):
+        self.worksheet.id = 7
+        self.worksheet.batch_update.side_effect = Exception("503")
+        self.addCleanup(write_queue._backoff.clear)
+        self.addCleanup(write_queue._pending.clear)
+        with patch.object(write_queue, '_ensure_worker'):
+            write_queue.enqueue_update('task_tracker', 'D5:D5', [['complete']])
+            write_queue.enqueue_update('task_tracker', 'F3:G3', [['complete', 'An']])
+            write_queue.flush()  # lỗi: cả hai vùng nằm lại chờ thử lại
+            sheet_cache.delete_row_ranges('task_tracker', [(2, 3)])
+        self.assertEqual(write_queue.pending_updates('task_tracker'), [('D3:D3', [['complete']])])
+
+    def test_backoff_cleared_when_nothing_is_left_to_write(self):
+        self.worksheet.id = 7
+        self.worksheet.batch_update.side_effect = Exception("503")
+        self.addCleanup(write_queue._backoff.clear)
+        with patch.object(write_queue, '_ensure_worker'):
+            write_queue.enqueue_update('task_tracker', 'D3:D3', [['complete']])
+            write_queue.flush()
+            self.assertIn('task_tracker', write_queue.get_queue_stats()['failing'])
+            sheet_cache.delete_row_ranges('task_tracker', [(3, 3)])
+        self.assertNotIn('task_tracker', write_queue._pending)
+        self.assertEqual(write_queue.get_queue_stats()['failing'], {})
+        self.assertIsNone(write_queue._seconds_until_retry())
+
+
+class TestGroupMemberRegistry(unittest.TestCase):
+
+    def setUp(self):
+        import flex_handler
+        self.fh = flex_handler
+        patchers = [
+            patch.object(flex_handler, '_members', None),
+            patch.object(flex_handler.sheet_cache, 'ensure_worksheet'),
+            patch.object(flex_handler.sheet_cache, 'get_all_records', return_value=[
+                {'group_id': 'G1', 'user_id': 'U1', 'display_name': 'An', 'last_seen': '2000-01-01 00:00:00'},
+            ]),
+            patch.object(flex_handler.sheet_cache, 'lookup_rows', return_value=[(2, ['G1', 'U1', 'An', ''])]),
+            patch.object(flex_handler.write_queue, 'enqueue_update'),
+            patch.object(flex_handler.write_queue, 'enqueue_append'),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_repeat_messages_skip_sheet_io(self):
+        for _ in range(3):
+            self.fh.register_group_member('G1', 'U2', 'Bình')
+        self.fh.write_queue.enqueue_append.assert_called_once()
+        self.assertEqual(self.fh.sheet_cache.get_all_records.call_count, 1)
+
+        # Thành viên cũ có last_seen quá hạn: ghi lại một lần rồi bỏ qua
+        self.fh.register_group_member('G1', 'U1', 'An')
+        self.fh.register_group_member('G1', 'U1', 'An')
+        self.fh.write_queue.enqueue_update.assert_called_once()
+        self.assertEqual(self.fh.write_queue.enqueue_update.call_args[0][1], 'C2:D2')
+
+        # Đổi tên thì ghi ngay dù chưa hết hạn
+        self.fh.register_group_member('G1', 'U1', 'An Nguyễn')
+        self.assertEqual(self.fh.write_queue.enqueue_update.call_count, 2)
+
+    def test_written_at_follows_write_outcome(self):
+        self.fh.register_group_member('G1', 'U2', 'Bình')
+        on_written = self.fh.write_queue.enqueue_append.call_args[1]['on_written']
+        self.assertEqual(self.fh._members[('G1', 'U2')]['written_at'], 0.0)
+
+        # Lần ghi bị bỏ: tin nhắn kế tiếp ghi lại
+        on_written(False)
+        self.fh.register_group_member('G1', 'U2', 'Bình')
+        self.fh.write_queue.enqueue_update.assert_called_once()
+
+        # Ghi thành công: các tin sau được bỏ qua tới khi last_seen cũ
+        self.fh.write_queue.enqueue_update.call_args[1]['on_written'](True)
+        self.assertGreater(self.fh._members[('G1', 'U2')]['written_at'], 0.0)
+        self.fh.register_group_member('G1', 'U2', 'Bình')
+        self.fh.write_queue.enqueue_update.assert_called_once()
+
+
+class TestSqliteBackend(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name, value in [('SQLITE_PATH', os.path.join(tmp.name, 'state.db')), ('SEED_FROM_SHEETS', False), ('_conn', None)]:
+            patcher = patch.object(sqlite_backend, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: sqlite_backend._conn and sqlite_backend._conn.close())
+
+    def test_worksheet_shaped_operations(self):
+        title = 'meal_tracker'
+        sqlite_backend.ensure(title, headers=['group_id', 'date', 'name', 'status'])
+        start = sqlite_backend.append_rows(title, [['G1', 'd', 'An', 'waiting'], ['G1', 'd', 'Binh', 'waiting'], ['G1', 'd', 'Chi', 'waiting']])
+        self.assertEqual(start, 2)
+
+        sqlite_backend.batch_update(title, [{'range': 'D3:D3', 'values': [['done']]}])
+        sqlite_backend.delete_row_ranges(title, [(2, 2)])
+
+        self.assertEqual(sqlite_backend.get_values(title), [
+            ['group_id', 'date', 'name', 'status'],
+            ['G1', 'd', 'Binh', 'done'],
+            ['G1', 'd', 'Chi', 'waiting'],
+        ])
+        self.assertEqual(sqlite_backend.get_range(title, 'A:B')[1], ['G1', 'd'])
+        self.assertEqual(sqlite_backend.append_rows(title, [['G2', 'd', 'Dung', 'waiting']]), 4)
+
+        sqlite_backend.clear(title, headers=['group_id'])
+        self.assertEqual(sqlite_backend.get_values(title), [['group_id']])
+
+    def test_failed_seed_is_retried_and_blocks_writes(self):
+        title = 'adhoc_tasks'
+        with patch.object(sqlite_backend, 'SEED_FROM_SHEETS', True), \
+             patch.object(sqlite_backend, '_seeded', set()), \
+             patch.object(sheets_backend, 'get_values', side_effect=[RuntimeError("503"), [['group_id'], ['G1']]]):
+            with self.assertRaises(RuntimeError):
+                sqlite_backend.ensure(title, headers=['group_id'])
+            # Trang không bị ghi dòng tiêu đề nên lần sau vẫn nạp lại từ Sheets
+            sqlite_backend.ensure(title, headers=['group_id'])
+            self.assertEqual(sqlite_backend.get_values(title), [['group_id'], ['G1']])
+
+
+if __name__ == '__main__':
+    unittest.main()
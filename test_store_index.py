@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import store_index
+
+CHI_TIET_CUM = [
+    ['Cụm', 'Kênh', 'Siêu thị', 'Target', 'Realtime'],
+    ['hcm 1', 'DMX', '12345 - DMX Quận 1', '100', '50'],
+    ['HCM 1', 'TGDD', '67890 - TGDD Quận 3', '80', '20'],
+    ['BD', 'DMX', '55555 DMX Thủ Dầu Một', '90', '10'],
+]
+
+
+class TestStoreIndex(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in [('_index', None), ('_refreshing', False), ('_cold_failed_at', None), ('_retry_timer', None),
+                            ('_stats', {k: 0 for k in store_index._stats})]:
+            patcher = patch.object(store_index, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(store_index.sheet_cache, 'get_all_values', return_value=CHI_TIET_CUM)
+        self.get_all_values = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_classify_uses_index_without_reading_sheet(self):
+        store_index.refresh()
+        self.get_all_values.reset_mock()
+        self.assertEqual(store_index.classify('HCM 1'), 'cluster')
+        self.assertEqual(store_index.classify('BD 2'), 'cluster_channel')
+        self.assertEqual(store_index.classify('12345'), 'store')
+        self.assertIsNone(store_index.classify('OK MỌI NGƯỜI'))
+        self.get_all_values.assert_not_called()
+        stats = store_index.get_index_stats()
+        self.assertEqual((stats['clusters'], stats['stores'], stats['matched']), (2, 3, 3))
+
+    def test_cold_index_builds_once_synchronously(self):
+        with patch.object(store_index.threading, 'Thread') as thread:
+            self.assertEqual(store_index.classify('12345'), 'store')
+            self.assertEqual(store_index.classify('HCM 1'), 'cluster')
+        thread.assert_not_called()
+        self.get_all_values.assert_called_once()
+        self.assertEqual(store_index.get_index_stats()['cold_misses'], 1)
+
+    def test_stale_index_refreshes_in_background(self):
+        store_index.refresh()
+        store_index._index['built_at'] = time.time() - store_index.REFRESH_SECONDS - 1
+        with patch.object(store_index.threading, 'Thread') as thread:
+            # Bản cũ vẫn được dùng trong lúc làm mới
+            self.assertEqual(store_index.classify('12345'), 'store')
+            self.assertEqual(store_index.classify('12345'), 'store')
+        thread.assert_called_once()  # chỉ một luồng làm mới dù hỏi nhiều lần
+
+    def test_cold_build_error_backs_off_and_retries_in_background(self):
+        self.get_all_values.side_effect = RuntimeError("quota")
+        with patch.object(store_index.threading, 'Timer') as timer:
+            self.assertIsNone(store_index.classify('12345'))
+            # Trong thời gian chờ: không đọc lại sheet cho từng tin nhắn
+            self.assertIsNone(store_index.classify('12345'))
+            self.assertIsNone(store_index.classify('HCM 1'))
+        self.get_all_values.assert_called_once()
+        timer.assert_called_once_with(store_index.COLD_RETRY_SECONDS, store_index.refresh)
+        self.assertEqual(store_index.get_index_stats()['cold_skipped'], 2)
+
+        # Lần thử lại nền thành công thì tra cứu chạy bình thường
+        self.get_all_values.side_effect = None
+        self.assertTrue(store_index.refresh())
+        self.assertEqual(store_index.classify('12345'), 'store')
+
+    def test_refresh_error_keeps_previous_index(self):
+        store_index.refresh()
+        self.get_all_values.side_effect = RuntimeError("quota")
+        self.assertFalse(store_index.refresh())
+        self.assertEqual(store_index.classify('67890'), 'store')
+        self.assertFalse(store_index._refreshing)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,12 +3,14 @@ import math
 from datetime import datetime
 import pytz
 import unicodedata
-import gspread
 from linebot.models import FlexSendMessage, TextSendMessage
 
 # Import từ file cấu hình trung tâm
-from config import CLIENT, SHEET_NAME, WORKSHEET_SCHEDULES_NAME, WORKSHEET_VESINH_TRACKER_NAME, get_spreadsheet
-from meal_handler import get_working_staff, normalize_text
+from config import WORKSHEET_VESINH_TRACKER_NAME
+from meal_handler import get_working_staff, normalize_text, tracker_staff_key
+import sheet_cache
+import schedule_repository
+import write_queue
 
 VESINH_HEADERS = ['group_id', 'date', 'session', 'type', 'name', 'zone', 'status', 'time_clicked', 'clicked_by']
 
@@ -178,46 +180,12 @@ def allocate_cleaning_zones(nv_list):
 
     return assignments
 
-def clean_staff_name(name):
-    name = re.sub(r'^\(\d+.*?\):?\s*', '', name)
-    name = re.sub(r'^[•\-\+:\.]\s*', '', name)
-    return name.strip()
-
-def parse_staff_from_raw(raw_text, target_shift):
-    if not raw_text:
-        return []
-    keywords = ["Ca Sáng", "Ca Chiều", "Nghỉ", "Vệ Sinh Kho", "Vệ Sinh"]
-    pattern = '|'.join(keywords)
-    parts = re.split(f'({pattern})', str(raw_text).replace('<br>', '\n'))
-    names = []
-    i = 1 if parts and not parts[0].strip() else 0
-    while i < len(parts):
-        shift_name = parts[i].strip()
-        content = parts[i+1].strip().lstrip(':').lstrip(';').strip() if i + 1 < len(parts) else ""
-        if shift_name.lower() == target_shift.lower():
-            raw_names = re.split(r'[,\n;•\+]', content)
-            for n in raw_names:
-                cn = clean_staff_name(n)
-                if cn and not cn.isdigit() and len(cn) > 1:
-                    names.append(cn)
-        i += 2
-
-    # Khử trùng lặp danh sách tên
-    seen = set()
-    unique_names = []
-    for n in names:
-        norm = normalize_text(n)
-        if norm not in seen:
-            seen.add(norm)
-            unique_names.append(n)
-    return unique_names
-
 def get_working_staff_vesinh(session_type):
     meal_session = 'ansang' if session_type == 'vesinh_sang' else 'anchieu'
-    target_shift_name = "Ca Sáng" if session_type == 'vesinh_sang' else "Ca Chiều"
     
     staff_lists = {}
     try:
+        # Đọc từ mô hình lịch dùng chung (schedule_repository), không tải/parse lại trang schedules
         staff_lists = get_working_staff(meal_session)
     except Exception as e:
         print(f"Lỗi get_working_staff: {e}")
@@ -225,42 +193,20 @@ def get_working_staff_vesinh(session_type):
     nv_list = staff_lists.get('NV', []) if isinstance(staff_lists, dict) else []
     pg_list = staff_lists.get('PG', []) if isinstance(staff_lists, dict) else []
 
-    if not nv_list:
-        try:
-            from meal_handler import get_vietnamese_day_of_week
-            day_str = get_vietnamese_day_of_week()
-            sheet = get_spreadsheet().worksheet(WORKSHEET_SCHEDULES_NAME)
-            records = sheet.get_all_records()
-            today_sched = next((row for row in records if row.get('day_of_week') == day_str), None)
-            if today_sched:
-                nv_raw = today_sched.get('employee_schedule', '')
-                pg_raw = today_sched.get('pg_schedule', '')
-                nv_list = parse_staff_from_raw(nv_raw, target_shift_name)
-                pg_list = parse_staff_from_raw(pg_raw, target_shift_name)
-        except Exception as err:
-            print(f"Lỗi parse fallback lịch vệ sinh: {err}")
+    from meal_handler import get_vietnamese_day_of_week
+    day_str = get_vietnamese_day_of_week()
 
     # Xử lý vệ sinh kho (chỉ lấy cho ca sáng)
     pg_kho_list = []
     if session_type == 'vesinh_sang':
         try:
-            from meal_handler import get_vietnamese_day_of_week
-            day_str = get_vietnamese_day_of_week()
-            sheet = get_spreadsheet().worksheet(WORKSHEET_SCHEDULES_NAME)
-            records = sheet.get_all_records()
-            today_sched = next((row for row in records if row.get('day_of_week') == day_str), None)
-            if today_sched:
-                pg_raw = today_sched.get('pg_schedule', '')
-                pg_kho_list = parse_staff_from_raw(pg_raw, "Vệ Sinh Kho")
+            pg_kho_list = schedule_repository.get_shift_staff(day_str, 'PG', "Vệ Sinh Kho")
         except Exception as err:
             print(f"Lỗi đọc vệ sinh kho: {err}")
 
     # Áp dụng quy tắc vệ sinh ca chiều
     if session_type == 'vesinh_chieu':
         try:
-            from meal_handler import get_vietnamese_day_of_week, normalize_text
-            day_str = get_vietnamese_day_of_week()
-            
             if day_str in ["Thứ Bảy", "Chủ Nhật"]:
                 # Thứ 7, Chủ Nhật: Chiều chỉ PG vệ sinh, NV đã vệ sinh sáng
                 nv_list = []
@@ -268,15 +214,7 @@ def get_working_staff_vesinh(session_type):
                 # Thứ 2 - Thứ 6: Loại bỏ NV đã làm Ca Sáng (làm cả ngày)
                 morning_staff = get_working_staff('ansang')
                 morning_nvs = morning_staff.get('NV', []) if isinstance(morning_staff, dict) else []
-                if not morning_nvs:
-                    sheet = get_spreadsheet().worksheet(WORKSHEET_SCHEDULES_NAME)
-                    records = sheet.get_all_records()
-                    today_sched = next((row for row in records if row.get('day_of_week') == day_str), None)
-                    if today_sched:
-                        nv_raw = today_sched.get('employee_schedule', '')
-                        morning_nvs = parse_staff_from_raw(nv_raw, "Ca Sáng")
-                
-                morning_nvs_norm = [normalize_text(name) for name in morning_nvs]
+                morning_nvs_norm = {normalize_text(name) for name in morning_nvs}
                 nv_list = [nv for nv in nv_list if normalize_text(nv) not in morning_nvs_norm]
         except Exception as e:
             print(f"Lỗi lọc nhân viên vệ sinh: {e}")
@@ -290,16 +228,10 @@ def sync_vesinh_sheet(group_id, session_type):
     """
     sheet = None
     try:
-        sheet = get_spreadsheet().worksheet(WORKSHEET_VESINH_TRACKER_NAME)
-    except Exception as e:
-        print(f"Chưa tìm thấy worksheet '{WORKSHEET_VESINH_TRACKER_NAME}', đang tạo mới: {e}")
-        try:
-            spreadsheet = get_spreadsheet()
-            sheet = spreadsheet.add_worksheet(title=WORKSHEET_VESINH_TRACKER_NAME, rows=100, cols=10)
-            sheet.append_row(VESINH_HEADERS)
-        except Exception as create_err:
-            print(f"Lỗi khởi tạo worksheet '{WORKSHEET_VESINH_TRACKER_NAME}': {create_err}")
-            sheet = None
+        sheet = sheet_cache.ensure_worksheet(WORKSHEET_VESINH_TRACKER_NAME, headers=VESINH_HEADERS, rows=100, cols=10)
+    except Exception as create_err:
+        print(f"Lỗi khởi tạo worksheet '{WORKSHEET_VESINH_TRACKER_NAME}': {create_err}")
+        sheet = None
 
     tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
     today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
@@ -307,19 +239,18 @@ def sync_vesinh_sheet(group_id, session_type):
     all_records = []
     if sheet:
         try:
+            # Đọc ô B2 từ bản chụp thay vì gọi acell
+            all_values = sheet_cache.get_all_values(WORKSHEET_VESINH_TRACKER_NAME)
             first_data_date = None
-            try:
-                val = sheet.acell('B2').value 
-                if val: first_data_date = val
-            except: pass
+            if len(all_values) > 1 and len(all_values[1]) > 1 and all_values[1][1]:
+                first_data_date = all_values[1][1]
 
             if first_data_date and first_data_date != today_str:
                 print(f"Ngày mới! Xóa dữ liệu vệ sinh cũ ({first_data_date})...")
-                sheet.clear()
-                sheet.append_row(VESINH_HEADERS)
+                sheet_cache.clear(WORKSHEET_VESINH_TRACKER_NAME, VESINH_HEADERS)
                 all_records = []
             else:
-                all_records = sheet.get_all_records()
+                all_records = sheet_cache.get_all_records(WORKSHEET_VESINH_TRACKER_NAME)
         except Exception as sheet_err:
             print(f"Lỗi đọc dữ liệu từ worksheet vesinh: {sheet_err}")
 
@@ -426,7 +357,7 @@ def sync_vesinh_sheet(group_id, session_type):
 
     if new_rows and sheet:
         try:
-            sheet.append_rows(new_rows, value_input_option='USER_ENTERED')
+            sheet_cache.append_rows(WORKSHEET_VESINH_TRACKER_NAME, new_rows)
         except Exception as append_err:
             print(f"Lỗi ghi dữ liệu mới vào sheet vesinh: {append_err}")
 
@@ -437,47 +368,26 @@ def update_vesinh_status(group_id, session_type, staff_name, clicker_name, targe
     Cập nhật trạng thái hoàn thành vệ sinh khi bấm nút.
     """
     try:
-        sheet = get_spreadsheet().worksheet(WORKSHEET_VESINH_TRACKER_NAME)
-        all_values = sheet.get_all_values()
-        
         tz_vietnam = pytz.timezone('Asia/Ho_Chi_Minh')
         today_str = datetime.now(tz_vietnam).strftime('%Y-%m-%d')
         time_now = datetime.now(tz_vietnam).strftime('%H:%M') if target_status == 'done' else ''
 
-        target_name_norm = normalize_text(staff_name)
-        target_group_id = str(group_id).strip()
+        target_key = (str(group_id).strip(), today_str, session_type, normalize_text(staff_name))
 
-        matching_rows = []
-        already_done = True
-        for i, row in enumerate(all_values[1:], start=2):
-            if len(row) < 5: continue
-            
-            row_group = str(row[0]).strip()
-            row_date = str(row[1]).strip()
-            row_session = str(row[2]).strip()
-            row_name_norm = normalize_text(row[4])
-
-            if (row_group == target_group_id and 
-                row_date == today_str and 
-                row_session == session_type and 
-                row_name_norm == target_name_norm):
-                matching_rows.append((i, row))
-                if len(row) < 7 or row[6].strip() != target_status:
-                    already_done = False
+        # Tìm các dòng tương ứng qua chỉ mục thay vì quét toàn bộ sheet
+        matching_rows = sheet_cache.lookup_rows(WORKSHEET_VESINH_TRACKER_NAME, 'vesinh_staff', tracker_staff_key, target_key)
+        already_done = all(len(row) >= 7 and row[6].strip() == target_status for _, row in matching_rows)
         
         if matching_rows:
             if already_done:
                 return "already", None
 
             clicked_user = clicker_name if target_status == 'done' else ''
-            cells = []
+            # Cột G: status, Cột H: time_clicked, Cột I: clicked_by
             for row_index, _ in matching_rows:
-                cells.extend([
-                    gspread.Cell(row_index, 7, target_status), # Column G: status
-                    gspread.Cell(row_index, 8, time_now),      # Column H: time_clicked
-                    gspread.Cell(row_index, 9, clicked_user)   # Column I: clicked_by
-                ])
-            sheet.update_cells(cells)
+                write_queue.enqueue_update(WORKSHEET_VESINH_TRACKER_NAME, f'G{row_index}:I{row_index}',
+                                           [[target_status, time_now, clicked_user]],
+                                           row_key=(tracker_staff_key, target_key))
             return True, time_now
         
         return False, None
@@ -0,0 +1,363 @@
+import os
+import re
+import atexit
+import contextlib
+import random
+import threading
+import time
+import collections
+
+import sheet_cache
+import storage
+
+# --- HÀNG ĐỢI GHI TRỄ (WRITE-BEHIND) CHO CÁC Ô TRẠNG THÁI ---
+# Khi cả ca cùng bấm "Hoàn tất" trong vài giây, mỗi lần bấm là một lệnh ghi
+# riêng lên Sheets và rất dễ chạm hạn mức ghi/phút. Module này gom các vùng ô
+# cần ghi theo từng worksheet, gộp trùng theo vùng (lần bấm sau đè lần trước)
+# và đẩy lên bằng MỘT lệnh batch_update mỗi SHEET_WRITE_FLUSH_MS mili giây.
+# Bản chụp trong sheet_cache được cập nhật ngay nên Flex trả lời luôn đúng.
+
+FLUSH_INTERVAL_SECONDS = int(os.environ.get('SHEET_WRITE_FLUSH_MS', '500')) / 1000.0
+# Lô ghi lỗi (vd. 429 hết hạn mức ghi/phút) KHÔNG bị bỏ: vẫn nằm trong hàng đợi
+# và được thử lại với thời gian chờ tăng gấp đôi (có nhiễu ngẫu nhiên) tới
+# SHEET_WRITE_RETRY_MAX_SECONDS, đủ vượt qua cửa sổ hạn mức 60 giây; nếu Sheets
+# trả Retry-After thì chờ ít nhất chừng đó. Sau SHEET_WRITE_ALERT_AFTER lần lỗi
+# liên tiếp, lô được báo là đang kẹt (log + /metrics) nhưng vẫn tiếp tục thử.
+RETRY_BASE_SECONDS = float(os.environ.get('SHEET_WRITE_RETRY_BASE_SECONDS', '2'))
+RETRY_MAX_SECONDS = float(os.environ.get('SHEET_WRITE_RETRY_MAX_SECONDS', '64'))
+RETRY_JITTER = 0.25
+QUOTA_WINDOW_SECONDS = 60
+ALERT_AFTER_RETRIES = int(os.environ.get('SHEET_WRITE_ALERT_AFTER', '5'))
+
+_lock = threading.Lock()
+_flush_lock = threading.RLock()
+_pending = collections.defaultdict(collections.OrderedDict)  # title -> {range: (values, row_key, callbacks)}
+_pending_appends = collections.defaultdict(list)  # title -> [(dòng cần thêm, on_written)]
+_backoff = {}  # title hoặc ('append', title) -> {'attempts', 'retry_at', 'last_error'}
+_wakeup = threading.Event()
+_worker = None
+_stats = {'enqueued': 0, 'coalesced': 0, 'batches': 0, 'ranges_written': 0, 'rows_appended': 0, 'failures': 0,
+          'rate_limited': 0, 'alerts': 0, 'rows_relocated': 0, 'rows_dropped': 0, 'last_flush_ms': None}
+
+
+def _ensure_worker():
+    global _worker
+    with _lock:
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_run, name='sheet-write-queue', daemon=True)
+        _worker.start()
+
+
+def _seconds_until_retry():
+    # Thời gian tới lần thử lại sớm nhất (None = không có lô nào đang chờ thử lại)
+    with _lock:
+        if not _backoff:
+            return None
+        return max(0.0, min(b['retry_at'] for b in _backoff.values()) - time.time())
+
+
+def _run():
+    while True:
+        _wakeup.wait(_seconds_until_retry())
+        # Chờ thêm một nhịp để gom các lần bấm liên tiếp vào cùng một lô
+        time.sleep(FLUSH_INTERVAL_SECONDS)
+        _wakeup.clear()
+        flush()
+
+
+def enqueue_update(title, range_name, values, row_key=None, on_written=None):
+    """
+    Đưa một vùng ô vào hàng đợi ghi. Bản chụp trong bộ nhớ được sửa ngay,
+    còn lệnh ghi thật sẽ được gom vào lô batch_update kế tiếp.
+    row_key=(key_fn, key): khóa của dòng đích lúc tra chỉ mục (vùng một dòng). Ngay
+    trước khi ghi, dòng được đọc lại và so khóa; nếu dòng đã bị dịch (xóa/chèn từ
+    nơi khác) thì ghi vào dòng đang mang khóa đó, không còn dòng nào thì bỏ vùng này.
+    on_written(ok): gọi với True khi vùng đã được ghi thật, False nếu vùng bị bỏ.
+    """
+    callbacks = (on_written,) if on_written else ()
+    with _lock:
+        ranges = _pending[title]
+        if range_name in ranges:
+            _stats['coalesced'] += 1
+            ranges.move_to_end(range_name)
+            callbacks = ranges[range_name][2] + callbacks
+        ranges[range_name] = (values, row_key, callbacks)
+        _stats['enqueued'] += 1
+    sheet_cache.patch(title, range_name, values)
+    _ensure_worker()
+    _wakeup.set()
+    return True
+
+
+def enqueue_append(title, row, on_written=None):
+    """
+    Đưa một dòng mới vào hàng đợi; các dòng của cùng worksheet được thêm bằng
+    MỘT lệnh append_rows ở lần đẩy kế tiếp (sau các vùng ô đang chờ).
+    on_written(ok): gọi với True khi dòng đã được thêm thật.
+    """
+    with _lock:
+        _pending_appends[title].append((list(row), on_written))
+        _stats['enqueued'] += 1
+    _ensure_worker()
+    _wakeup.set()
+    return True
+
+
+def _notify(callbacks, ok):
+    for callback in callbacks:
+        if callback is None:
+            continue
+        try:
+            callback(ok)
+        except Exception as e:
+            print(f"Lỗi trong callback sau khi ghi: {e}")
+
+
+def _in_backoff(key, now):
+    backoff = _backoff.get(key)
+    return backoff is not None and backoff['retry_at'] > now
+
+
+def flush(title=None, force=False):
+    """
+    Đẩy ngay các vùng ô và dòng mới đang chờ lên Sheets (của một worksheet hoặc tất cả).
+    Được gọi trước khi tải lại bản chụp và trước các thao tác làm dịch dòng.
+    Lô đang trong thời gian chờ thử lại được giữ nguyên, trừ khi force=True (lúc tắt).
+    """
+    with _flush_lock:
+        with _lock:
+            now = time.time()
+            titles = [title] if title else list(set(_pending) | set(_pending_appends))
+            batches = {}
+            appends = {}
+            for t in titles:
+                if force or not _in_backoff(t, now):
+                    ranges = _pending.pop(t, None)
+                    if ranges:
+                        batches[t] = ranges
+                if force or not _in_backoff(('append', t), now):
+                    entries = _pending_appends.pop(t, None)
+                    if entries:
+                        appends[t] = entries
+
+        for t, ranges in batches.items():
+            started = time.time()
+            try:
+                ranges = _verify_rows(t, ranges)
+                data = [{'range': r, 'values': entry[0]} for r, entry in ranges.items()]
+                if not data:
+                    # Mọi vùng đều đã bị bỏ: không còn gì để thử lại
+                    with _lock:
+                        _backoff.pop(t, None)
+                    continue
+                storage.batch_update(t, data)
+            except Exception as e:
+                _requeue(t, ranges, e)
+                continue
+            with _lock:
+                _backoff.pop(t, None)
+                _stats['batches'] += 1
+                _stats['ranges_written'] += len(data)
+                _stats['last_flush_ms'] = round((time.time() - started) * 1000, 1)
+            print(f"Đã ghi gộp {len(data)} vùng ô vào {t} trong 1 lệnh batch_update.")
+            _notify([cb for entry in ranges.values() for cb in entry[2]], True)
+
+        for t, entries in appends.items():
+            rows = [row for row, _ in entries]
+            try:
+                sheet_cache.append_rows(t, rows)
+            except Exception as e:
+                _requeue_appends(t, entries, e)
+                continue
+            with _lock:
+                _backoff.pop(('append', t), None)
+                _stats['rows_appended'] += len(rows)
+            print(f"Đã thêm gộp {len(rows)} dòng vào {t} trong 1 lệnh append_rows.")
+            _notify([cb for _, cb in entries], True)
+
+
+def _range_row(range_name):
+    match = re.match(r'^[A-Z]+(\d+)(?::[A-Z]+(\d+))?$', range_name)
+    if not match or (match.group(2) and match.group(2) != match.group(1)):
+        return None
+    return int(match.group(1))
+
+
+def _key_at(values, row_number, key_fn):
+    if row_number is None or row_number < 2 or row_number > len(values):
+        return None
+    try:
+        return key_fn(values[row_number - 1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _verify_rows(title, ranges):
+    """
+    Đọc lại các cột khóa (KEY_COLUMNS_RANGE, không tải cả sheet) và kiểm tra khóa của
+    các vùng có row_key. Vùng lệch dòng được chuyển sang (các) dòng đang mang khóa đó;
+    không tìm thấy thì bỏ. Có thay đổi thì hủy bản chụp vì chỉ mục trong bộ nhớ đã cũ.
+    """
+    if all(entry[1] is None for entry in ranges.values()):
+        return ranges
+    values = storage.get_range(title, sheet_cache.KEY_COLUMNS_RANGE)
+    indexes = {}
+    verified = collections.OrderedDict()
+    relocated = dropped = 0
+    dropped_callbacks = []
+    for range_name, (range_values, row_key, callbacks) in ranges.items():
+        targets = [range_name]
+        if row_key is not None:
+            key_fn, key = row_key
+            row_number = _range_row(range_name)
+            if _key_at(values, row_number, key_fn) != key:
+                if key_fn not in indexes:
+                    indexes[key_fn] = sheet_cache.build_row_index(values, key_fn)
+                rows = indexes[key_fn].get(key, []) if row_number is not None else []
+                targets = [re.sub(r'\d+', str(r), range_name) for r in rows]
+                if targets:
+                    relocated += 1
+                else:
+                    dropped += 1
+                    dropped_callbacks.extend(callbacks)
+                    print(f"Bỏ vùng {range_name} của {title}: không còn dòng nào mang khóa {key}.")
+        for i, target in enumerate(targets):
+            # Giá trị mới hơn (xếp sau trong lô) đè giá trị cũ nếu cùng đích
+            older = verified.pop(target, None)
+            merged = (older[2] if older else ()) + (callbacks if i == 0 else ())
+            verified[target] = (range_values, row_key, merged)
+
+    if relocated or dropped:
+        with _lock:
+            _stats['rows_relocated'] += relocated
+            _stats['rows_dropped'] += dropped
+        print(f"Kiểm tra khóa dòng {title}: dời {relocated} vùng ô, bỏ {dropped} vùng ô trước khi ghi.")
+        sheet_cache.invalidate(title)
+    _notify(dropped_callbacks, False)
+    return verified
+
+
+def _retry_after(error):
+    """(mã HTTP, số giây Retry-After) từ lỗi gspread/requests nếu có."""
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        retry_after = float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        retry_after = None
+    return status, retry_after
+
+
+def _schedule_retry(key, label, count, error):
+    """Gọi khi đang giữ _lock: tính thời điểm thử lại (lùi theo cấp số nhân + nhiễu)."""
+    backoff = _backoff.setdefault(key, {'attempts': 0, 'retry_at': 0.0, 'last_error': None})
+    backoff['attempts'] += 1
+    attempts = backoff['attempts']
+    status, retry_after = _retry_after(error)
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+    if status == 429:
+        _stats['rate_limited'] += 1
+        # Hạn mức tính theo phút: lần thứ hai trở đi chờ hết cửa sổ hiện tại
+        if attempts > 1:
+            delay = max(delay, QUOTA_WINDOW_SECONDS)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    delay += random.uniform(0, RETRY_JITTER * delay)
+    backoff['retry_at'] = time.time() + delay
+    backoff['last_error'] = str(error)[:200]
+    _stats['failures'] += 1
+    if attempts >= ALERT_AFTER_RETRIES:
+        _stats['alerts'] += 1
+        print(f"⚠️ CẢNH BÁO: {count} {label} của {key} vẫn chưa ghi được sau {attempts} lần, "
+              f"sẽ thử lại sau {delay:.0f}s: {error}")
+    else:
+        print(f"Lỗi ghi {label} vào {key} (lần {attempts}), thử lại sau {delay:.1f}s: {error}")
+
+
+def _requeue_appends(title, entries, error):
+    with _lock:
+        # Giữ thứ tự: các dòng lỗi đứng trước các dòng mới được thêm trong lúc đang ghi
+        _pending_appends[title] = entries + _pending_appends.pop(title, [])
+        _schedule_retry(('append', title), 'dòng mới', len(entries), error)
+
+
+def _requeue(title, ranges, error):
+    with _lock:
+        # Giữ lại giá trị mới hơn nếu vùng đó vừa được bấm lại trong lúc đang ghi
+        newer = _pending.pop(title, collections.OrderedDict())
+        merged = collections.OrderedDict(ranges)
+        for range_name, (values, row_key, callbacks) in newer.items():
+            older = merged.pop(range_name, None)
+            merged[range_name] = (values, row_key, (older[2] if older else ()) + callbacks)
+        _pending[title] = merged
+        _schedule_retry(title, 'vùng ô', len(ranges), error)
+
+
+@contextlib.contextmanager
+def paused():
+    """Không cho lô nào được đẩy lên trong khối lệnh (dùng khi xóa dòng làm dịch số dòng)."""
+    with _flush_lock:
+        yield
+
+
+def shift_rows(title, row_ranges):
+    """
+    Gọi sau khi xóa các khoảng dòng [(start, end), ...] của worksheet: vùng ô đang chờ
+    ghi được dời lên theo số dòng đã xóa phía trên nó; vùng chạm vào khoảng bị xóa thì
+    bỏ (dòng đích không còn). Trả về số vùng bị bỏ.
+    """
+    dropped = []
+    with _lock:
+        ranges = _pending.get(title)
+        if not ranges:
+            return 0
+        shifted = collections.OrderedDict()
+        for range_name, entry in ranges.items():
+            match = re.match(r'^([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?$', range_name)
+            if not match:
+                shifted[range_name] = entry
+                continue
+            start = int(match.group(2))
+            end = int(match.group(4) or start)
+            if any(s <= end and start <= e for s, e in row_ranges):
+                dropped.append(entry)
+                continue
+            offset = sum(e - s + 1 for s, e in row_ranges if e < start)
+            new_name = f"{match.group(1)}{start - offset}"
+            if match.group(3):
+                new_name += f":{match.group(3)}{end - offset}"
+            shifted[new_name] = entry
+        if shifted:
+            _pending[title] = shifted
+        else:
+            del _pending[title]
+            _backoff.pop(title, None)
+        _stats['rows_dropped'] += len(dropped)
+    if dropped:
+        print(f"Bỏ {len(dropped)} vùng ô đang chờ ghi của {title}: dòng đích đã bị xóa.")
+        _notify([cb for entry in dropped for cb in entry[2]], False)
+    return len(dropped)
+
+
+def pending_updates(title):
+    """Danh sách (vùng, giá trị) của worksheet còn đang chờ ghi."""
+    with _lock:
+        return [(r, entry[0]) for r, entry in _pending.get(title, {}).items()]
+
+
+def get_queue_stats():
+    with _lock:
+        now = time.time()
+        failing = {
+            str(key): {'attempts': b['attempts'], 'retry_in_s': round(max(0.0, b['retry_at'] - now), 1),
+                       'last_error': b['last_error']}
+            for key, b in _backoff.items()
+        }
+        return dict(_stats, pending=sum(len(r) for r in _pending.values()),
+                    pending_appends=sum(len(r) for r in _pending_appends.values()),
+                    failing=failing, flush_interval_ms=int(FLUSH_INTERVAL_SECONDS * 1000))
+
+
+atexit.register(flush, force=True)